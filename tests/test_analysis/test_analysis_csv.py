@@ -1,5 +1,7 @@
 import hashlib
 import json
+import os
+import pstats
 from datetime import date, datetime
 from tempfile import NamedTemporaryFile
 
@@ -9,9 +11,11 @@ from asyncpg.exceptions import UndefinedTableError
 from yarl import URL
 
 from tests.conftest import RESOURCE_ID, RESOURCE_URL
-from udata_hydra.analysis.csv import analyse_csv, csv_to_db
+from udata_hydra.analysis.csv import analyse_csv, csv_detective_routine, csv_to_db
 from udata_hydra.crawl.check_resources import check_resource
+from udata_hydra.db.check import Check
 from udata_hydra.db.resource import Resource
+from udata_hydra.utils import artifacts
 
 pytestmark = pytest.mark.asyncio
 
@@ -47,6 +51,71 @@ async def test_analyse_csv_on_catalog(
     res = await db.fetchrow("SELECT * from tables_index")
     inspection = json.loads(res["csv_detective"])
     assert all(k in inspection["columns"] for k in ["id", "url"])
+    # the timings of the analysis stages are stored with the check
+    timings: dict = (await Check.get_latest(resource_id=RESOURCE_ID))["analysis_timings"]
+    assert timings["analyse-csv"].keys() == {
+        "download-file",
+        "csv-inspection",
+        "csv-to-db",
+        "csv-to-parquet",
+        "csv-index",
+        "total",
+    }
+    assert timings["analyse-csv"]["download-file"]["bytes"] == len(catalog_content)
+    assert timings["analyse-csv"]["csv-to-db"]["rows"] == 2
+    assert timings["analyse-csv"]["total"]["wall"] >= timings["analyse-csv"]["csv-to-db"]["wall"]
+
+
+async def test_analyse_csv_profile(
+    setup_catalog, rmock, catalog_content, fake_check, produce_mock, mocker, tmp_path
+):
+    mocker.patch("udata_hydra.config.PROFILES_FOLDER", str(tmp_path))
+    check = await fake_check()
+    rmock.get(check["url"], status=200, body=catalog_content)
+    await analyse_csv(check=check, profile=True)
+    path: str = (await Check.get_latest(resource_id=RESOURCE_ID))["analysis_profile"]
+    assert path == str(tmp_path / f"{check['id']}.pstats")
+    functions = {func for _, _, func in pstats.Stats(path).stats}
+    # the CPU-bound steps are profiled along with the rest of the analysis
+    assert {"csv_to_db", "routine", "smart_cast"} <= functions
+
+    # the profiles can be uploaded along with the parquet exports
+    mocker.patch("udata_hydra.config.PROFILES_TO_MINIO", True)
+    send_file = mocker.patch(
+        "udata_hydra.analysis.csv.minio_client.send_file",
+        return_value=f"https://minio/profiles/{check['id']}.pstats",
+    )
+    await analyse_csv(check=check, profile=True)
+    send_file.assert_called_once_with(path, object_name=f"profiles/{check['id']}.pstats")
+    check = await Check.get_latest(resource_id=RESOURCE_ID)
+    assert check["analysis_profile"] == f"https://minio/profiles/{check['id']}.pstats"
+
+
+async def test_analyse_csv_cached_file(
+    setup_catalog, rmock, catalog_content, db, fake_check, produce_mock, mocker, tmp_path
+):
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_FOLDER", str(tmp_path))
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_MAX_SIZE", 1)
+    check = await fake_check()
+    rmock.get(check["url"], status=200, body=catalog_content)
+
+    def inspect_while_evicting(*args, **kwargs):
+        # another job expires and evicts the cache while the file is being analysed
+        mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_TTL", -1)
+        artifacts.evict()
+        return csv_detective_routine(*args, **kwargs)
+
+    mocker.patch("udata_hydra.analysis.csv.csv_detective_routine", inspect_while_evicting)
+    await analyse_csv(check=check)
+
+    res = await db.fetchrow("SELECT * FROM checks")
+    assert res["parsing_error"] is None
+    assert len(await db.fetch(f'SELECT * FROM "{res["parsing_table"]}"')) == 2
+    # the file is cached for the next analyses of the check until it's evicted
+    assert artifacts.pinned() == set()
+    assert os.path.exists(tmp_path / str(check["id"]))
+    artifacts.evict()
+    assert not os.path.exists(tmp_path / str(check["id"]))
 
 
 @pytest.mark.slow
@@ -3,21 +3,36 @@ NB: we can't use pytest-aiohttp helpers because
 it will interfere with the rest of our async code
 """
 
+import asyncio
 import hashlib
 import json
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 
 import pytest
 from aiohttp import RequestInfo
 from aiohttp.client_exceptions import ClientError, ClientResponseError
+from aiohttp.test_utils import TestClient, TestServer
 from yarl import URL
 
 from tests.conftest import DATASET_ID, RESOURCE_ID, RESOURCE_URL
+from udata_hydra.app import app_factory
+from udata_hydra.crawl.check_resources import check_resource_job
+from udata_hydra.db.check import Check
 from udata_hydra.db.resource import Resource
+from udata_hydra.utils.cache import LISTENER_APPLICATION_NAME
 
 pytestmark = pytest.mark.asyncio
 
 
+async def wait_until(condition, timeout: float = 2.5) -> bool:
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return condition()
+
+
 @pytest.mark.parametrize(
     "query",
     [
@@ -69,6 +84,8 @@ async def test_get_latest_check(setup_catalog, client, query, fake_check, fake_r
         "parsing_table": hashlib.md5(url.encode("utf-8")).hexdigest(),
         "parquet_url": "https://example.org/file.parquet",
         "parquet_size": 2048,
+        "analysis_timings": None,
+        "analysis_profile": None,
     }
 
     # Test deleted resource
@@ -77,6 +94,158 @@ async def test_get_latest_check(setup_catalog, client, query, fake_check, fake_r
     assert resp.status == 410
 
 
+async def test_get_latest_check_cached(setup_catalog, mocker, fake_check, api_headers):
+    mocker.patch("udata_hydra.config.API_CACHE_TTL", {"/api/checks/latest": 60})
+    check = await fake_check()
+    app = await app_factory()
+    async with TestClient(TestServer(app)) as client:
+        assert await wait_until(lambda: app["cache"].listening)
+        query = f"resource_id={RESOURCE_ID}"
+        resp = await client.get(f"/api/checks/latest?{query}")
+        assert resp.status == 200
+        etag = resp.headers["ETag"]
+        # the last write date of the check
+        created_at: datetime = (await Check.get_latest(resource_id=RESOURCE_ID))["created_at"]
+        assert parsedate_to_datetime(resp.headers["Last-Modified"]) == created_at.replace(
+            microsecond=0
+        )
+        assert (await resp.json())["id"] == check["id"]
+
+        # the trailing slash variant hits the same entry, answering 304 to the current ETag
+        resp = await client.get(f"/api/checks/latest/?{query}", headers={"If-None-Match": etag})
+        assert resp.status == 304
+        resp = await client.get(f"/api/checks/latest?{query}")
+        assert resp.status == 200
+        assert resp.headers["ETag"] == etag
+        assert app["cache"].hits == 2
+        assert app["cache"].misses == 1
+
+        # a write by another process is notified through Postgres and invalidates the entry
+        await Check.update(
+            check["id"], {"parsing_error": "changed", "parsing_finished_at": datetime.now()}
+        )
+        await wait_until(lambda: not app["cache"].entries)
+        resp = await client.get(f"/api/checks/latest?{query}", headers={"If-None-Match": etag})
+        assert resp.status == 200
+        assert resp.headers["ETag"] != etag
+        assert (await resp.json())["parsing_error"] == "changed"
+
+        # so does a write through the API, before responding
+        assert app["cache"].entries
+        resp = await client.delete(f"/api/resources/{RESOURCE_ID}", headers=api_headers)
+        assert resp.status == 204
+        assert not app["cache"].entries
+
+        resp = await client.get("/api/health")
+        stats = (await resp.json())["cache"]
+        assert stats["hits"] == 2
+        assert stats["misses"] == 2
+        assert stats["not_modified"] == 1
+        assert stats["latency_ms"]["hit"]["p50"] is not None
+
+
+async def test_get_latest_check_cached_etag(setup_catalog, mocker, fake_check):
+    mocker.patch("udata_hydra.config.API_CACHE_TTL", {"/api/checks/latest": 60})
+    check = await fake_check()
+    app = await app_factory()
+    async with TestClient(TestServer(app)) as client:
+        assert await wait_until(lambda: app["cache"].listening)
+        url = f"/api/checks/latest?resource_id={RESOURCE_ID}"
+        resp = await client.get(url)
+        etag = resp.headers["ETag"]
+
+        # the entity tags of If-None-Match are compared exactly, weak ones included
+        for if_none_match, status in (
+            (f'"other", {etag}', 304),
+            (f"W/{etag}", 304),
+            ("*", 304),
+            (f'"prefix-{etag[1:]}', 200),
+            (etag[1:-1], 200),
+        ):
+            resp = await client.get(url, headers={"If-None-Match": if_none_match})
+            assert resp.status == status, if_none_match
+
+        # the ETag is derived from the id and the writes of the check, not from the response
+        app["cache"].clear()
+        resp = await client.get(url, headers={"If-None-Match": etag})
+        assert resp.status == 304
+        await Check.add_timings(check["id"], "analyse-resource", {"download-file": {"wall": 1}})
+        await wait_until(lambda: not app["cache"].entries)
+        resp = await client.get(url, headers={"If-None-Match": etag})
+        assert resp.status == 200
+        assert resp.headers["ETag"] != etag
+
+
+async def test_cache_listener(setup_catalog, mocker, fake_check, db):
+    mocker.patch("udata_hydra.config.API_CACHE_TTL", {"/api/checks/latest": 60})
+    mocker.patch("udata_hydra.utils.cache.LISTENER_CHECK_INTERVAL", 0.1)
+    await fake_check()
+    app = await app_factory()
+    async with TestClient(TestServer(app)) as client:
+        cache = app["cache"]
+        assert await wait_until(lambda: cache.listening)
+        await client.get(f"/api/checks/latest?resource_id={RESOURCE_ID}")
+        assert cache.entries
+
+        # writes to many other resources at once invalidate all the entries
+        await db.execute(
+            """INSERT INTO catalog (dataset_id, resource_id, url, deleted, priority)
+            SELECT $1, md5(i::text)::uuid, 'https://example.com/' || i, FALSE, FALSE
+            FROM generate_series(1, 101) i""",
+            DATASET_ID,
+        )
+        await db.execute("UPDATE catalog SET priority = TRUE WHERE resource_id != $1", RESOURCE_ID)
+        assert await wait_until(lambda: not cache.entries)
+
+        # the notifications are missed while the connection is lost: the cache is cleared,
+        # and bypassed until it listens again
+        await client.get(f"/api/checks/latest?resource_id={RESOURCE_ID}")
+        assert cache.entries
+        q = "SELECT pid FROM pg_stat_activity WHERE application_name = $1"
+        pid: int = await db.fetchval(q, LISTENER_APPLICATION_NAME)
+        await db.execute("SELECT pg_terminate_backend($1)", pid)
+        assert await wait_until(lambda: not cache.entries)
+        for _ in range(50):
+            if cache.listening and await db.fetchval(q, LISTENER_APPLICATION_NAME) != pid:
+                break
+            await asyncio.sleep(0.05)
+        assert cache.listening
+        await client.get(f"/api/checks/latest?resource_id={RESOURCE_ID}")
+        assert cache.entries
+
+
+async def test_get_latest_checks(setup_catalog, client, fake_check, fake_resource_id):
+    await fake_check(status=500)
+    await fake_check(status=200)
+    missing_id: str = str(fake_resource_id())
+
+    resp = await client.post("/api/checks/latest", json={"resource_ids": [RESOURCE_ID, missing_id]})
+    assert resp.status == 200
+    data: dict = await resp.json()
+    assert data[RESOURCE_ID]["status"] == 200
+    assert data[missing_id] is None
+
+    resp = await client.post("/api/checks/latest", json={"urls": [RESOURCE_URL]})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data[RESOURCE_URL]["resource_id"] == RESOURCE_ID
+
+    # the resource_ids are keyed as given
+    resp = await client.post(
+        "/api/checks/latest", json={"resource_ids": [RESOURCE_ID.upper(), RESOURCE_ID]}
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert data[RESOURCE_ID.upper()]["status"] == data[RESOURCE_ID]["status"] == 200
+
+    resp = await client.post("/api/checks/latest", json={"resource_ids": ["not-a-uuid"]})
+    assert resp.status == 400
+    resp = await client.post("/api/checks/latest", json={"resource_ids": RESOURCE_ID})
+    assert resp.status == 400
+    resp = await client.post("/api/checks/latest", json={"resource_ids": [RESOURCE_ID] * 1001})
+    assert resp.status == 400
+
+
 @pytest.mark.parametrize(
     "query",
     [
@@ -100,6 +269,43 @@ async def test_get_all_checks(setup_catalog, client, query, fake_check):
     assert second["error"] == "no-can-do"
 
 
+async def test_get_all_checks_paginated(setup_catalog, client, fake_check):
+    for status in (500, 502, 200):
+        await fake_check(status=status)
+
+    resp = await client.get(f"/api/checks/all?resource_id={RESOURCE_ID}&page_size=2")
+    assert resp.status == 200
+    assert [c["status"] for c in await resp.json()] == [200, 502]
+    next_url = resp.links["next"]["url"]
+
+    resp = await client.get(next_url.path_qs)
+    assert resp.status == 200
+    assert [c["status"] for c in await resp.json()] == [500]
+    assert "next" not in resp.links
+
+    resp = await client.get(f"/api/checks/all?resource_id={RESOURCE_ID}&page_size=0")
+    assert resp.status == 400
+    resp = await client.get(f"/api/checks/all?resource_id={RESOURCE_ID}&cursor=nope")
+    assert resp.status == 400
+
+
+async def test_get_all_checks_ndjson_since(setup_catalog, client, fake_check, db):
+    await fake_check(status=500)
+    await fake_check(status=200)
+    await db.execute("UPDATE checks SET created_at = '2024-01-01' WHERE status = 500")
+
+    resp = await client.get(f"/api/checks/all?resource_id={RESOURCE_ID}&format=ndjson")
+    assert resp.status == 200
+    assert resp.content_type == "application/x-ndjson"
+    lines = (await resp.text()).splitlines()
+    assert [json.loads(line)["status"] for line in lines] == [200, 500]
+
+    resp = await client.get(f"/api/checks/all?resource_id={RESOURCE_ID}&since=2024-06-01")
+    assert [c["status"] for c in await resp.json()] == [200]
+    resp = await client.get(f"/api/checks/all?resource_id={RESOURCE_ID}&until=2024-06-01")
+    assert [c["status"] for c in await resp.json()] == [500]
+
+
 @pytest.mark.parametrize(
     "query,value_template",
     [
@@ -134,6 +340,33 @@ async def test_api_get_checks_aggregate(setup_catalog, client, query, value_temp
         assert data[i]["count"] == occurences[i]
 
 
+async def test_api_get_checks_aggregate_dates(setup_catalog, client, fake_check):
+    for day, status in [(4, 200), (5, 200), (5, 404), (6, 500), (6, 200), (6, None)]:
+        await fake_check(created_at=datetime(2024, 9, day, 10, 0, 0), status=status)
+
+    resp = await client.get(
+        "/api/checks/aggregate?group_by=status&since=2024-09-05&until=2024-09-06"
+    )
+    assert resp.status == 200
+    assert await resp.json() == [
+        {"value": "200", "count": 2},
+        {"value": "404", "count": 1},
+        {"value": "500", "count": 1},
+        {"value": None, "count": 1},
+    ]
+    resp = await client.get("/api/checks/aggregate?group_by=domain&since=2024-09-01&page_size=1")
+    assert await resp.json() == [{"value": "example.com", "count": 6}]
+
+    for query in [
+        "group_by=domain;DROP TABLE checks&created_at=today",
+        "group_by=url&created_at=today",
+        "group_by=domain&since=stupid",
+        "group_by=domain",
+    ]:
+        resp = await client.get(f"/api/checks/aggregate?{query}")
+        assert resp.status == 400
+
+
 async def test_create_check_wrongly(
     setup_catalog,
     client,
@@ -151,6 +384,88 @@ async def test_create_check_wrongly(
     assert resp.status == 404
 
 
+async def test_create_check_async(
+    setup_catalog, client, rmock, mocker, udata_url, api_headers, fake_resource_id, fake_check
+):
+    enqueue = mocker.patch("udata_hydra.utils.queue.enqueue")
+    rmock.head(RESOURCE_URL, status=200, headers={"Content-LENGTH": "10"})
+    rmock.put(udata_url)
+
+    resp = await client.post(
+        "/api/checks", headers=api_headers, json={"resource_id": RESOURCE_ID, "async": True}
+    )
+    assert resp.status == 202
+    job: dict = await resp.json()
+    assert job["status"] == "QUEUED"
+    assert job["resource_id"] == RESOURCE_ID
+    assert job["check"] is None
+    assert resp.headers["Location"] == f"/api/checks/jobs/{job['id']}"
+    enqueue.assert_called_once_with(check_resource_job, job["id"], _priority="high")
+
+    # a burst of concurrent requests for the same resource shares the pending job
+    responses = await asyncio.gather(
+        *(
+            client.post(
+                "/api/checks", headers=api_headers, json={"resource_id": RESOURCE_ID, "async": True}
+            )
+            for _ in range(5)
+        )
+    )
+    assert {(resp.status, (await resp.json())["id"]) for resp in responses} == {(202, job["id"])}
+    assert enqueue.call_count == 1
+
+    resp = await client.get(f"/api/checks/jobs/{job['id']}?wait=0.1")
+    assert resp.status == 200
+    assert (await resp.json())["status"] == "QUEUED"
+
+    await check_resource_job(job["id"])
+    resp = await client.get(f"/api/checks/jobs/{job['id']}")
+    assert resp.status == 200
+    data: dict = await resp.json()
+    assert data["status"] == "DONE"
+    assert data["result"] == "ok"
+    assert data["started_at"] and data["finished_at"]
+    assert data["check"]["id"] == data["check_id"]
+    assert data["check"]["status"] == 200
+
+    # the job keeps its check once the resource is checked again
+    await fake_check(status=500)
+    resp = await client.get(f"/api/checks/jobs/{job['id']}")
+    assert (await resp.json())["check"] == data["check"]
+
+    resp = await client.get("/api/checks/jobs/stupid")
+    assert resp.status == 400
+    resp = await client.get(f"/api/checks/jobs/{fake_resource_id()}")
+    assert resp.status == 404
+
+
+async def test_create_check_async_lost_jobs(setup_catalog, client, mocker, api_headers, db):
+    payload = {"resource_id": RESOURCE_ID, "async": True}
+    # a job which couldn't be enqueued doesn't stay pending
+    mocker.patch("udata_hydra.utils.queue.enqueue", side_effect=ConnectionError)
+    resp = await client.post("/api/checks", headers=api_headers, json=payload)
+    assert resp.status == 500
+    failed = await db.fetchrow("SELECT * FROM check_jobs")
+    assert failed["status"] == "FAILED"
+
+    enqueue = mocker.patch("udata_hydra.utils.queue.enqueue")
+    resp = await client.post("/api/checks", headers=api_headers, json=payload)
+    assert resp.status == 202
+    queued = await resp.json()
+    assert queued["id"] != str(failed["id"])
+    assert enqueue.call_count == 1
+
+    # a job queued for too long is deemed lost and replaced
+    mocker.patch("udata_hydra.config.CHECK_JOBS_MAX_QUEUED", -1)
+    resp = await client.post("/api/checks", headers=api_headers, json=payload)
+    assert resp.status == 202
+    assert (await resp.json())["id"] != queued["id"]
+    assert enqueue.call_count == 2
+    lost = await db.fetchrow("SELECT * FROM check_jobs WHERE id = $1", queued["id"])
+    assert lost["status"] == "FAILED"
+    assert lost["error"] == "lost"
+
+
 @pytest.mark.parametrize(
     "resource",
     [
@@ -60,6 +60,7 @@ async def test_create_resource_exception(
             "resource_id": RESOURCE_ID,
             "table_indexes": RESOURCE_EXCEPTION_TABLE_INDEXES,
             "comment": "This is a test comment.",
+            "profile": True,
         },
     )
     assert resp.status == 201
@@ -67,6 +68,7 @@ async def test_create_resource_exception(
     assert data["resource_id"] == RESOURCE_ID
     assert json.loads(data["table_indexes"]) == RESOURCE_EXCEPTION_TABLE_INDEXES
     assert data["comment"] == "This is a test comment."
+    assert data["profile"] is True
 
     # Test posting the same resource exception
     resp = await client.post(
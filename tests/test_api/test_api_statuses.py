@@ -5,7 +5,9 @@ it will interfere with the rest of our async code
 
 import pytest
 
+from udata_hydra.db.check import Check
 from udata_hydra.db.resource import Resource
+from udata_hydra.db.stats import Stats
 
 pytestmark = pytest.mark.asyncio
 
@@ -25,6 +27,14 @@ async def test_get_crawler_status(setup_catalog, client, fake_check):
     resp = await client.get("/api/status/crawler")
     assert resp.status == 200
     data: dict = await resp.json()
+    computed_at = data.pop("computed_at")
+    assert data == expected_data
+
+    # the snapshot is served until it's refreshed
+    await fake_check()
+    resp = await client.get("/api/status/crawler")
+    data: dict = await resp.json()
+    assert data.pop("computed_at") == computed_at
     assert data == expected_data
 
     expected_resources_statuses_count = {s: 0 for s in Resource.STATUSES if s}
@@ -38,17 +48,29 @@ async def test_get_crawler_status(setup_catalog, client, fake_check):
         "resources_statuses_count": expected_resources_statuses_count,
     }
 
-    await fake_check()
+    await Stats.refresh("crawler_status")
     resp = await client.get("/api/status/crawler")
     assert resp.status == 200
     data: dict = await resp.json()
+    assert data.pop("computed_at") > computed_at
     assert data == expected_data
 
 
+async def test_get_crawler_status_outdated_snapshot(setup_catalog, client, fake_check, mocker):
+    await client.get("/api/status/crawler")
+    await fake_check()
+    # the API refreshes snapshots older than STATS_MAX_AGE itself
+    mocker.patch("udata_hydra.config.STATS_MAX_AGE", 0)
+    resp = await client.get("/api/status/crawler")
+    data: dict = await resp.json()
+    assert data["fresh_checks"] == 1
+
+
 async def test_get_stats(setup_catalog, client, fake_check):
     resp = await client.get("/api/stats")
     assert resp.status == 200
     data: dict = await resp.json()
+    assert data.pop("computed_at")
     assert data == {
         "status": [
             {"label": "error", "count": 0, "percentage": 0},
@@ -62,9 +84,11 @@ async def test_get_stats(setup_catalog, client, fake_check):
     await fake_check()
     await fake_check(timeout=True, status=None)
     await fake_check(status=500, error="error")
+    await Stats.refresh("checks_stats")
     resp = await client.get("/api/stats")
     assert resp.status == 200
     data: dict = await resp.json()
+    assert data.pop("computed_at")
     assert data == {
         "status": [
             {"label": "error", "count": 1, "percentage": 100.0},
@@ -75,6 +99,53 @@ async def test_get_stats(setup_catalog, client, fake_check):
     }
 
 
+async def test_get_analysis_stats(setup_catalog, client, fake_check):
+    for wall in (1, 2, 3):
+        check = await fake_check()
+        await Check.add_timings(
+            check["id"],
+            "analyse-csv",
+            {"csv-to-db": {"wall": wall, "cpu": 0.5, "rows": 10}, "total": {"wall": 4, "cpu": 1}},
+        )
+    resp = await client.get("/api/stats/analysis")
+    assert resp.status == 200
+    data: dict = await resp.json()
+    assert data.pop("computed_at")
+    assert data["analyses"]["analyse-csv"]["csv-to-db"] == {
+        "count": 3,
+        "wall": {"p50": 2.0, "p95": 2.9, "p99": 2.98},
+        "cpu": {"p50": 0.5, "p95": 0.5, "p99": 0.5},
+        "rows": 30,
+        "bytes": None,
+    }
+    assert data["analyses"]["analyse-csv"]["total"]["count"] == 3
+
+
 async def test_get_health(client) -> None:
     resp = await client.get("/api/health")
     assert resp.status == 200
+    data: dict = await resp.json()
+    assert data["pools"]["role"] == "api"
+
+
+async def test_get_metrics(setup_catalog, client, mocker) -> None:
+    mocker.patch("udata_hydra.utils.metrics._queues_stats_fetched_at", 0)
+    fetch = mocker.patch(
+        "udata_hydra.utils.metrics._fetch_queues_stats",
+        return_value={"depth": {("high",): 2}, "wait": {("high",): 1.5}},
+    )
+    await client.get("/api/health")
+    resp = await client.get("/api/metrics")
+    assert resp.status == 200
+    assert resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text: str = await resp.text()
+    assert "# TYPE hydra_checks_total counter" in text
+    assert "# TYPE hydra_db_pool_connections gauge" in text
+    assert '\nhydra_db_queries{counter="queries"} ' in text
+    assert '\nhydra_queue_depth{queue="high"} 2\n' in text
+    assert '\nhydra_queue_oldest_wait_seconds{queue="high"} 1.5\n' in text
+
+    # the stats of the queues are fetched from Redis once for the scrapes of METRICS_QUEUES_TTL
+    resp = await client.get("/api/metrics")
+    assert '\nhydra_queue_depth{queue="high"} 2\n' in await resp.text()
+    assert fetch.call_count == 1
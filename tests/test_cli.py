@@ -1,10 +1,12 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 import nest_asyncio
 import pytest
 from minicli import run
+from yarl import URL
 
-from tests.conftest import RESOURCE_ID, RESOURCE_URL
+from tests.conftest import DATASET_ID, RESOURCE_ID, RESOURCE_URL
+from udata_hydra import config
 from udata_hydra.db.resource import Resource
 
 pytestmark = pytest.mark.asyncio
@@ -36,6 +38,90 @@ async def test_purge_checks(setup_catalog, db, fake_check):
     assert len(res) == 1
 
 
+async def test_purge_checks_partitions(setup_catalog, db, fake_check):
+    # replace the (empty) legacy partition with monthly partitions over the past months
+    await db.execute("ALTER TABLE checks DETACH PARTITION checks_legacy")
+    await db.execute("DROP TABLE checks_legacy")
+    await db.execute("SELECT create_checks_partitions(now() - interval '6 months', 7)")
+    now = datetime.now(timezone.utc)
+    old_partition = f"checks_{now - timedelta(days=150):%Y_%m}"
+    await fake_check(created_at=now - timedelta(days=150))
+    await fake_check(created_at=now - timedelta(days=50))
+    check = await fake_check(created_at=now - timedelta(days=10))
+    await Resource.update(resource_id=RESOURCE_ID, data={"last_check": check["id"]})
+    run("purge_checks", retention_days=60)
+    res = await db.fetch("SELECT * FROM checks")
+    assert len(res) == 2
+    # the partition of outdated checks has been dropped as a whole
+    res = await db.fetchrow("SELECT tablename FROM pg_tables WHERE tablename = $1", old_partition)
+    assert res is None
+    run("purge_checks", retention_days=20)
+    res = await db.fetch("SELECT * FROM checks")
+    assert len(res) == 1
+    resource = await Resource.get(RESOURCE_ID)
+    assert resource["last_check"] == check["id"]
+
+
+async def test_sync_catalog(setup_catalog, db, rmock):
+    url = f"{config.CATALOG_SYNC_URL}?sort=-last_update&page_size={config.CATALOG_SYNC_PAGE_SIZE}"
+    new_resource_id = "5d0b2b91-b21b-4120-83ef-83f818ba2451"
+    rmock.get(
+        url,
+        payload={
+            "data": [
+                {
+                    "id": "601ddcfc85a59c3a45c2435c",
+                    "last_update": "2025-01-20T10:00:00+00:00",
+                    "archived": None,
+                    "resources": [
+                        {"id": new_resource_id, "url": "https://example.com/new", "harvest": None}
+                    ],
+                },
+                {
+                    # the only resource of this dataset has been removed
+                    "id": DATASET_ID,
+                    "last_update": "2025-01-15T10:00:00+00:00",
+                    "archived": None,
+                    "resources": [],
+                },
+            ],
+            "next_page": f"{url}&page=2",
+        },
+    )
+    rmock.get(
+        f"{url}&page=2",
+        payload={
+            "data": [
+                {
+                    # already synced, next pages are not fetched
+                    "id": "601ddcfc85a59c3a45c2435d",
+                    "last_update": "2025-01-01T10:00:00+00:00",
+                    "archived": None,
+                    "resources": [],
+                },
+            ],
+            "next_page": f"{url}&page=3",
+        },
+    )
+    run("sync_catalog", since="2025-01-10T00:00:00")
+
+    assert ("GET", URL(f"{url}&page=3")) not in rmock.requests
+    res = await db.fetchrow("SELECT * FROM catalog WHERE resource_id = $1", new_resource_id)
+    assert res["url"] == "https://example.com/new"
+    assert res["deleted"] is False
+    res = await db.fetchrow("SELECT * FROM catalog WHERE resource_id = $1", RESOURCE_ID)
+    assert res["deleted"] is True
+    res = await db.fetchrow("SELECT * FROM catalog_sync")
+    assert res["source"] == config.CATALOG_SYNC_URL
+    assert res["watermark"] == datetime(2025, 1, 20, 10, tzinfo=timezone.utc)
+
+    # the next sync starts from the watermark
+    rmock.get(url, payload={"data": [], "next_page": None})
+    run("sync_catalog")
+    res = await db.fetchrow("SELECT * FROM catalog_sync")
+    assert res["watermark"] == datetime(2025, 1, 20, 10, tzinfo=timezone.utc)
+
+
 async def test_purge_csv_tables(setup_catalog, db, fake_check):
     # pretend we have a csv_analysis with a converted table for this url
     check = await fake_check(parsing_table=True)
@@ -0,0 +1,10 @@
+from udata_hydra import config, context
+
+
+def test_pool_settings(mocker):
+    assert context.pool_settings("api")["max_size"] == config.POOL_PROFILES["api"]["max_size"]
+    # unknown roles fall back to MAX_POOL_SIZE
+    assert context.pool_settings("unknown")["max_size"] == config.MAX_POOL_SIZE
+    assert context.pool_settings("worker")["statement_cache_size"] > 0
+    mocker.patch("udata_hydra.config.EXTERNAL_POOLER", True)
+    assert context.pool_settings("worker")["statement_cache_size"] == 0
@@ -5,12 +5,14 @@ import pytest
 from aiohttp import ClientSession
 from yarl import URL
 
-from tests.conftest import RESOURCE_URL
+from tests.conftest import RESOURCE_ID, RESOURCE_URL
 from udata_hydra.crawl import start_checks
 from udata_hydra.crawl.check_resources import (
     RESOURCE_RESPONSE_STATUSES,
     check_resource,
 )
+from udata_hydra.crawl.helpers import is_domain_backoff
+from udata_hydra.db.check import Check
 
 # TODO: make file content configurable
 SIMPLE_CSV_CONTENT = """code_insee,number
@@ -199,3 +201,23 @@ async def test_no_backoff_domains(
     event_loop.run_until_complete(start_checks(iterations=1))
     # verify that we actually did not back-off
     assert not magic.add_backoff.called
+
+
+async def test_backoff_buffered_checks(setup_catalog, mocker, db):
+    mocker.patch("udata_hydra.config.CHECKS_FLUSH_INTERVAL", 3600)
+    domain = URL(RESOURCE_URL).host
+    # a 429 is not written in DB yet, but we should backoff right away
+    await Check.buffer(
+        {"resource_id": RESOURCE_ID, "url": RESOURCE_URL, "domain": domain, "status": 429}
+    )
+    assert not await db.fetch("SELECT * FROM checks")
+    should_backoff, reason = await is_domain_backoff(domain)
+    assert should_backoff
+    assert "429" in reason
+
+    # buffered checks are counted along with the ones in DB
+    mocker.patch("udata_hydra.config.BACKOFF_NB_REQ", 1)
+    mocker.patch("udata_hydra.config.COOL_OFF_PERIOD", 0)
+    should_backoff, reason = await is_domain_backoff(domain)
+    assert should_backoff
+    assert reason == "Too many requests: 1"
@@ -16,12 +16,17 @@ from yarl import URL
 
 from tests.conftest import RESOURCE_ID, RESOURCE_URL
 from udata_hydra import config
-from udata_hydra.analysis.resource import analyse_resource
+from udata_hydra.analysis.resource import (
+    Change,
+    analyse_resource,
+    detect_resource_change_on_early_hints,
+)
 from udata_hydra.crawl import start_checks
-from udata_hydra.crawl.check_resources import check_resource
+from udata_hydra.crawl.check_resources import check_resource, flush_pending_writes
 from udata_hydra.crawl.preprocess_check_data import get_content_type_from_header
 from udata_hydra.db.check import Check
 from udata_hydra.db.resource import Resource
+from udata_hydra.utils import metrics
 
 # TODO: make file content configurable
 SIMPLE_CSV_CONTENT = """code_insee,number
@@ -74,9 +79,21 @@ async def test_crawl(setup_catalog, rmock, event_loop, db, resource, analysis_mo
     # mock for head fallback
     rmock.get(rurl, **params)
     rmock.put(udata_url)
+    responses: dict = dict(metrics.CHECK_RESPONSES.series)
     event_loop.run_until_complete(start_checks(iterations=1))
     assert ("HEAD", URL(rurl)) in rmock.requests
 
+    # the response of the check is counted once, by its status
+    counted = {
+        key: count - responses.get(key, 0)
+        for key, count in metrics.CHECK_RESPONSES.series.items()
+        if count != responses.get(key, 0)
+    }
+    if timeout:
+        assert counted == {}
+    else:
+        assert counted == {(str(status) if not exception else "error",): 1}
+
     # test check results in DB
     res = await db.fetchrow("SELECT * FROM checks WHERE url = $1", rurl)
     assert res["url"] == rurl
@@ -225,6 +242,22 @@ async def test_analyse_resource(setup_catalog, mocker, fake_check):
     assert result["mime_type"] == "text/plain"
 
 
+async def test_analyse_resource_legacy_headers(setup_catalog, mocker, fake_check):
+    """Jobs enqueued by the previous release carry the check headers as a JSON string"""
+    download = mocker.patch(
+        "udata_hydra.analysis.resource.download_resource", side_effect=mock_download_resource
+    )
+    mocker.patch("udata_hydra.config.WEBHOOK_ENABLED", False)
+
+    check = await fake_check(headers={"content-type": "text/csv"})
+    legacy_check = {**check, "headers": json.dumps(check["headers"])}
+    await analyse_resource(check=legacy_check, last_check=legacy_check)
+    result: Record | None = await Check.get_by_id(check["id"])
+
+    assert download.call_args.args[1] == {"content-type": "text/csv"}
+    assert result["checksum"] == hashlib.sha1(SIMPLE_CSV_CONTENT.encode("utf-8")).hexdigest()
+
+
 async def test_analyse_resource_send_udata(setup_catalog, mocker, rmock, fake_check, udata_url):
     mocker.patch("udata_hydra.analysis.resource.download_resource", mock_download_resource)
     rmock.put(udata_url, status=200, repeat=True)
@@ -256,6 +289,24 @@ async def test_analyse_resource_send_udata_no_change(
     assert ("PUT", URL(udata_url)) not in rmock.requests
 
 
+async def test_change_detection_from_job_payload(setup_catalog):
+    resource: Record | None = await Resource.get(RESOURCE_ID)
+    now = datetime.now(timezone.utc)
+    last_check = {"created_at": now - timedelta(days=1), "headers": {"content-length": "1"}}
+    check = {"created_at": now, "headers": {"content-length": "2"}}
+    # changes are detected from the checks passed along, without querying the checks table
+    change_status, change_payload = await detect_resource_change_on_early_hints(
+        resource, check, last_check
+    )
+    assert change_status == Change.HAS_CHANGED
+    assert change_payload["analysis:last-modified-at"] == now.isoformat()
+    assert change_payload["analysis:last-modified-detection"] == "content-length-header"
+
+    check["headers"]["content-length"] = "1"
+    change_status, _ = await detect_resource_change_on_early_hints(resource, check, last_check)
+    assert change_status == Change.HAS_NOT_CHANGED
+
+
 async def test_analyse_resource_from_crawl(setup_catalog, rmock, event_loop, db, udata_url):
     """
     Looks a lot like an E2E test:
@@ -276,7 +327,11 @@ async def test_analyse_resource_from_crawl(setup_catalog, rmock, event_loop, db,
 
     event_loop.run_until_complete(start_checks(iterations=1))
 
-    assert len(rmock.requests[("PUT", URL(udata_url))]) == 2
+    # check and analysis results of the resource are coalesced in a single document
+    requests = rmock.requests[("PUT", URL(udata_url))]
+    assert len(requests) == 1
+    assert "check:status" in requests[0].kwargs["json"]
+    assert "analysis:checksum" in requests[0].kwargs["json"]
     res = await db.fetch("SELECT * FROM checks")
     assert len(res) == 1
     assert res[0]["url"] == rurl
@@ -576,10 +631,42 @@ async def test_check_triggers_csv_analysis(rmock, event_loop, db, produce_mock,
     assert len(res) == 2
 
 
+@pytest.mark.parametrize(
+    "content_type,body,is_tabular",
+    [
+        ("application/octet-stream", SIMPLE_CSV_CONTENT.encode("utf-8"), True),
+        ("application/octet-stream", b"Some plain text\nthat isn't tabular at all.\n", False),
+        ("application/octet-stream", b"\x89PNG\r\n\x1a\n" + bytes(range(256)), False),
+        # a single column has no delimiter: tabular if its headers say so
+        ("application/octet-stream", b"code\n75001\n75002\n", False),
+        ("text/plain", b"code\n75001\n75002\n", True),
+        ("text/plain", b"\x89PNG\r\n\x1a\n" + bytes(range(256)), False),
+    ],
+)
+async def test_sniff_tabular_content(
+    rmock, event_loop, db, produce_mock, setup_catalog, mocker, content_type, body, is_tabular
+):
+    """A file served with a generic content-type is analysed as a CSV if its first bytes look like one"""
+    mocker.patch("udata_hydra.config.SNIFF_TABULAR", True)
+    rurl = RESOURCE_URL
+    headers = {"content-type": content_type, "content-length": str(len(body))}
+    rmock.head(rurl, status=200, headers=headers)
+    # mocks for the sniffing of the first bytes, then for the analysis download
+    rmock.get(rurl, status=206, headers=headers, body=body)
+    rmock.get(rurl, status=200, headers=headers, body=body)
+    event_loop.run_until_complete(start_checks(iterations=1))
+    requests = rmock.requests[("GET", URL(rurl))]
+    assert requests[0].kwargs["headers"]["Range"] == f"bytes=0-{config.SNIFF_SIZE - 1}"
+    res = await db.fetch("SELECT * FROM checks")
+    assert (res[0]["parsing_table"] is not None) == is_tabular
+
+
+@pytest.mark.parametrize("content_type", ["application/csv", "text/plain"])
 async def test_recheck_download_only_once(
-    rmock, fake_check, event_loop, db, produce_mock, setup_catalog
+    rmock, fake_check, event_loop, db, produce_mock, setup_catalog, mocker, content_type
 ):
-    """On recheck of a (CSV) file, if it hasn't change, downloads only once"""
+    """On recheck of a (CSV) file, if it hasn't change, downloads only once, without sniffing it"""
+    mocker.patch("udata_hydra.config.SNIFF_TABULAR", True)
     await fake_check(
         resource_id=RESOURCE_ID, headers={"last-modified": "Thu, 09 Jan 2020 09:33:37 GMT"}
     )
@@ -590,7 +677,7 @@ async def test_recheck_download_only_once(
         status=200,
         headers={
             "last-modified": "Thu, 09 Jan 2020 09:33:37 GMT",
-            "content-type": "application/csv",
+            "content-type": content_type,
         },
     )
     await db.execute("UPDATE catalog SET priority = TRUE WHERE resource_id = $1", RESOURCE_ID)
@@ -696,6 +783,7 @@ async def test_wrong_url_in_catalog(
         )
     async with ClientSession() as session:
         await check_resource(url=not_found_url, resource=r, session=session)
+    await flush_pending_writes()
     if url_changed:
         r = await Resource.get(resource_id=RESOURCE_ID, column_name="url")
         assert r["url"] == new_url
@@ -704,3 +792,19 @@ async def test_wrong_url_in_catalog(
     else:
         check = await Check.get_by_resource_id(RESOURCE_ID)
         assert check["status"] == 404
+
+
+async def test_check_resource_not_buffered(setup_catalog, rmock, mocker, db):
+    enqueue = mocker.patch("udata_hydra.utils.queue.enqueue")
+    r = await Resource.get(RESOURCE_ID)
+    rmock.head(r["url"], status=200, headers={"content-length": "10"})
+    async with ClientSession() as session:
+        await check_resource(url=r["url"], resource=r, session=session, buffered=False)
+    # the checks requested on demand are in DB as soon as they're made, along with their resource
+    assert Check.get_buffered(RESOURCE_ID) is None
+    check = await Check.get_by_resource_id(RESOURCE_ID)
+    assert check["status"] == 200
+    resource = await db.fetchrow("SELECT * FROM catalog WHERE resource_id = $1", RESOURCE_ID)
+    assert resource["last_check"] == check["id"]
+    assert resource["status"] == "TO_ANALYSE_RESOURCE"
+    assert enqueue.call_args.kwargs["check"]["id"] == check["id"]
@@ -1,8 +1,12 @@
+from datetime import datetime, timedelta, timezone
+
 import pytest
 from asyncpg import Record
 
-from tests.conftest import RESOURCE_ID
+from tests.conftest import DATASET_ID, RESOURCE_ID, RESOURCE_URL
+from udata_hydra import context
 from udata_hydra.db.check import Check
+from udata_hydra.db.resource import Resource
 
 pytestmark = pytest.mark.asyncio
 
@@ -21,3 +25,105 @@ async def test_delete_check(setup_catalog, fake_check):
     await Check.delete(check_id)
     checks: list[Record] = await Check.get_all(resource_id=RESOURCE_ID)
     assert len(checks) == 0
+    # its resource no longer points to it
+    resource: Record = await Resource.get(RESOURCE_ID)
+    assert resource["last_check"] is None
+    assert resource["last_check_at"] is None
+
+
+async def test_ingest_check(setup_catalog, db, fake_check):
+    previous_check: dict = await fake_check()
+    data = {
+        "resource_id": RESOURCE_ID,
+        "url": RESOURCE_URL,
+        "domain": "example.com",
+        "status": 200,
+        "headers": {"content-type": "text/csv"},
+        "timeout": False,
+    }
+
+    pool = await context.pool()
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            last_check: Record | None = await Check.get_last_for_update(connection, RESOURCE_ID)
+            check: dict = await Check.ingest(connection, data, "TO_ANALYSE_RESOURCE")
+
+    assert last_check["id"] == previous_check["id"]
+    assert check["id"] != previous_check["id"]
+    assert check["dataset_id"] == DATASET_ID
+    assert check["status"] == 200
+    # JSONB columns are decoded by the pool
+    assert check["headers"] == {"content-type": "text/csv"}
+
+    resource = await db.fetchrow("SELECT * FROM catalog WHERE resource_id = $1", RESOURCE_ID)
+    assert resource["last_check"] == check["id"]
+    assert resource["last_check_at"] == check["created_at"]
+    assert resource["status"] == "TO_ANALYSE_RESOURCE"
+    assert resource["priority"] is False
+
+
+async def test_check_headers_decoded(setup_catalog, fake_check):
+    check: dict = await fake_check(headers={"content-type": "text/csv"})
+    # headers are stored as JSONB, not as a JSON-encoded string
+    assert (await Check.get_by_id(check["id"]))["headers"] == {"content-type": "text/csv"}
+    assert check["headers"] == {"content-type": "text/csv"}
+
+
+async def test_buffer_checks(setup_catalog, db, mocker):
+    mocker.patch("udata_hydra.config.CHECKS_FLUSH_INTERVAL", 3600)
+    data = {
+        "resource_id": RESOURCE_ID,
+        "url": RESOURCE_URL,
+        "domain": "example.com",
+        "timeout": True,
+    }
+    ingested: list[dict] = []
+
+    async def on_ingested(check: dict) -> None:
+        ingested.append(check)
+
+    buffered: dict = await Check.buffer(data, on_ingested=on_ingested)
+    # the check is not in DB yet, but it stands for the last check of the resource
+    assert not await db.fetch("SELECT * FROM checks")
+    assert Check.get_buffered(RESOURCE_ID)["timeout"] is True
+    assert not ingested
+
+    await db.execute(
+        "UPDATE catalog SET status = 'CRAWLING_URL', priority = TRUE WHERE resource_id = $1",
+        RESOURCE_ID,
+    )
+    await Check.flush_buffered()
+    assert Check.get_buffered(RESOURCE_ID) is None
+    checks = await db.fetch("SELECT * FROM checks")
+    assert len(checks) == 1
+    assert checks[0]["timeout"] is True
+    # the check is stamped with the time it was made at, not the one of the flush
+    assert checks[0]["created_at"] == buffered["created_at"]
+    assert [c["id"] for c in ingested] == [checks[0]["id"]]
+    assert ingested[0]["dataset_id"] == DATASET_ID
+    resource = await db.fetchrow("SELECT * FROM catalog WHERE resource_id = $1", RESOURCE_ID)
+    assert resource["last_check"] == checks[0]["id"]
+    assert resource["last_check_at"] == checks[0]["created_at"]
+    assert resource["status"] is None
+    assert resource["priority"] is False
+
+    # the status of the resource is set along with its check
+    await Check.buffer({**data, "timeout": False}, resource_status="TO_ANALYSE_RESOURCE")
+    await Check.flush_buffered()
+    resource = await db.fetchrow("SELECT * FROM catalog WHERE resource_id = $1", RESOURCE_ID)
+    assert resource["status"] == "TO_ANALYSE_RESOURCE"
+    assert len(await db.fetch("SELECT * FROM checks")) == 2
+
+
+async def test_drain_checks_default(setup_catalog, db, fake_check):
+    # a check of a month whose partition doesn't exist yet is caught by the default partition
+    created_at = datetime.now(timezone.utc) + timedelta(days=365 * 2)
+    check: dict = await fake_check(created_at=created_at)
+    assert len(await db.fetch("SELECT * FROM checks_default")) == 1
+
+    await Check.create_partitions()
+    # it has been moved to the partition of its month, and is still the last check of its resource
+    assert not await db.fetch("SELECT * FROM checks_default")
+    res = await db.fetch(f'SELECT * FROM "checks_{created_at:%Y_%m}"')
+    assert [r["id"] for r in res] == [check["id"]]
+    assert (await Check.get_by_resource_id(RESOURCE_ID))["id"] == check["id"]
@@ -4,6 +4,8 @@ from minicli import run
 
 from tests.conftest import DATASET_ID, RESOURCE_ID, RESOURCE_URL
 from udata_hydra.crawl import start_checks
+from udata_hydra.db import queries
+from udata_hydra.db.resource import Resource
 
 pytestmark = pytest.mark.asyncio
 # allows nested async to test async with async :mindblown:
@@ -79,3 +81,95 @@ async def test_catalog_deleted_with_new_url(
     assert len(res) == 1
     assert res[0]["deleted"] is False
     assert "resource-2" in res[0]["url"]
+
+
+async def test_catalog_unchanged_rows_untouched(setup_catalog, db, rmock, catalog_content):
+    q = "SELECT xmin::text AS version FROM catalog WHERE resource_id = $1"
+    before = await db.fetchrow(q, RESOURCE_ID)
+    # load the same catalog again, the unchanged resource must not be rewritten
+    catalog = "https://example.com/catalog"
+    rmock.get(catalog, status=200, body=catalog_content)
+    run("load_catalog", url=catalog)
+    after = await db.fetchrow(q, RESOURCE_ID)
+    assert after["version"] == before["version"]
+
+
+async def test_set_status_buffered(setup_catalog, db, mocker):
+    mocker.patch("udata_hydra.config.STATUS_FLUSH_INTERVAL", 3600)
+    await Resource.flush_statuses()
+
+    await Resource.set_status(RESOURCE_ID, "TO_ANALYSE_RESOURCE", priority=True)
+    await Resource.set_status(RESOURCE_ID, "ANALYSING_RESOURCE")
+    # nothing has been written in DB yet
+    res = await db.fetchrow(
+        "SELECT status, priority FROM catalog WHERE resource_id = $1", RESOURCE_ID
+    )
+    assert res["status"] is None
+    assert res["priority"] is False
+
+    # transitions are coalesced into the last status, keeping the buffered priority
+    await Resource.flush_statuses()
+    res = await db.fetchrow(
+        "SELECT status, priority FROM catalog WHERE resource_id = $1", RESOURCE_ID
+    )
+    assert res["status"] == "ANALYSING_RESOURCE"
+    assert res["priority"] is True
+
+    # a direct update supersedes the buffered transitions
+    await Resource.set_status(RESOURCE_ID, None)
+    await Resource.update(RESOURCE_ID, data={"status": "ANALYSING_CSV"})
+    await Resource.flush_statuses()
+    res = await db.fetchrow("SELECT status FROM catalog WHERE resource_id = $1", RESOURCE_ID)
+    assert res["status"] == "ANALYSING_CSV"
+
+
+async def test_set_status_flush_failed(setup_catalog, db, mocker):
+    mocker.patch("udata_hydra.config.STATUS_FLUSH_INTERVAL", 3600)
+    await Resource.flush_statuses()
+    await Resource.set_status(RESOURCE_ID, "TO_ANALYSE_RESOURCE", priority=True)
+    mocker.patch("udata_hydra.db.queries.execute", side_effect=ConnectionError)
+    with pytest.raises(ConnectionError):
+        await Resource.flush_statuses()
+    mocker.stopall()
+
+    # the transitions are buffered again, behind the ones buffered in the meantime
+    await Resource.set_status(RESOURCE_ID, "ANALYSING_RESOURCE")
+    await Resource.flush_statuses()
+    res = await db.fetchrow(
+        "SELECT status, priority FROM catalog WHERE resource_id = $1", RESOURCE_ID
+    )
+    assert res["status"] == "ANALYSING_RESOURCE"
+    assert res["priority"] is True
+
+
+async def test_set_status_invalid():
+    with pytest.raises(ValueError):
+        await Resource.set_status(RESOURCE_ID, "NOT_A_STATUS")
+
+
+async def test_resource_queries_counted(setup_catalog):
+    await Resource.get(RESOURCE_ID, column_name="url")
+    count, statements = queries.count, len(queries.statements)
+    for _ in range(3):
+        resource = await Resource.get(RESOURCE_ID, column_name="url")
+        assert resource["url"] == RESOURCE_URL
+    # the same query text is sent each time, so it's a single statement
+    assert queries.count == count + 3
+    assert len(queries.statements) == statements
+    with pytest.raises(ValueError):
+        await Resource.get(RESOURCE_ID, column_name="url; DROP TABLE catalog")
+    await Resource.delete(RESOURCE_ID)
+    resource = await Resource.get(RESOURCE_ID, column_name="deleted")
+    assert resource["deleted"] is True
+
+
+async def test_resource_queries_sampled(setup_catalog, mocker):
+    mocker.patch("udata_hydra.config.QUERIES_SAMPLE_RATE", 1)
+    sampled = queries.sampled
+    resource = await Resource.get(RESOURCE_ID, column_name="url")
+    assert resource["url"] == RESOURCE_URL
+    # the writes aren't sampled, they'd be run twice
+    await Resource.update(RESOURCE_ID, {"priority": True})
+    assert queries.sampled == sampled + 1
+    assert queries.planning_time > 0
+    assert 0 <= queries.stats()["buffers_hit_ratio"] <= 1
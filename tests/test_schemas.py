@@ -0,0 +1,88 @@
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from tests.conftest import DATASET_ID, RESOURCE_ID
+from udata_hydra.db.check import Check
+from udata_hydra.schemas import (
+    CheckGroupBy,
+    CheckSchema,
+    ResourceExceptionSchema,
+    ResourceSchema,
+    serializer,
+)
+
+pytestmark = pytest.mark.asyncio
+
+CHECK = {
+    "check_id": 1,
+    "catalog_id": 2,
+    "url": "https://example.com/resource-1",
+    "domain": "example.com",
+    "created_at": datetime(2024, 1, 1, 12, 30, tzinfo=timezone.utc),
+    "check_status": 200,
+    "headers": {"content-type": "text/csv"},
+    "timeout": False,
+    "response_time": 1,
+    "error": None,
+    "dataset_id": DATASET_ID,
+    "resource_id": uuid.UUID(RESOURCE_ID),
+    "next_check_at": None,
+    "deleted": False,
+    "parsing_table": b"table",
+    "parquet_size": "2048",
+    "not_in_schema": "ignored",
+}
+
+
+@pytest.mark.parametrize(
+    "schema,record",
+    [
+        (CheckSchema, CHECK),
+        # missing keys are left out, except for Function fields
+        (CheckSchema, {"check_id": 1, "headers": None, "timeout": 1}),
+        (CheckGroupBy, {"value": 200, "count": 3}),
+        (ResourceSchema, {"dataset_id": DATASET_ID, "resource_id": RESOURCE_ID, "status": None}),
+        (
+            ResourceSchema,
+            {
+                "dataset_id": DATASET_ID,
+                "resource_id": RESOURCE_ID,
+                "document": {"id": RESOURCE_ID, "created_at": CHECK["created_at"], "extras": {}},
+            },
+        ),
+        (
+            ResourceExceptionSchema,
+            {"id": 1, "resource_id": RESOURCE_ID, "table_indexes": {"siren": "index"}},
+        ),
+    ],
+)
+async def test_serializer_dumps_like_schema(schema, record):
+    assert serializer(schema)(record) == schema().dump(record)
+
+
+async def test_serializer_dumps_records_like_schema(setup_catalog, fake_check):
+    await fake_check(parsing_table=True, parquet_url=True)
+    record = await Check.get_latest(resource_id=RESOURCE_ID)
+    assert serializer(CheckSchema)(record) == CheckSchema().dump(dict(record))
+    assert serializer(CheckSchema) is serializer(CheckSchema)
+
+
+@pytest.mark.slow
+async def test_serializer_benchmark():
+    """Throughputs of the serializers, to be read with `pytest -s -m slow`: timings are too noisy
+    under coverage or on a shared CI runner to be asserted"""
+    records = [{**CHECK, "check_id": i} for i in range(20_000)]
+    throughputs = {}
+    for name, dump in (
+        ("marshmallow", lambda r: CheckSchema().dump(r)),
+        ("marshmallow (shared schema)", CheckSchema().dump),
+        ("serializer", serializer(CheckSchema)),
+    ):
+        start = time.perf_counter()
+        for record in records:
+            dump(record)
+        throughputs[name] = len(records) / (time.perf_counter() - start)
+    print(", ".join(f"{name}: {rows:.0f} rows/s" for name, rows in throughputs.items()))
@@ -1,8 +1,26 @@
+import asyncio
+import cProfile
 import hashlib
 import os
+import pstats
 import tempfile
 
-from udata_hydra.utils import compute_checksum_from_file
+import pytest
+from yarl import URL
+
+from tests.conftest import DATASET_ID, RESOURCE_ID
+from udata_hydra import config
+from udata_hydra.utils import (
+    compute_checksum_from_file,
+    metrics,
+    profiler,
+    queue,
+    send,
+    sender,
+)
+from udata_hydra.utils.artifacts import ArtifactCache
+from udata_hydra.utils.profiler import Profiler
+from udata_hydra.utils.timer import Timer
 
 
 def test_compute_checksum_from_file():
@@ -13,3 +31,199 @@ def test_compute_checksum_from_file():
     checksum = compute_checksum_from_file(tmp_file.name)
     assert checksum == hashlib.sha1(b"a very small file").hexdigest()
     os.remove(tmp_file.name)
+
+
+async def test_send_coalesces_documents_by_resource(rmock, udata_url):
+    rmock.put(udata_url, status=200, repeat=True)
+    await send(DATASET_ID, RESOURCE_ID, {"check:status": 200, "check:timeout": False})
+    await send(DATASET_ID, RESOURCE_ID, {"check:status": 404, "analysis:checksum": "abc"})
+    # nothing is sent until the sender is flushed
+    assert ("PUT", URL(udata_url)) not in rmock.requests
+    await sender.flush()
+    requests = rmock.requests[("PUT", URL(udata_url))]
+    assert len(requests) == 1
+    assert requests[0].kwargs["json"] == {
+        "check:status": 404,
+        "check:timeout": False,
+        "analysis:checksum": "abc",
+    }
+
+
+async def test_send_retries_then_drops(rmock, udata_url, mocker):
+    mocker.patch("udata_hydra.config.SEND_RETRY_BACKOFF", 0)
+    rmock.put(udata_url, status=502, repeat=True)
+    dropped = sender.counters["dropped"]
+    await send(DATASET_ID, RESOURCE_ID, {"check:status": 200})
+    await sender.flush()
+    assert len(rmock.requests[("PUT", URL(udata_url))]) == config.SEND_MAX_RETRIES + 1
+    assert sender.counters["dropped"] == dropped + 1
+
+
+async def test_send_flush_failed(rmock, udata_url, mocker):
+    rmock.put(udata_url, status=200, repeat=True)
+    mocker.patch("udata_hydra.utils.queue.enqueue", side_effect=ConnectionError)
+    await send(DATASET_ID, RESOURCE_ID, {"check:status": 200})
+    with pytest.raises(ConnectionError):
+        await sender.flush()
+    # the documents are kept for the next flush, along with the ones pushed meanwhile
+    await send(DATASET_ID, RESOURCE_ID, {"analysis:checksum": "abc"})
+    assert sender.pending[RESOURCE_ID] == (
+        DATASET_ID,
+        {"check:status": 200, "analysis:checksum": "abc"},
+    )
+    assert ("PUT", URL(udata_url)) not in rmock.requests
+
+
+@pytest.mark.parametrize(
+    "size,file_format,priority,expected",
+    [
+        (None, "csv", "low", "low"),
+        ("not a number", "csv", "low", "low"),
+        (1024, "csv", "low", "low"),
+        (50 * 1024 * 1024, "csv", "low", "heavy"),
+        # xlsx files are 8 times costlier than csv files to analyse
+        (5 * 1024 * 1024, "xlsx", "default", "heavy"),
+        (5 * 1024 * 1024, "csv", "default", "default"),
+    ],
+)
+def test_get_analysis_queue(mocker, size, file_format, priority, expected):
+    mocker.patch("udata_hydra.config.MAX_FILESIZE_ALLOWED", {"csv": 104857600, "xlsx": 13107200})
+    assert queue.get_analysis_queue(size, file_format, priority) == expected
+
+
+def test_artifacts_cache(mocker, tmp_path):
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_FOLDER", str(tmp_path))
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_MAX_SIZE", 20)
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_TTL", 3600)
+    cache = ArtifactCache()
+    assert cache.get(1) is None
+
+    for check_id in (1, 2):
+        tmp_file = tempfile.NamedTemporaryFile(delete=False)
+        tmp_file.write(b"0123456789")
+        tmp_file.close()
+        path = cache.put(check_id, tmp_file.name)
+        assert not os.path.exists(tmp_file.name)
+        assert path == str(tmp_path / str(check_id))
+    assert cache.get(1) == str(tmp_path / "1")
+
+    # exceeds the max size, 2 is the least recently used
+    tmp_file = tempfile.NamedTemporaryFile(delete=False)
+    tmp_file.write(b"0123456789")
+    tmp_file.close()
+    cache.put(3, tmp_file.name)
+    assert cache.get(2) is None
+    assert cache.get(1) and cache.get(3)
+
+    # expired
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_TTL", -1)
+    assert cache.get(1) is None
+    assert not os.path.exists(tmp_path / "1")
+
+    stats = cache.stats()
+    assert stats["files"] == 1
+    assert stats["evictions"] == 1
+    assert (stats["hits"], stats["misses"]) == (3, 3)
+
+
+def test_artifacts_cache_pins(mocker, tmp_path):
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_FOLDER", str(tmp_path))
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_MAX_SIZE", 10)
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_TTL", 3600)
+    cache = ArtifactCache()
+
+    def put(check_id: int) -> str:
+        tmp_file = tempfile.NamedTemporaryFile(delete=False)
+        tmp_file.write(b"0123456789")
+        tmp_file.close()
+        return cache.put(check_id, tmp_file.name)
+
+    # pinned before being cached, e.g. by an analysis downloading its file
+    pin = cache.pin(1)
+    put(1)
+    assert cache.pinned() == {"1"}
+    # the pinned file is kept over the max size, and doesn't expire while in use
+    put(2)
+    assert cache.get(1)
+    mocker.patch("udata_hydra.config.ARTIFACTS_CACHE_TTL", -1)
+    assert cache.get(1)
+    cache.evict()
+    assert os.path.exists(tmp_path / "1")
+    assert not os.path.exists(tmp_path / "2")
+
+    cache.unpin(pin)
+    assert cache.pinned() == set()
+    cache.evict()
+    assert not os.path.exists(tmp_path / "1")
+
+    # pins left by crashed processes are dropped
+    pin = cache.pin(3)
+    os.utime(pin, (0, 0))
+    assert cache.pinned() == set()
+    assert not os.path.exists(pin)
+
+
+def test_metrics(mocker):
+    mocker.patch("udata_hydra.config.METRICS_MAX_SERIES", 2)
+    counter = metrics.Counter("hydra_test_total", "Test counter", labels=("domain",))
+    histogram = metrics.Histogram("hydra_test_seconds", "Test histogram", buckets=(0.1, 1))
+    for domain in ("a.fr", "a.fr", "b.fr", "c.fr", "d.fr"):
+        counter.inc(domain=domain)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    lines = metrics.registry.render().splitlines()
+    assert 'hydra_test_total{domain="a.fr"} 2' in lines
+    assert 'hydra_test_total{domain="b.fr"} 1' in lines
+    # series beyond METRICS_MAX_SERIES are counted together
+    assert 'hydra_test_total{domain="other"} 2' in lines
+    assert 'hydra_test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'hydra_test_seconds_bucket{le="1.0"} 2' in lines
+    assert 'hydra_test_seconds_bucket{le="+Inf"} 3' in lines
+    assert "hydra_test_seconds_sum 5.55" in lines
+    assert "hydra_test_seconds_count 3" in lines
+    del metrics.registry.metrics["hydra_test_total"], metrics.registry.metrics["hydra_test_seconds"]
+
+
+def test_timer():
+    timer = Timer("test")
+    timer.mark("read", rows=10, bytes=2048)
+    sum(range(100_000))
+    timer.mark("compute")
+    timings: dict = timer.stop()
+    assert list(timings) == ["read", "compute", "total"]
+    assert timings["read"]["rows"] == 10 and timings["read"]["bytes"] == 2048
+    assert "rows" not in timings["compute"]
+    assert timings["compute"]["wall"] > 0 and timings["compute"]["cpu"] > 0
+    assert timings["total"]["wall"] >= timings["read"]["wall"] + timings["compute"]["wall"]
+    # each timer has its own stages
+    assert Timer("other").stop().keys() == {"total"}
+
+
+async def test_profiler(mocker, tmp_path):
+    mocker.patch("udata_hydra.config.PROFILES_FOLDER", str(tmp_path))
+    events = []
+
+    async def profiled(key: str) -> str:
+        job_profiler = Profiler()
+        assert await job_profiler.start()
+        events.append(f"start-{key}")
+        await asyncio.sleep(0.01)
+        events.append(f"stop-{key}")
+        return job_profiler.stop(key=key)
+
+    # concurrent profiled jobs take turns
+    paths = await asyncio.gather(profiled("a"), profiled("b"))
+    assert events == ["start-a", "stop-a", "start-b", "stop-b"]
+    assert paths == [str(tmp_path / "a.pstats"), str(tmp_path / "b.pstats")]
+    for path in paths:
+        assert pstats.Stats(path).stats
+
+    # the job isn't profiled if another profiler is active, without holding back the next ones
+    mocker.patch.object(
+        cProfile.Profile,
+        "enable",
+        side_effect=ValueError("Another profiling tool is already active"),
+    )
+    assert not await Profiler().start()
+    assert not profiler._lock.locked()
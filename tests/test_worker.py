@@ -0,0 +1,95 @@
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import pytest
+import redis
+from rq import Queue
+from rq.job import JobStatus
+
+from udata_hydra import config, context
+from udata_hydra.worker import perform_job, start_worker
+
+# side effects of the jobs below, which are run by their import path as RQ does
+results: list = []
+
+
+async def async_task(value) -> None:
+    results.append(value)
+
+
+async def failing_task() -> None:
+    raise ValueError("oops")
+
+
+def sync_task(value) -> None:
+    results.append((value, threading.get_ident()))
+
+
+@pytest.fixture
+def rq_queue():
+    """A real RQ queue of its own, on the Redis of REDIS_URL"""
+    connection = redis.from_url(config.REDIS_URL)
+    try:
+        connection.ping()
+    except redis.exceptions.ConnectionError:
+        pytest.skip(f"Redis is not reachable at {config.REDIS_URL}")
+    results.clear()
+    rq_queue = Queue(f"test-{uuid.uuid4()}", connection=connection)
+    yield rq_queue
+    rq_queue.delete(delete_jobs=True)
+
+
+async def test_perform_job_awaits_coroutine(rq_queue):
+    job = rq_queue.enqueue(async_task, 1, result_ttl=500)
+    await perform_job(job, rq_queue)
+    assert results == [1]
+    assert job.get_status() == JobStatus.FINISHED
+    assert job.id in rq_queue.finished_job_registry
+    assert job.id not in rq_queue.started_job_registry
+    assert job.id not in rq_queue.failed_job_registry
+
+
+async def test_perform_job_runs_function_in_thread(rq_queue):
+    job = rq_queue.enqueue(sync_task, 1)
+    await perform_job(job, rq_queue)
+    [(value, thread_id)] = results
+    assert value == 1 and thread_id != threading.get_ident()
+    assert job.get_status() == JobStatus.FINISHED
+    # without a result_ttl of its own, the job is kept for RQ's default one
+    assert job.id in rq_queue.finished_job_registry
+    assert rq_queue.finished_job_registry.get_expiration_time(job) > datetime.now(
+        timezone.utc
+    ).replace(tzinfo=None)
+
+
+async def test_perform_job_records_failure(rq_queue):
+    job = rq_queue.enqueue(failing_task)
+    await perform_job(job, rq_queue)
+    assert job.get_status() == JobStatus.FAILED
+    assert job.id in rq_queue.failed_job_registry
+    assert job.id not in rq_queue.finished_job_registry
+
+
+async def test_start_worker_burst(rq_queue):
+    jobs = [rq_queue.enqueue(async_task, value) for value in range(3)]
+    jobs.append(rq_queue.enqueue(failing_task))
+    try:
+        await start_worker(queues=[rq_queue.name], burst=True)
+    finally:
+        context.context.pop("role", None)
+    assert sorted(results) == [0, 1, 2]
+    assert [job.get_status() for job in jobs] == [JobStatus.FINISHED] * 3 + [JobStatus.FAILED]
+    assert rq_queue.count == 0
+    # the shared resources of the worker are released
+    assert context.http_session() is None and context.executor() is None
+
+
+async def test_run_cpu_bound():
+    assert await context.run_cpu_bound(sum, [1, 2, 3]) == 6
+    context.context["executor"] = ProcessPoolExecutor(max_workers=1)
+    try:
+        assert await context.run_cpu_bound(sum, [1, 2, 3], start=4) == 10
+    finally:
+        context.context.pop("executor").shutdown()
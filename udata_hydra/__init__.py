@@ -40,7 +40,10 @@ class Configurator:
 
     def check(self) -> None:
         """Sanity check on config"""
-        assert self.MAX_POOL_SIZE >= self.BATCH_SIZE, "BATCH_SIZE cannot exceed MAX_POOL_SIZE"
+        crawler_pool: dict = (self.POOL_PROFILES or {}).get("crawler", {})
+        assert crawler_pool.get("max_size", self.MAX_POOL_SIZE) >= self.BATCH_SIZE, (
+            "BATCH_SIZE cannot exceed the max_size of the crawler pool"
+        )
 
     def __getattr__(self, __name):
         return self.configuration.get(__name)
@@ -1,3 +1,5 @@
+import asyncio
+import contextlib
 import csv as stdcsv
 import hashlib
 import json
@@ -5,7 +7,9 @@ import logging
 import os
 import sys
 from datetime import datetime, timezone
-from typing import Any, Iterator
+from itertools import islice
+from pathlib import Path
+from typing import Any, AsyncIterator, Generator
 
 from asyncpg import Record
 from csv_detective.detection import engine_to_file
@@ -41,13 +45,16 @@ from udata_hydra.utils import (
     ParseException,
     Reader,
     Timer,
+    artifacts,
     download_resource,
     handle_parse_exception,
-    queue,
+    metrics,
     send,
+    sender,
 )
 from udata_hydra.utils.minio import MinIOClient
 from udata_hydra.utils.parquet import save_as_parquet
+from udata_hydra.utils.profiler import Profiler
 
 log = logging.getLogger("udata-hydra")
 
@@ -82,6 +89,8 @@ PYTHON_TYPE_TO_PY = {
 }
 
 RESERVED_COLS = ("__id", "cmin", "cmax", "collation", "ctid", "tableoid", "xmin", "xmax")
+# rows read and cast at once in a thread when copying a file to the db, see generate_records_by_chunks
+RECORDS_CHUNK_SIZE = 1000
 minio_client = MinIOClient()
 
 
@@ -103,18 +112,21 @@ async def notify_udata(resource: Record, check: dict) -> None:
     if config.CSV_TO_PARQUET:
         payload["document"]["analysis:parsing:parquet_url"] = check.get("parquet_url")
         payload["document"]["analysis:parsing:parquet_size"] = check.get("parquet_size")
-    queue.enqueue(send, _priority="high", **payload)
+    await send(**payload)
 
 
 async def analyse_csv(
     check: dict,
     file_path: str | None = None,
     debug_insert: bool = False,
+    profile: bool = False,
 ) -> None:
-    """Launch csv analysis from a check or an URL (debug), using previously downloaded file at file_path if any"""
+    """Launch csv analysis from a check or an URL (debug), using previously downloaded file at file_path if any.
+    The analysis is profiled if profile is set or if its resource exception says so, see utils.profiler"""
     if not config.CSV_ANALYSIS:
         log.debug("CSV_ANALYSIS turned off, skipping.")
         return
+    check = helpers.decode_check_headers(check)
 
     resource_id: str = str(check["resource_id"])
     url = check["url"]
@@ -127,13 +139,25 @@ async def analyse_csv(
     exception: Record | None = await ResourceException.get_by_resource_id(resource_id)
     table_indexes: dict | None = None
     if exception and exception.get("table_indexes"):
-        table_indexes = json.loads(exception["table_indexes"])
+        table_indexes = exception["table_indexes"]
 
     timer = Timer("analyse-csv")
     assert any(_ is not None for _ in (check["id"], url))
-
+    profiler: Profiler | None = None
+    if profile or (exception and exception.get("profile")):
+        profiler = Profiler()
+        if not await profiler.start():
+            profiler = None
+
+    # the file is re-opened by path by the steps below, keep it from being evicted meanwhile
+    pin: Path | None = artifacts.pin(check["id"])
     try:
-        headers = json.loads(check.get("headers") or "{}")
+        headers = check.get("headers") or {}
+        # the file downloaded by analyse_resource may have been on another host or evicted meanwhile,
+        # getting it from the cache also marks it as recently used
+        file_path = artifacts.get(check["id"]) or file_path
+        if file_path and not os.path.exists(file_path):
+            file_path = None
         tmp_file = (
             open(file_path, "rb")
             if file_path
@@ -143,14 +167,23 @@ async def analyse_csv(
                 max_size_allowed=None if exception else int(config.MAX_FILESIZE_ALLOWED["csv"]),
             )
         )
+        if not file_path:
+            # keep the file for a next analysis of this check
+            tmp_file = open(artifacts.put(check["id"], tmp_file.name), "rb")
         table_name = hashlib.md5(url.encode("utf-8")).hexdigest()
-        timer.mark("download-file")
+        timer.mark("download-file", bytes=os.path.getsize(tmp_file.name))
 
-        check = await Check.update(check["id"], {"parsing_started_at": datetime.now(timezone.utc)})
+        check = await Check.update(
+            check["id"],
+            {"parsing_started_at": datetime.now(timezone.utc)},
+            created_at=check.get("created_at"),
+        )
 
         # Launch csv-detective against given file
         try:
-            csv_inspection: dict | None = csv_detective_routine(
+            # CPU-bound, run in a separate process by the async worker
+            csv_inspection: dict | None = await context.run_cpu_bound(
+                csv_detective_routine,
                 csv_file_path=tmp_file.name,
                 output_profile=True,
                 num_rows=-1,
@@ -160,9 +193,9 @@ async def analyse_csv(
             raise ParseException(
                 step="csv_detective", resource_id=resource_id, url=url, check_id=check["id"]
             ) from e
-        timer.mark("csv-inspection")
+        timer.mark("csv-inspection", rows=(csv_inspection or {}).get("total_lines"))
 
-        await csv_to_db(
+        rows: int | None = await csv_to_db(
             file_path=tmp_file.name,
             inspection=csv_inspection,
             table_name=table_name,
@@ -170,7 +203,7 @@ async def analyse_csv(
             resource_id=resource_id,
             debug_insert=debug_insert,
         )
-        timer.mark("csv-to-db")
+        timer.mark("csv-to-db", rows=rows)
 
         try:
             parquet_args: tuple[str, int] | None = await csv_to_parquet(
@@ -179,7 +212,7 @@ async def analyse_csv(
                 table_name=table_name,
                 resource_id=resource_id,
             )
-            timer.mark("csv-to-parquet")
+            timer.mark("csv-to-parquet", bytes=parquet_args[1] if parquet_args else None)
         except Exception as e:
             raise ParseException(
                 step="parquet_export", resource_id=resource_id, url=url, check_id=check["id"]
@@ -193,19 +226,48 @@ async def analyse_csv(
                 "parquet_url": parquet_args[0] if parquet_args else None,
                 "parquet_size": parquet_args[1] if parquet_args else None,
             },
+            created_at=check.get("created_at"),
         )
         await csv_to_db_index(table_name, csv_inspection, check)
+        timer.mark("csv-index")
 
     except (ParseException, IOException) as e:
         await handle_parse_exception(e, table_name, check)
     finally:
+        # the file isn't opened by path anymore
+        artifacts.unpin(pin)
+        if profiler:
+            await Check.update(
+                check["id"],
+                {"analysis_profile": await store_profile(profiler.stop(key=check["id"]))},
+                created_at=check.get("created_at"),
+            )
         await notify_udata(resource, check)
-        timer.stop()
+        await Check.add_timings(
+            check["id"], timer.name, timer.stop(), created_at=check.get("created_at")
+        )
         tmp_file.close()
-        os.remove(tmp_file.name)
+        # cached files are removed by the eviction of the artifacts cache
+        if not artifacts.enabled:
+            os.remove(tmp_file.name)
 
         # Reset resource status to None
-        await Resource.update(resource_id, {"status": None})
+        await Resource.set_status(resource_id, None, flush=True)
+        await sender.flush()
+
+
+async def store_profile(path: str) -> str:
+    """Upload the profile of an analysis to MinIO if PROFILES_TO_MINIO, returning its URL,
+    or its local path if it's not uploaded"""
+    if not config.PROFILES_TO_MINIO:
+        return path
+    try:
+        return await asyncio.to_thread(
+            minio_client.send_file, path, object_name=f"profiles/{os.path.basename(path)}"
+        )
+    except Exception as e:
+        log.warning(f"Could not upload the profile {path}: {e}")
+        return path
 
 
 def smart_cast(_type: str, value, failsafe: bool = False) -> Any:
@@ -274,7 +336,9 @@ def compute_create_table_query(
     return query
 
 
-def generate_records(file_path: str, inspection: dict, columns: dict) -> Iterator[list]:
+def generate_records(
+    file_path: str, inspection: dict, columns: dict
+) -> Generator[list, None, None]:
     # because we need the iterator twice, not possible to
     # handle parquet and db through the same iteration
     with Reader(file_path, inspection) as reader:
@@ -283,6 +347,42 @@ def generate_records(file_path: str, inspection: dict, columns: dict) -> Iterato
                 yield [smart_cast(t, v, failsafe=True) for t, v in zip(columns.values(), line)]
 
 
+async def generate_records_by_chunks(
+    file_path: str, inspection: dict, columns: dict, chunk_size: int = RECORDS_CHUNK_SIZE
+) -> AsyncIterator[list]:
+    """generate_records whose rows are read and cast by chunks in a thread,
+    so that the event loop (and the other jobs of the async worker) isn't blocked meanwhile.
+    Profiled jobs read them in the calling thread, to be profiled."""
+    records = generate_records(file_path, inspection, columns)
+
+    def read_chunk() -> list[list]:
+        return list(islice(records, chunk_size))
+
+    try:
+        while chunk := (
+            read_chunk() if context.profiling.get() else await asyncio.to_thread(read_chunk)
+        ):
+            for record in chunk:
+                yield record
+    finally:
+        # the generator is still running in its thread if the copy was cancelled meanwhile
+        with contextlib.suppress(ValueError):
+            records.close()
+
+
+def save_csv_as_parquet(
+    file_path: str, inspection: dict, columns: dict, output_filename: str
+) -> str:
+    """Cast the rows of a csv file and save them as parquet, returning the path of the parquet file.
+    CPU-bound, run in a separate process by the async worker"""
+    parquet_file, _ = save_as_parquet(
+        records=generate_records(file_path, inspection, columns),
+        columns=columns,
+        output_filename=output_filename,
+    )
+    return parquet_file
+
+
 async def csv_to_parquet(
     file_path: str,
     inspection: dict,
@@ -303,13 +403,13 @@ async def csv_to_parquet(
     """
     if not config.CSV_TO_PARQUET:
         log.debug("CSV_TO_PARQUET turned off, skipping parquet export.")
-        return
+        return None
 
     if int(inspection.get("total_lines", 0)) < config.MIN_LINES_FOR_PARQUET:
         log.debug(
             f"Skipping parquet export for {table_name} because it has less than {config.MIN_LINES_FOR_PARQUET} lines."
         )
-        return
+        return None
 
     log.debug(
         f"Converting from {engine_to_file.get(inspection.get('engine', ''), 'CSV')} "
@@ -318,17 +418,15 @@ async def csv_to_parquet(
 
     if resource_id:
         # Update resource status to CONVERTING_TO_PARQUET
-        await Resource.update(resource_id, {"status": "CONVERTING_TO_PARQUET"})
+        await Resource.set_status(resource_id, "CONVERTING_TO_PARQUET")
 
     columns = {c: v["python_type"] for c, v in inspection["columns"].items()}
     # save the file as parquet and store it on Minio instance
-    parquet_file, _ = save_as_parquet(
-        records=generate_records(file_path, inspection, columns),
-        columns=columns,
-        output_filename=table_name,
+    parquet_file: str = await context.run_cpu_bound(
+        save_csv_as_parquet, file_path, inspection, columns, output_filename=table_name
     )
     parquet_size: int = os.path.getsize(parquet_file)
-    parquet_url: str = minio_client.send_file(parquet_file)
+    parquet_url: str = await asyncio.to_thread(minio_client.send_file, parquet_file)
     return parquet_url, parquet_size
 
 
@@ -339,7 +437,7 @@ async def csv_to_db(
     table_indexes: dict[str, str] | None = None,
     resource_id: str | None = None,
     debug_insert: bool = False,
-) -> None:
+) -> int | None:
     """
     Convert a csv file to database table using inspection data. It should (re)create one table:
     - `table_name` with data from `file_path`
@@ -348,10 +446,11 @@ async def csv_to_db(
     :inspection: CSV detective report
     :table_name: used to create tables
     :debug_insert: insert record one by one instead of using postgresql COPY
+    :returns: the number of rows inserted
     """
     if not config.CSV_TO_DB:
         log.debug("CSV_TO_DB turned off, skipping.")
-        return
+        return None
 
     log.debug(
         f"Converting from {engine_to_file.get(inspection.get('engine', ''), 'CSV')} "
@@ -360,7 +459,7 @@ async def csv_to_db(
 
     if resource_id:
         # Update resource status to INSERTING_IN_DB
-        await Resource.update(resource_id, {"status": "INSERTING_IN_DB"})
+        await Resource.set_status(resource_id, "INSERTING_IN_DB")
 
     # build a `column_name: type` mapping and explicitely rename reserved column names
     columns = {
@@ -385,11 +484,13 @@ async def csv_to_db(
     if not debug_insert:
         # NB: also see copy_to_table for a file source
         try:
-            await db.copy_records_to_table(
+            status: str = await db.copy_records_to_table(
                 table_name,
-                records=generate_records(file_path, inspection, columns),
+                records=generate_records_by_chunks(file_path, inspection, columns),
                 columns=columns.keys(),
             )
+            # "COPY <number of rows>"
+            rows = int(status.split()[-1])
         except Exception as e:  # I know what I'm doing, pinky swear
             raise ParseException(
                 step="copy_records_to_table", resource_id=resource_id, table_name=table_name
@@ -402,6 +503,9 @@ async def csv_to_db(
             # NB: possible sql injection here, but should not be used in prod
             q = compute_insert_query(table_name=table_name, data=data, returning="__id")
             await db.execute(q, *data.values())
+        rows = bar.done
+    metrics.ROWS_INGESTED.inc(rows)
+    return rows
 
 
 async def csv_to_db_index(table_name: str, inspection: dict, check: Record) -> None:
@@ -1,3 +1,4 @@
+import json
 from datetime import date, datetime
 
 from dateparser import parse as date_parser
@@ -10,6 +11,16 @@ def to_json(value: str) -> str:
     return value
 
 
+def decode_check_headers(check: dict) -> dict:
+    """
+    Jobs enqueued before the checks headers were decoded by the pool carry them as a JSON string,
+    decode them so that those jobs can still run. To be removed in the next release.
+    """
+    if isinstance(check.get("headers"), str):
+        return {**check, "headers": json.loads(check["headers"])}
+    return check
+
+
 def _parse_dt(value: str) -> datetime | None:
     """For performance reasons, we try first with dateutil and fallback on dateparser"""
     try:
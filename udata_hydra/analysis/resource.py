@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 from datetime import datetime, timezone
@@ -8,19 +7,23 @@ import magic
 from asyncpg import Record
 from dateparser import parse as date_parser
 
-from udata_hydra import config, context
+from udata_hydra import config
+from udata_hydra.analysis import helpers
 from udata_hydra.analysis.csv import analyse_csv
 from udata_hydra.crawl.calculate_next_check import calculate_next_check_date
 from udata_hydra.db.check import Check
 from udata_hydra.db.resource import Resource
 from udata_hydra.db.resource_exception import ResourceException
 from udata_hydra.utils import (
+    artifacts,
     compute_checksum_from_file,
-    detect_tabular_from_headers,
+    detect_tabular,
     download_resource,
     queue,
     send,
+    sender,
 )
+from udata_hydra.utils.timer import Timer
 
 
 class Change(Enum):
@@ -36,7 +39,7 @@ async def analyse_resource(
     check: dict, last_check: dict | None, force_analysis: bool = False
 ) -> None:
     """
-    Perform analysis on the resource designated by check_id:
+    Perform analysis on the resource of check, last_check being the previous check of the resource if any:
     - change analysis
     - size (optional)
     - mime_type (optional)
@@ -46,91 +49,108 @@ async def analyse_resource(
     Will call udata if first check or changes found, and update check with optional infos
     """
 
+    check = helpers.decode_check_headers(check)
+    last_check = helpers.decode_check_headers(last_check) if last_check else None
+
     # Check if the resource is in the exceptions table
     exception: Record | None = await ResourceException.get_by_resource_id(str(check["resource_id"]))
 
     resource_id = check["resource_id"]
     dataset_id = check["dataset_id"]
     url = check["url"]
-    headers = json.loads(check["headers"] or "{}")
+    headers = check["headers"] or {}
 
     log.debug(f"Analysis for resource {resource_id} in dataset {dataset_id}")
 
-    # Update resource status to ANALYSING_RESOURCE
-    resource: Record | None = await Resource.update(
-        resource_id, data={"status": "ANALYSING_RESOURCE"}
-    )
-
-    # let's see if we can infer a modification date on early hints based on harvest infos and headers
-    change_status, change_payload = await detect_resource_change_on_early_hints(resource)
-
-    # could it be a CSV? If we get hints, we will analyse the file further depending on change status
-    is_tabular, file_format = await detect_tabular_from_headers(check)
-    max_size_allowed = None if exception else int(config.MAX_FILESIZE_ALLOWED[file_format])
-
-    # if the change status is NO_GUESS or HAS_CHANGED, let's download the file to get more infos
-    dl_analysis = {}
-    tmp_file = None
-    if change_status != Change.HAS_NOT_CHANGED or force_analysis:
-        try:
-            tmp_file = await download_resource(url, headers, max_size_allowed)
-        except IOError:
-            dl_analysis["analysis:error"] = "File too large to download"
-        else:
-            # Get file size
-            dl_analysis["analysis:content-length"] = os.path.getsize(tmp_file.name)
-            # Get checksum
-            dl_analysis["analysis:checksum"] = compute_checksum_from_file(tmp_file.name)
-            # Check if checksum has been modified if we don't have other hints
-            if change_status == Change.NO_GUESS:
-                (
-                    change_status,
-                    change_payload,
-                ) = await detect_resource_change_from_checksum(
-                    new_checksum=dl_analysis["analysis:checksum"], last_check=last_check
+    try:
+        # Update resource status to ANALYSING_RESOURCE
+        resource: Record | None = await Resource.update(
+            resource_id, data={"status": "ANALYSING_RESOURCE"}
+        )
+
+        # let's see if we can infer a modification date on early hints based on harvest infos and headers
+        change_status, change_payload = await detect_resource_change_on_early_hints(
+            resource, check, last_check
+        )
+
+        # if the change status is NO_GUESS or HAS_CHANGED, let's download the file to get more infos
+        dl_analysis: dict = {}
+        tmp_file = None
+        is_tabular, file_format = False, "csv"
+        if change_status != Change.HAS_NOT_CHANGED or force_analysis:
+            # could it be a CSV? If we get hints, we will analyse the downloaded file further
+            is_tabular, file_format = await detect_tabular(check)
+            max_size_allowed = None if exception else int(config.MAX_FILESIZE_ALLOWED[file_format])
+            timer = Timer("analyse-resource")
+            try:
+                tmp_file = await download_resource(url, headers, max_size_allowed)
+            except IOError:
+                dl_analysis["analysis:error"] = "File too large to download"
+            else:
+                # Get file size
+                dl_analysis["analysis:content-length"] = os.path.getsize(tmp_file.name)
+                timer.mark("download-file", bytes=dl_analysis["analysis:content-length"])
+                # Get checksum
+                dl_analysis["analysis:checksum"] = compute_checksum_from_file(tmp_file.name)
+                # Check if checksum has been modified if we don't have other hints
+                if change_status == Change.NO_GUESS:
+                    (
+                        change_status,
+                        change_payload,
+                    ) = await detect_resource_change_from_checksum(
+                        new_checksum=dl_analysis["analysis:checksum"], last_check=last_check
+                    )
+                dl_analysis["analysis:mime-type"] = magic.from_file(tmp_file.name, mime=True)
+                timer.mark("file-analysis")
+            finally:
+                if tmp_file and not is_tabular:
+                    os.remove(tmp_file.name)
+                await Check.update(
+                    check["id"],
+                    {
+                        "checksum": dl_analysis.get("analysis:checksum"),
+                        "analysis_error": dl_analysis.get("analysis:error"),
+                        "filesize": dl_analysis.get("analysis:content-length"),
+                        "mime_type": dl_analysis.get("analysis:mime-type"),
+                        "analysis_timings": {timer.name: timer.stop()},
+                    },
+                    created_at=check.get("created_at"),
                 )
-            dl_analysis["analysis:mime-type"] = magic.from_file(tmp_file.name, mime=True)
-        finally:
-            if tmp_file and not is_tabular:
-                os.remove(tmp_file.name)
-            await Check.update(
-                check["id"],
-                {
-                    "checksum": dl_analysis.get("analysis:checksum"),
-                    "analysis_error": dl_analysis.get("analysis:error"),
-                    "filesize": dl_analysis.get("analysis:content-length"),
-                    "mime_type": dl_analysis.get("analysis:mime-type"),
-                },
+
+        if change_status == Change.HAS_CHANGED:
+            await update_check_with_modification_and_next_dates(
+                change_payload or {}, check["id"], last_check
             )
 
-    if change_status == Change.HAS_CHANGED:
-        await update_check_with_modification_and_next_dates(
-            change_payload or {}, check["id"], last_check
-        )
+        analysis_results = {**dl_analysis, **(change_payload or {})}
+
+        if change_status == Change.HAS_CHANGED or not last_check or force_analysis:
+            if is_tabular and tmp_file:
+                # Change status to TO_ANALYSE_CSV, flushing it before the handover
+                await Resource.set_status(resource_id, "TO_ANALYSE_CSV", flush=True)
+                # Analyse CSV and create a table in the CSV database
+                queue.enqueue(
+                    analyse_csv,
+                    check=check,
+                    # the file is also cached for analyse_csv jobs running on other hosts sharing the cache
+                    file_path=artifacts.put(check["id"], tmp_file.name),
+                    _priority=queue.get_analysis_queue(
+                        dl_analysis.get("analysis:content-length"), file_format
+                    ),
+                )
 
-    analysis_results = {**dl_analysis, **(change_payload or {})}
+            else:
+                await Resource.set_status(resource_id, None)
 
-    if change_status == Change.HAS_CHANGED or not last_check or force_analysis:
-        if is_tabular and tmp_file:
-            # Change status to TO_ANALYSE_CSV
-            await Resource.update(resource_id, data={"status": "TO_ANALYSE_CSV"})
-            # Analyse CSV and create a table in the CSV database
-            queue.enqueue(analyse_csv, check=check, file_path=tmp_file.name, _priority="default")
+            # Send analysis result to udata
+            await send(dataset_id=dataset_id, resource_id=resource_id, document=analysis_results)
 
         else:
-            await Resource.update(resource_id, data={"status": None})
-
-        # Send analysis result to udata
-        queue.enqueue(
-            send,
-            dataset_id=dataset_id,
-            resource_id=resource_id,
-            document=analysis_results,
-            _priority="high",
-        )
-
-    else:
-        await Resource.update(resource_id, data={"status": None})
+            await Resource.set_status(resource_id, None)
+    finally:
+        # write the status transitions left by the analysis, even if it failed
+        await Resource.flush_statuses()
+        await sender.flush()
 
 
 async def update_check_with_modification_and_next_dates(
@@ -175,7 +195,7 @@ async def detect_resource_change_from_checksum(
 
 
 async def detect_resource_change_from_last_modified_header(
-    data: dict,
+    data: list[dict],
 ) -> tuple[Change, dict | None]:
     # last modified header check
 
@@ -199,7 +219,7 @@ async def detect_resource_change_from_last_modified_header(
 
 
 async def detect_resource_change_from_content_length_header(
-    data: dict,
+    data: list[dict],
 ) -> tuple[Change, dict | None]:
     # content-length variation between current and last check
     if len(data) <= 1 or not data[0]["content_length"]:
@@ -213,13 +233,33 @@ async def detect_resource_change_from_content_length_header(
     return Change.HAS_NOT_CHANGED, None
 
 
+def get_change_state(check: dict | None) -> dict | None:
+    """
+    Compact state of a check used for change detection: the headers to compare between checks
+    and the results of the check analysis, if any
+    """
+    if not check:
+        return None
+    headers: dict = check.get("headers") or {}
+    return {
+        "created_at": check.get("created_at"),
+        "last_modified": headers.get("last-modified"),
+        "content_length": headers.get("content-length"),
+        "checksum": check.get("checksum"),
+        "detected_last_modified_at": check.get("detected_last_modified_at"),
+    }
+
+
 async def detect_resource_change_on_early_hints(
-    resource: Record | None,
+    resource: Record | None, check: dict, last_check: dict | None
 ) -> tuple[Change, dict | None]:
     """
     Try to guess if a resource has been modified from harvest and headers in check data:
     - last-modified header value if it can be found and parsed
-    - content-length if it is found and changed over time (vs last checks)
+    - content-length if it is found and changed over time (vs last check)
+
+    The current and last checks are the ones of the analysis job payload, there is no need to
+    query the checks of the resource.
 
     Returns a tuple with a Change status and an optional payload:
     {
@@ -227,29 +267,12 @@ async def detect_resource_change_on_early_hints(
         "analysis:last-modified-detection": "detection-method",
     }
     """
-    data = None
-
-    if resource:
-        # Fetch current and last check headers
-        q = """
-        SELECT
-            created_at,
-            headers->>'last-modified' as last_modified,
-            headers->>'content-length' as content_length,
-            detected_last_modified_at
-        FROM checks
-        WHERE resource_id = $1
-        ORDER BY created_at DESC
-        LIMIT 2
-        """
-        pool = await context.pool()
-        async with pool.acquire() as connection:
-            data = await connection.fetch(q, str(resource["resource_id"]))
-
-    # not enough checks to make a comparison
-    if not data:
+    if not resource:
         return Change.NO_GUESS, None
 
+    # current and last check states, most recent first
+    data = [state for state in (get_change_state(check), get_change_state(last_check)) if state]
+
     # let's see if we can infer a modification date from harvest infos
     change_status, change_payload = await detect_resource_change_from_harvest(data, resource)
     if change_status != Change.NO_GUESS:
@@ -268,7 +291,7 @@ async def detect_resource_change_on_early_hints(
 
 
 async def detect_resource_change_from_harvest(
-    checks_data: tuple, resource: Record | None
+    checks_data: list[dict], resource: Record | None
 ) -> tuple[Change, dict | None]:
     """
     Checks if resource has a harvest.modified_at
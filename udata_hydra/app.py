@@ -1,21 +1,46 @@
+import asyncio
+import contextlib
 import os
 
 from aiohttp import web
 
-from udata_hydra import context
+from udata_hydra import config, context
 from udata_hydra.routes import routes
-from udata_hydra.utils import token_auth_middleware
+from udata_hydra.utils import metrics, token_auth_middleware
+from udata_hydra.utils.cache import ResponseCache, response_cache_middleware
 
 
 async def app_factory() -> web.Application:
     async def app_startup(app):
         app["pool"] = await context.pool()
+        if config.API_CACHE_TTL:
+            app["cache"] = ResponseCache()
+            app["cache_listener"] = asyncio.create_task(app["cache"].listen())
+            metrics.API_CACHE.set_function(
+                lambda: {
+                    (k,): v for k, v in app["cache"].stats().items() if isinstance(v, (int, float))
+                }
+            )
 
     async def app_cleanup(app):
+        if "cache_listener" in app:
+            app["cache_listener"].cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await app["cache_listener"]
         if "pool" in app:
             await app["pool"].close()
 
-    app = web.Application(middlewares=[token_auth_middleware(exclude_methods=("GET",))])
+    context.set_role("api")
+    app = web.Application(
+        middlewares=[
+            token_auth_middleware(
+                # bulk lookup of latest checks, read-only like GET routes
+                exclude_routes=(r"/api/checks/latest/?",),
+                exclude_methods=("GET",),
+            ),
+            response_cache_middleware(),
+        ]
+    )
     app.add_routes(routes)
     app.on_startup.append(app_startup)
     app.on_cleanup.append(app_cleanup)
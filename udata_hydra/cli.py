@@ -1,9 +1,11 @@
 import csv
 import logging
 import os
-from datetime import datetime, timezone
+import time
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from tempfile import NamedTemporaryFile
+from typing import Iterator
 
 import aiohttp
 import asyncpg
@@ -14,11 +16,17 @@ from progressist import ProgressBar
 
 from udata_hydra import config
 from udata_hydra.analysis.csv import analyse_csv
+from udata_hydra.context import init_connection, set_role
 from udata_hydra.crawl.check_resources import check_resource as crawl_check_resource
+from udata_hydra.crawl.check_resources import flush_pending_writes
+from udata_hydra.db.catalog_sync import CatalogSync
 from udata_hydra.db.check import Check
+from udata_hydra.db.check_job import CheckJob
 from udata_hydra.db.resource import Resource
+from udata_hydra.db.stats import Stats
 from udata_hydra.logger import setup_logging
 from udata_hydra.migrations import Migrator
+from udata_hydra.utils import artifacts
 
 context = {}
 log = setup_logging()
@@ -44,6 +52,8 @@ async def connection(db_name: str = "main"):
         context["conn"][db_name] = await asyncpg.connect(
             dsn=dsn, server_settings={"search_path": config.DATABASE_SCHEMA}
         )
+        if db_name == "main":
+            await init_connection(context["conn"][db_name])
     return context["conn"][db_name]
 
 
@@ -69,52 +79,51 @@ async def load_catalog(
         await drop_dbs(dbs=dbs)
         await migrate()
 
-    def iter_with_progressbar_or_quiet(rows, quiet):
-        if quiet:
-            for row in rows:
-                yield row
-        else:
-            bar = ProgressBar(total=len(rows))
-            for row in bar.iter(rows):
-                yield row
+    def iter_catalog_records(file) -> Iterator[tuple]:
+        """Stream the resources of the catalog file that don't belong to an archived dataset"""
+        start = time.perf_counter()
+        for nb, row in enumerate(csv.DictReader(file, delimiter=";"), start=1):
+            if not quiet and nb % 100_000 == 0:
+                log.info(f"{nb} rows read ({nb / (time.perf_counter() - start):.0f} rows/s)")
+            # Skip resources belonging to an archived dataset
+            if row.get("dataset.archived") != "False":
+                continue
+            yield (
+                nb,
+                row["dataset.id"],
+                row["id"],
+                row["url"],
+                # force timezone info to UTC (catalog data should be in UTC)
+                datetime.fromisoformat(row["harvest.modified_at"]).replace(tzinfo=timezone.utc)
+                if row["harvest.modified_at"]
+                else None,
+            )
 
     try:
         log.info(f"Downloading resources catalog from {url}...")
         with NamedTemporaryFile(dir=config.TEMPORARY_DOWNLOAD_FOLDER or None, delete=False) as fd:
             await download_file(url, fd)
         log.info("Upserting resources catalog in database...")
-        # consider everything deleted, deleted will be updated when loading new catalog
+        start = time.perf_counter()
         conn = await connection()
-        await conn.execute("UPDATE catalog SET deleted = TRUE")
-        with open(fd.name) as fd:
-            reader = csv.DictReader(fd, delimiter=";")
-            rows = list(reader)
-            for row in iter_with_progressbar_or_quiet(rows, quiet):
-                # Skip resources belonging to an archived dataset
-                if row.get("dataset.archived") != "False":
-                    continue
-
-                await conn.execute(
-                    """
-                    INSERT INTO catalog (
-                        dataset_id, resource_id, url, harvest_modified_at,
-                        deleted, priority, status
-                    )
-                    VALUES ($1, $2, $3, $4, FALSE, FALSE, NULL)
-                    ON CONFLICT (resource_id) DO UPDATE SET
-                        dataset_id = $1,
-                        url = $3,
-                        deleted = FALSE;
-                """,
-                    row["dataset.id"],
-                    row["id"],
-                    row["url"],
-                    # force timezone info to UTC (catalog data should be in UTC)
-                    datetime.fromisoformat(row["harvest.modified_at"]).replace(tzinfo=timezone.utc)
-                    if row["harvest.modified_at"]
-                    else None,
+        async with conn.transaction():
+            await Resource.create_staging(conn)
+            with open(fd.name) as fd:
+                nb_rows = int(
+                    (
+                        await conn.copy_records_to_table(
+                            "catalog_staging", records=iter_catalog_records(fd)
+                        )
+                    ).split()[-1]
                 )
-        log.info("Resources catalog successfully upserted into DB.")
+            # the resources missing from the catalog are considered deleted
+            res: Record = await Resource.merge_staging(conn)
+        duration = time.perf_counter() - start
+        log.info(
+            f"Resources catalog successfully upserted into DB: {nb_rows} resources loaded "
+            f"in {duration:.1f}s ({nb_rows / duration:.0f} rows/s), {res['inserted']} inserted, "
+            f"{res['updated']} updated, {res['deleted']} marked as deleted."
+        )
     except Exception as e:
         raise e
     finally:
@@ -122,6 +131,96 @@ async def load_catalog(
         os.unlink(fd.name)
 
 
+def parse_utc_datetime(value: str) -> datetime:
+    """Parse an ISO datetime, considered in UTC if naive (catalog data should be in UTC)"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+@cli
+async def sync_catalog(since: str | None = None, quiet: bool = False):
+    """Sync the catalog with the datasets updated since the last sync, instead of loading it all
+
+    Datasets are fetched from the datasets API, most recently updated first, until the watermark
+    of the last sync is reached. Their resources are upserted in the catalog, page by page, and
+    their resources that are gone (or that belong to an archived dataset) are marked as deleted.
+    NB: deleted datasets are not listed by the API, `load_catalog` catches them.
+
+    :since: ISO datetime to sync from, instead of the watermark of the last sync
+    :quiet: ingore logs except for errors
+    """
+    if quiet:
+        log.setLevel(logging.ERROR)
+
+    source: str = config.CATALOG_SYNC_URL
+    watermark: datetime | None = (
+        parse_utc_datetime(since) if since else await CatalogSync.get_watermark(source)
+    )
+    if not watermark:
+        log.error("No previous sync of the catalog, please provide a starting date with --since")
+        return
+
+    def iter_datasets_records(datasets: list[dict]) -> Iterator[tuple]:
+        line = 0
+        for dataset in datasets:
+            if dataset.get("archived") or dataset.get("deleted"):
+                continue
+            for resource in dataset["resources"]:
+                line += 1
+                yield (
+                    line,
+                    dataset["id"],
+                    resource["id"],
+                    resource["url"],
+                    parse_utc_datetime(resource["harvest"]["modified_at"])
+                    if (resource.get("harvest") or {}).get("modified_at")
+                    else None,
+                )
+
+    log.info(f"Syncing resources catalog with datasets updated since {watermark.isoformat()}...")
+    start = time.perf_counter()
+    new_watermark: datetime = watermark
+    nb_datasets = nb_rows = 0
+    conn = await connection()
+    url: str | None = f"{source}?sort=-last_update&page_size={config.CATALOG_SYNC_PAGE_SIZE}"
+    async with aiohttp.ClientSession() as session:
+        while url:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                page: dict = await resp.json()
+            datasets = [d for d in page["data"] if parse_utc_datetime(d["last_update"]) > watermark]
+            if datasets:
+                async with conn.transaction():
+                    await Resource.create_staging(conn)
+                    nb_rows += int(
+                        (
+                            await conn.copy_records_to_table(
+                                "catalog_staging", records=iter_datasets_records(datasets)
+                            )
+                        ).split()[-1]
+                    )
+                    res: Record = await Resource.merge_staging(
+                        conn, dataset_ids=[d["id"] for d in datasets]
+                    )
+                nb_datasets += len(datasets)
+                new_watermark = max(
+                    new_watermark, *(parse_utc_datetime(d["last_update"]) for d in datasets)
+                )
+                log.info(
+                    f"{nb_datasets} datasets synced ({nb_rows / (time.perf_counter() - start):.0f} "
+                    f"rows/s): {res['inserted']} inserted, {res['updated']} updated, "
+                    f"{res['deleted']} marked as deleted."
+                )
+            # datasets are sorted by last update, next pages are older than the watermark
+            url = page.get("next_page") if len(datasets) == len(page["data"]) else None
+
+    await CatalogSync.set_watermark(source, new_watermark)
+    log.info(
+        f"Resources catalog successfully synced: {nb_datasets} datasets updated, "
+        f"new watermark is {new_watermark.isoformat()}."
+    )
+
+
 @cli
 async def crawl_url(url: str, method: str = "get"):
     """Quickly crawl an URL"""
@@ -144,15 +243,19 @@ async def check_resource(resource_id: str, method: str = "get", force_analysis:
     if not resource:
         log.error(f"Resource {resource_id} not found in catalog")
         return
-    async with aiohttp.ClientSession(timeout=None) as session:
-        await crawl_check_resource(
-            url=resource["url"],
-            resource=resource,
-            session=session,
-            method=method,
-            force_analysis=force_analysis,
-            worker_priority="high",
-        )
+    try:
+        async with aiohttp.ClientSession(timeout=None) as session:
+            await crawl_check_resource(
+                url=resource["url"],
+                resource=resource,
+                session=session,
+                method=method,
+                force_analysis=force_analysis,
+                worker_priority="high",
+                buffered=False,
+            )
+    finally:
+        await flush_pending_writes()
 
 
 @cli(name="analyse-csv")
@@ -161,9 +264,11 @@ async def analyse_csv_cli(
     url: str | None = None,
     resource_id: str | None = None,
     debug_insert: bool = False,
+    profile: bool = False,
 ):
     """Trigger a csv analysis from a check_id, an url or a resource_id
     Try to get the check from the check ID, then from the URL
+    :profile: profile the analysis, storing the path of the profile in the check
     """
     assert check_id or url or resource_id
     check = None
@@ -184,7 +289,7 @@ async def analyse_csv_cli(
         elif resource_id:
             log.error("Could not find a check linked to the specified resource ID")
         return
-    await analyse_csv(check=check, debug_insert=debug_insert)
+    await analyse_csv(check=check, debug_insert=debug_insert, profile=profile)
 
 
 @cli
@@ -201,7 +306,7 @@ async def csv_sample(size: int = 1000, download: bool = False, max_size: str = "
             checks.headers->>'content-type' as content_type,
             checks.headers->>'content-length' as content_length
         FROM checks, catalog
-        WHERE catalog.last_check = checks.id
+        WHERE catalog.last_check = checks.id AND catalog.last_check_at = checks.created_at
         AND checks.headers->>'content-type' LIKE '%csv%'
         AND checks.status >= 200 and checks.status < 400
         AND CAST(checks.headers->>'content-length' AS INTEGER) <= {max_size}
@@ -266,7 +371,8 @@ async def drop_dbs(dbs: list = []):
             WHERE schemaname = '{config.DATABASE_SCHEMA}';
         """)
         for table in tables:
-            await conn.execute(f'DROP TABLE "{table["tablename"]}" CASCADE')
+            # partitions are dropped along with their partitioned table
+            await conn.execute(f'DROP TABLE IF EXISTS "{table["tablename"]}" CASCADE')
 
 
 @cli
@@ -280,18 +386,46 @@ async def migrate(skip_errors: bool = False, dbs: list[str] = ["main", "csv"]):
 
 @cli
 async def purge_checks(retention_days: int = 60, quiet: bool = False) -> None:
-    """Delete outdated checks that are more than `retention_days` days old"""
+    """Delete outdated checks that are more than `retention_days` days old
+
+    Partitions of the checks table only holding outdated checks are dropped as a whole,
+    outdated checks are only deleted row by row from the partition holding the retention limit.
+    Upcoming partitions are created along the way, and the checks caught by the default partition
+    are moved to the partitions of their months beforehand.
+    Check jobs older than CHECK_JOBS_RETENTION_DAYS days are deleted too.
+    """
     if quiet:
         log.setLevel(logging.ERROR)
 
+    await Check.create_partitions()
+
     conn = await connection()
     log.debug(f"Deleting checks that are more than {retention_days} days old...")
-    res: Record = await conn.fetchrow(
-        f"""WITH deleted AS (DELETE FROM checks WHERE created_at < now() - interval '{retention_days} days' RETURNING *) SELECT count(*) FROM deleted"""
-    )
-    deleted: int = res["count"]
+    since = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    deleted = 0
+    async with conn.transaction():
+        # dropping partitions doesn't fire the trigger unsetting the last_check of their resources
+        await conn.execute(
+            "UPDATE catalog SET last_check = NULL, last_check_at = NULL WHERE last_check_at < $1",
+            since,
+        )
+        for partition in await Check.get_partitions_before(conn, since):
+            deleted += await conn.fetchval(f'SELECT count(*) FROM "{partition["name"]}"')
+            await conn.execute(f'ALTER TABLE checks DETACH PARTITION "{partition["name"]}"')
+            await conn.execute(f'DROP TABLE "{partition["name"]}"')
+            log.debug(f"Dropped partition {partition['name']}")
+        res: Record = await conn.fetchrow(
+            """WITH deleted AS (DELETE FROM checks WHERE created_at < $1 RETURNING id)
+            SELECT count(*) FROM deleted""",
+            since,
+        )
+    deleted += res["count"]
     log.info(f"Deleted {deleted} checks.")
 
+    since = datetime.now(timezone.utc) - timedelta(days=config.CHECK_JOBS_RETENTION_DAYS)
+    deleted = await CheckJob.purge(since)
+    log.info(f"Deleted {deleted} check jobs.")
+
 
 @cli
 async def purge_csv_tables(quiet: bool = False) -> None:
@@ -344,6 +478,31 @@ async def purge_csv_tables(quiet: bool = False) -> None:
         log.info("Nothing to delete.")
 
 
+@cli
+async def refresh_stats() -> None:
+    """Compute and store the snapshots of the crawler statistics served by the API"""
+    await Stats.refresh_all()
+    log.info("Stats refreshed.")
+
+
+@cli
+async def purge_artifacts(quiet: bool = False) -> None:
+    """Remove the expired files of the artifacts cache, and the least recently used ones
+    if the cache exceeds its max size"""
+    if quiet:
+        log.setLevel(logging.ERROR)
+
+    if not artifacts.enabled:
+        log.info("Artifacts cache is disabled.")
+        return
+    artifacts.evict()
+    stats: dict = artifacts.stats()
+    log.info(
+        f"Evicted {stats['evictions']} file(s), {stats['files']} file(s) left "
+        f"for {stats['size']} bytes."
+    )
+
+
 @cli
 async def insert_resource_into_catalog(resource_id: str):
     """Insert a resource into the catalog
@@ -392,6 +551,7 @@ async def insert_resource_into_catalog(resource_id: str):
 
 @wrap
 async def cli_wrapper():
+    set_role("cli")
     context["conn"] = {}
     yield
     for db in context["conn"]:
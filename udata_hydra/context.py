@@ -1,18 +1,40 @@
+import asyncio
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+from typing import Any
 from unittest.mock import MagicMock
 
+import aiohttp
 import asyncpg
+import orjson
 import redis
 from rq import Queue
 
 from udata_hydra import config
 
+
+def json_dumps(value) -> str:
+    return orjson.dumps(value).decode()
+
+
+def json_loads(value: str | bytes) -> Any:
+    return orjson.loads(value)
+
+
 log = logging.getLogger("udata-hydra")
-context = {
+context: dict[str, Any] = {
     "databases": {},
     "queues": {},
 }
 
+# CPU time spent in the pool of processes by the steps of the current job, see run_cpu_bound
+offloaded_cpu_time: ContextVar[float] = ContextVar("offloaded_cpu_time", default=0.0)
+# whether the current job is profiled, its CPU-bound steps then running in the calling process
+profiling: ContextVar[bool] = ContextVar("profiling", default=False)
+
 
 def monitor() -> MagicMock:
     if "monitor" in context:
@@ -24,17 +46,76 @@ def monitor() -> MagicMock:
     return context["monitor"]
 
 
+async def init_connection(connection: asyncpg.Connection) -> None:
+    """
+    Encode and decode JSON(B) columns natively, so that records carry dicts instead of strings.
+    Only for the main database: the CSV database stores values of converted files as is.
+    """
+    for typename in ("json", "jsonb"):
+        await connection.set_type_codec(
+            typename, encoder=json_dumps, decoder=json_loads, schema="pg_catalog"
+        )
+
+
+def set_role(role: str) -> None:
+    """Set the role of the current process (crawler, api, worker or cli), which selects
+    the profile of its DB pools in POOL_PROFILES"""
+    context["role"] = role
+
+
+def role() -> str:
+    # jobs run by the RQ worker don't go through any of our entrypoints
+    return context.get("role", "worker")
+
+
+def pool_settings(role: str) -> dict:
+    """Settings of the DB pools of a process role, falling back to asyncpg defaults and MAX_POOL_SIZE"""
+    settings = {
+        "min_size": 10,
+        "max_size": config.MAX_POOL_SIZE,
+        "max_inactive_connection_lifetime": 300.0,
+        "statement_cache_size": 100,
+        **(config.POOL_PROFILES or {}).get(role, {}),
+    }
+    settings["min_size"] = min(settings["min_size"], settings["max_size"])
+    if config.EXTERNAL_POOLER:
+        settings["statement_cache_size"] = 0
+    return settings
+
+
 async def pool(db: str = "main") -> asyncpg.pool.Pool:
     if db not in context["databases"]:
         dsn = config.DATABASE_URL if db == "main" else getattr(config, f"DATABASE_URL_{db.upper()}")
         context["databases"][db] = await asyncpg.create_pool(
             dsn=dsn,
-            max_size=config.MAX_POOL_SIZE,
             server_settings={"search_path": config.DATABASE_SCHEMA},
+            init=init_connection if db == "main" else None,
+            **pool_settings(role()),
         )
     return context["databases"][db]
 
 
+def pools_stats() -> dict:
+    """Gauge of the connections of the DB pools of the current process"""
+    return {
+        "role": role(),
+        "databases": {
+            db: {
+                "size": p.get_size(),
+                "idle": p.get_idle_size(),
+                "min_size": p.get_min_size(),
+                "max_size": p.get_max_size(),
+            }
+            for db, p in context["databases"].items()
+        },
+    }
+
+
+def queue_timeout(name: str) -> int:
+    """Default timeout of the jobs of a queue"""
+    return (config.QUEUES_TIMEOUT or {}).get(name, config.RQ_DEFAULT_TIMEOUT)
+
+
 def queue(name: str = "default") -> Queue | None:
     if not context["queues"].get(name):
         # we dont need a queue while testing, make sure we're not using a real Redis connection
@@ -42,6 +123,37 @@ def queue(name: str = "default") -> Queue | None:
             return None
         connection = redis.from_url(config.REDIS_URL)
         context["queues"][name] = Queue(
-            name, connection=connection, default_timeout=config.RQ_DEFAULT_TIMEOUT
+            name,
+            connection=connection,
+            default_timeout=queue_timeout(name),
         )
     return context["queues"][name]
+
+
+def http_session() -> aiohttp.ClientSession | None:
+    """HTTP session shared by the jobs of the async worker, None outside of it"""
+    return context.get("http_session")
+
+
+def executor() -> ProcessPoolExecutor | None:
+    """Pool of processes for the CPU-bound steps of the jobs of the async worker, None outside of it"""
+    return context.get("executor")
+
+
+def _run_timed(fn, *args, **kwargs) -> tuple:
+    """Run fn, returning its result along with the CPU time it took"""
+    start = time.process_time()
+    return fn(*args, **kwargs), time.process_time() - start
+
+
+async def run_cpu_bound(fn, *args, **kwargs):
+    """Run fn in the pool of processes of the async worker if any and the job isn't profiled,
+    else in the calling process.
+    The CPU time it took in the pool is added to offloaded_cpu_time, for the timers of the job."""
+    if not executor() or profiling.get():
+        return fn(*args, **kwargs)
+    result, cpu_time = await asyncio.get_running_loop().run_in_executor(
+        executor(), partial(_run_timed, fn, *args, **kwargs)
+    )
+    offloaded_cpu_time.set(offloaded_cpu_time.get() + cpu_time)
+    return result
@@ -5,8 +5,10 @@ from asyncpg import Record
 from udata_hydra import config, context
 from udata_hydra.crawl.check_resources import check_batch_resources
 from udata_hydra.crawl.select_batch import select_batch_resources_to_check
+from udata_hydra.db.check import Check
+from udata_hydra.db.stats import Stats
 from udata_hydra.logger import setup_logging
-from udata_hydra.utils import queue  # noqa
+from udata_hydra.utils import metrics, queue  # noqa
 
 log = setup_logging()
 
@@ -16,6 +18,8 @@ async def start_checks(iterations: int = -1) -> None:
 
     :iterations: for testing purposes (break infinite loop)
     """
+    context.set_role("crawler")
+    metrics_server = await metrics.start_metrics_server((config.METRICS_PORTS or {}).get("crawler"))
     try:
         context.monitor().init(
             CHECK_DELAYS=config.CHECK_DELAYS,
@@ -23,9 +27,13 @@ async def start_checks(iterations: int = -1) -> None:
             BACKOFF_NB_REQ=config.BACKOFF_NB_REQ,
             BACKOFF_PERIOD=config.BACKOFF_PERIOD,
         )
+        # checks of the upcoming months must have a partition to go to
+        await Check.create_partitions()
 
         while iterations != 0:
             batch: list[Record] = await select_batch_resources_to_check()
+            metrics.BATCHES.inc()
+            metrics.BATCH_FILL_RATIO.set(len(batch) / config.BATCH_SIZE)
 
             if batch and len(batch):
                 await check_batch_resources(batch)
@@ -33,10 +41,15 @@ async def start_checks(iterations: int = -1) -> None:
             else:
                 context.monitor().set_status("No resources to check for now.")
 
+            # reconcile the stats snapshots served by the API, if they are due
+            await Stats.refresh_all(max_age=config.STATS_REFRESH_INTERVAL)
+
             await asyncio.sleep(config.SLEEP_BETWEEN_BATCHES)
             iterations -= 1
 
     finally:
+        if metrics_server:
+            await metrics_server.cleanup()
         pool = await context.pool()
         await pool.close()
 
@@ -1,7 +1,9 @@
 import asyncio
+import contextlib
 import logging
 import time
 from collections import defaultdict
+from datetime import datetime, timezone
 from urllib.parse import urlparse
 
 import aiohttp
@@ -15,8 +17,10 @@ from udata_hydra.crawl.helpers import (
     is_domain_backoff,
 )
 from udata_hydra.crawl.preprocess_check_data import preprocess_check_data
+from udata_hydra.db.check import Check
+from udata_hydra.db.check_job import CheckJob
 from udata_hydra.db.resource import Resource
-from udata_hydra.utils import queue
+from udata_hydra.utils import detect_tabular_from_headers, metrics, queue, sender
 
 RESOURCE_RESPONSE_STATUSES = {
     "OK": "ok",
@@ -35,22 +39,83 @@ async def check_batch_resources(to_parse: list[Record]) -> None:
     """Check a batch of resources"""
     context.monitor().set_status("Checking resources...")
     tasks: list = []
-    async with aiohttp.ClientSession(
-        timeout=None, headers={"user-agent": config.USER_AGENT}
-    ) as session:
-        for row in to_parse:
-            tasks.append(
-                check_resource(
-                    url=row["url"],
-                    resource=row,
-                    session=session,
-                    worker_priority="low",
+    try:
+        async with aiohttp.ClientSession(
+            timeout=None, headers={"user-agent": config.USER_AGENT}
+        ) as session:
+            for row in to_parse:
+                tasks.append(
+                    check_resource(
+                        url=row["url"],
+                        resource=row,
+                        session=session,
+                        worker_priority="low",
+                    )
                 )
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                results[result] += 1
+                metrics.CHECKS.inc(result=result)
+                context.monitor().refresh(results)
+    finally:
+        # write the checks and status transitions still buffered for this batch
+        await flush_pending_writes()
+
+
+async def flush_pending_writes() -> None:
+    """Write the checks and the resources status transitions buffered in memory,
+    and send the pending documents to udata"""
+    try:
+        await Check.flush_buffered()
+    finally:
+        try:
+            await Resource.flush_statuses()
+        finally:
+            # only enqueues the documents, which are sent by a worker
+            await sender.flush()
+
+
+async def check_resource_job(check_job_id: str) -> None:
+    """Check the resource of a check job requested through the API, recording its outcome in the job"""
+    job: Record = await CheckJob.update(
+        check_job_id, {"status": "RUNNING", "started_at": datetime.now(timezone.utc)}
+    )
+    try:
+        resource: Record | None = await Resource.get(str(job["resource_id"]))
+        if not resource:
+            raise ValueError(f"Resource {job['resource_id']} not found")
+        session = context.http_session()
+        async with (
+            aiohttp.ClientSession(timeout=None, headers={"user-agent": config.USER_AGENT})
+            if session is None
+            else contextlib.nullcontext(session)
+        ) as session:
+            status: str = await check_resource(
+                url=resource["url"],
+                resource=resource,
+                session=session,
+                force_analysis=job["force_analysis"],
+                worker_priority="high",
+                buffered=False,
             )
-        for task in asyncio.as_completed(tasks):
-            result = await task
-            results[result] += 1
-            context.monitor().refresh(results)
+    except Exception as e:
+        await flush_pending_writes()
+        await CheckJob.update(
+            check_job_id,
+            {"status": "FAILED", "error": str(e), "finished_at": datetime.now(timezone.utc)},
+        )
+        raise
+    await flush_pending_writes()
+    check: Record | None = await Check.get_latest(resource_id=str(job["resource_id"]))
+    await CheckJob.update(
+        check_job_id,
+        {
+            "status": "DONE",
+            "result": status,
+            "check_id": check["check_id"] if check else None,
+            "finished_at": datetime.now(timezone.utc),
+        },
+    )
 
 
 async def check_resource(
@@ -61,7 +126,13 @@ async def check_resource(
     method: str = "head",
     worker_priority: str = "default",
     force_analysis: bool = False,
+    buffered: bool = True,
 ) -> str:
+    """
+    Check a resource and process its check, returning the outcome of the check.
+    The checks of the crawler are buffered and written in bulk, see preprocess_check_data.
+    The ones requested on demand (API, CLI) are not buffered, so that they're in DB once checked.
+    """
     log.debug(f"check {url}, sleep {sleep}, method {method}")
 
     # Import here to avoid circular import issues
@@ -84,18 +155,19 @@ async def check_resource(
                 "error": "Not netloc in url",
                 "timeout": False,
             },
+            buffered=buffered,
         )
         return RESOURCE_RESPONSE_STATUSES["ERROR"]
 
     should_backoff, reason = await is_domain_backoff(domain)
+    metrics.BACKOFF_DECISIONS.inc(decision="backoff" if should_backoff else "crawl")
     if should_backoff:
         log.info(f"backoff {domain} ({reason})")
         # skip this URL, it will come back in a next batch
-        await Resource.update(
-            str(resource["resource_id"]), data={"status": "BACKOFF", "priority": False}
-        )
+        await Resource.set_status(str(resource["resource_id"]), "BACKOFF", priority=False)
         return RESOURCE_RESPONSE_STATUSES["BACKOFF"]
 
+    response_counted = False
     try:
         start = time.time()
         timeout = aiohttp.ClientTimeout(total=5)
@@ -110,11 +182,31 @@ async def check_resource(
                     force_analysis=force_analysis,
                     method="get",
                     worker_priority=worker_priority,
+                    buffered=buffered,
                 )
+            metrics.CHECK_DURATION.observe(end - start, domain=domain)
+            metrics.CHECK_RESPONSES.inc(status=resp.status)
+            response_counted = True
             resp.raise_for_status()
 
+            async def enqueue_analysis(new_check: dict, last_check: dict | None) -> None:
+                # Enqueue the resource for analysis, in the heavy lane if the file looks big
+                _, file_format = await detect_tabular_from_headers(new_check)
+                queue.enqueue(
+                    analyse_resource,
+                    check=new_check,
+                    last_check=last_check,
+                    force_analysis=force_analysis,
+                    _priority=queue.get_analysis_queue(
+                        (new_check.get("headers") or {}).get("content-length"),
+                        file_format,
+                        worker_priority,
+                    ),
+                )
+
             # Preprocess the check data. If it has changed, it will be sent to udata
-            new_check, last_check = await preprocess_check_data(
+            # The check may be buffered, its analysis is enqueued once it's written in DB
+            await preprocess_check_data(
                 dataset_id=resource["dataset_id"],
                 check_data={
                     "resource_id": str(resource["resource_id"]),
@@ -125,20 +217,10 @@ async def check_resource(
                     "timeout": False,
                     "response_time": end - start,
                 },
-            )
-
-            # Update resource status to TO_ANALYSE_RESOURCE
-            await Resource.update(
-                str(resource["resource_id"]), data={"status": "TO_ANALYSE_RESOURCE"}
-            )
-
-            # Enqueue the resource for analysis
-            queue.enqueue(
-                analyse_resource,
-                check=new_check,
-                last_check=last_check,
-                force_analysis=force_analysis,
-                _priority=worker_priority,
+                # Update resource status to TO_ANALYSE_RESOURCE along with the check
+                resource_status="TO_ANALYSE_RESOURCE",
+                buffered=buffered,
+                on_ingested=enqueue_analysis,
             )
 
             return RESOURCE_RESPONSE_STATUSES["OK"]
@@ -153,11 +235,9 @@ async def check_resource(
                 "domain": domain,
                 "timeout": True,
             },
+            buffered=buffered,
         )
 
-        # Reset resource status so that it's not forbidden to be checked again
-        await Resource.update(str(resource["resource_id"]), data={"status": None})
-
         return RESOURCE_RESPONSE_STATUSES["TIMEOUT"]
 
     # TODO: debug AssertionError, should be caught in DB now
@@ -179,11 +259,16 @@ async def check_resource(
                 url,
                 force_analysis,
                 worker_priority,
+                buffered,
             )
             if handled is not None:
                 return handled
 
         error = getattr(e, "message", None) or str(e)
+        # the responses with an error status are already counted by their status, but not the errors
+        # raised before a response, e.g. TooManyRedirects which is a ClientResponseError too
+        if not response_counted:
+            metrics.CHECK_RESPONSES.inc(status="error")
         # Process the check data. If it has changed, it will be sent to udata
         await preprocess_check_data(
             dataset_id=resource["dataset_id"],
@@ -196,13 +281,11 @@ async def check_resource(
                 "headers": convert_headers(getattr(e, "headers", {})),
                 "status": getattr(e, "status", None),
             },
+            buffered=buffered,
         )
 
         log.warning(f"Crawling error for url {url}", exc_info=e)
 
-        # Reset resource status so that it's not forbidden to be checked again
-        await Resource.update(str(resource["resource_id"]), data={"status": None})
-
         return RESOURCE_RESPONSE_STATUSES["ERROR"]
 
 
@@ -212,6 +295,7 @@ async def handle_wrong_resource_url(
     url: str,
     force_analysis: bool,
     worker_priority: str,
+    buffered: bool = True,
 ):
     resource_id = resource["resource_id"]
     stable_resource_url = f"{config.UDATA_URI.replace('api/2', 'fr')}/datasets/r/{resource_id}"
@@ -227,5 +311,6 @@ async def handle_wrong_resource_url(
             force_analysis=force_analysis,
             method="head",
             worker_priority=worker_priority,
+            buffered=buffered,
         )
     return
@@ -1,9 +1,11 @@
 from datetime import datetime, timedelta, timezone
 from typing import Any
 
+from asyncpg import Record
 from multidict import CIMultiDictProxy
 
 from udata_hydra import config, context
+from udata_hydra.db.check import Check
 
 
 async def get_content_type_from_header(headers: dict) -> str:
@@ -78,6 +80,17 @@ async def is_domain_backoff(domain: str) -> tuple[bool, str]:
         return backoff
 
     since_backoff_period = datetime.now(timezone.utc) - timedelta(seconds=config.BACKOFF_PERIOD)
+    since_cool_off_period = datetime.now(timezone.utc) - timedelta(seconds=config.COOL_OFF_PERIOD)
+    # the checks buffered by this process are not in DB yet, they're counted along with the others
+    buffered_checks: list[dict] = sorted(
+        (
+            check
+            for check in Check.pending_checks.values()
+            if check.get("domain") == domain
+            and check["created_at"] >= min(since_backoff_period, since_cool_off_period)
+        ),
+        key=lambda check: check["created_at"],
+    )
 
     pool = await context.pool()
     async with pool.acquire() as connection:
@@ -91,38 +104,47 @@ async def is_domain_backoff(domain: str) -> tuple[bool, str]:
             domain,
             since_backoff_period,
         )
+        count: int = res["count"] + sum(
+            check["created_at"] >= since_backoff_period for check in buffered_checks
+        )
         backoff = (
-            res["count"] >= config.BACKOFF_NB_REQ,
-            f"Too many requests: {res['count']}",
+            count >= config.BACKOFF_NB_REQ,
+            f"Too many requests: {count}",
         )
 
         if not backoff[0]:
             # check if we hit a ratelimit or received a 429 on this domain since COOL_OFF_PERIOD
-            since_cool_off_period = datetime.now(timezone.utc) - timedelta(
-                seconds=config.COOL_OFF_PERIOD
-            )
-            q = """
-                SELECT
-                    headers->>'x-ratelimit-remaining' as ratelimit_remaining,
-                    headers->>'x-ratelimit-limit' as ratelimit_limit,
-                    status,
-                    created_at
-                FROM checks
-                WHERE domain = $1
-                AND created_at >= $2
-                ORDER BY created_at DESC
-                LIMIT 1
-            """
-            res = await connection.fetchrow(q, domain, since_cool_off_period)
-            if res:
-                if res["status"] == 429:
+            if buffered_checks and buffered_checks[-1]["created_at"] >= since_cool_off_period:
+                headers: dict = buffered_checks[-1].get("headers") or {}
+                latest: Record | dict | None = {
+                    "ratelimit_remaining": headers.get("x-ratelimit-remaining"),
+                    "ratelimit_limit": headers.get("x-ratelimit-limit"),
+                    "status": buffered_checks[-1].get("status"),
+                    "created_at": buffered_checks[-1]["created_at"],
+                }
+            else:
+                q = """
+                    SELECT
+                        headers->>'x-ratelimit-remaining' as ratelimit_remaining,
+                        headers->>'x-ratelimit-limit' as ratelimit_limit,
+                        status,
+                        created_at
+                    FROM checks
+                    WHERE domain = $1
+                    AND created_at >= $2
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                """
+                latest = await connection.fetchrow(q, domain, since_cool_off_period)
+            if latest:
+                if latest["status"] == 429:
                     # we have made too many requests already and haven't cooled off yet
                     # TODO: we could also user Retry-after, but it isn't returned correctly on 429 we're getting
                     return True, "429 status code has been returned on the latest call"
                 try:
                     remain, limit = (
-                        float(res["ratelimit_remaining"]),
-                        float(res["ratelimit_limit"]),
+                        float(latest["ratelimit_remaining"]),
+                        float(latest["ratelimit_limit"]),
                     )
                 except (ValueError, TypeError):
                     pass
@@ -132,7 +154,7 @@ async def is_domain_backoff(domain: str) -> tuple[bool, str]:
                     if remain == 0 or limit == 0:
                         # we have really messed up
                         backoff = True, "X-ratelimit reached"
-                    elif remain / limit <= 0.1 and res["created_at"] > since_backoff_period:
+                    elif remain / limit <= 0.1 and latest["created_at"] > since_backoff_period:
                         # less than 10% left from our quota, we're backing off until backoff period
                         backoff = True, "X-ratelimit reached"
 
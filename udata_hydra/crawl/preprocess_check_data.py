@@ -1,40 +1,83 @@
-import json
+from collections.abc import Awaitable, Callable
 from datetime import datetime, timezone
 
 from asyncpg import Record
 
+from udata_hydra import context
 from udata_hydra.crawl.calculate_next_check import calculate_next_check_date
 from udata_hydra.crawl.helpers import get_content_type_from_header, is_valid_status
 from udata_hydra.db.check import Check
 from udata_hydra.db.resource import Resource
-from udata_hydra.utils import queue, send
+from udata_hydra.utils import send
 
 
-async def preprocess_check_data(dataset_id: str, check_data: dict) -> tuple[dict, dict | None]:
+async def preprocess_check_data(
+    dataset_id: str,
+    check_data: dict,
+    resource_status: str | None = None,
+    buffered: bool = False,
+    on_ingested: Callable[[dict, dict | None], Awaitable] | None = None,
+) -> tuple[dict, dict | None]:
     """Preprocess a check data.
 
-    Insert a new check in the DB with the provided check data before analysis, and update the resource status and priority.
+    In a single transaction, read the previous check, insert a new check in the DB with the provided check data before analysis, and update the resource status and priority.
+    If buffered, the check is instead written later along with other checks, the buffered check of the resource standing for its previous check meanwhile.
     If the check data has changed compared to the previous check, it will also send the check to udata, and provide a first estimated next_check date to the new check.
 
     Args:
+        dataset_id: the dataset_id of the checked resource.
         check_data: the check data to insert in the DB.
+        resource_status: the status of the resource once the check is inserted.
+        buffered: buffer the check to write it in DB later along with other checks, instead of inserting it right away.
+        on_ingested: awaited with the inserted check and the previous one once the check is in DB, e.g. to enqueue its analysis.
 
     Returns:
-        The updated check data as it has just been inserted in the DB.
+        The updated check data as it has just been inserted in the DB, or as it has been buffered.
         The previous check data, or None if it's the first check.
     """
 
     check_data["resource_id"] = str(check_data["resource_id"])
+    # a check still buffered is the actual last check of the resource
+    buffered_check: dict | None = Check.get_buffered(check_data["resource_id"])
+
+    if buffered:
+        last_check: dict | None = buffered_check
+        if not last_check:
+            last_check_record: Record | None = await Check.get_by_resource_id(
+                check_data["resource_id"]
+            )
+            last_check = dict(last_check_record) if last_check_record else None
+
+        has_changed: bool = await has_check_changed(check_data, last_check)
+        check_data["next_check_at"] = calculate_next_check_date(has_changed, last_check, None)
+
+    else:
+        if buffered_check:
+            await Check.flush_buffered()
+
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                last_check = None
+                last_check_record = await Check.get_last_for_update(
+                    connection, check_data["resource_id"]
+                )
+                if last_check_record:
+                    last_check = dict(last_check_record)
+
+                has_changed = await has_check_changed(check_data, last_check)
+                check_data["next_check_at"] = calculate_next_check_date(
+                    has_changed, last_check, None
+                )
 
-    last_check: dict | None = None
-    last_check_record: Record | None = await Check.get_by_resource_id(check_data["resource_id"])
-    if last_check_record:
-        last_check = dict(last_check_record)
+                # Update resource following check:
+                # Set the resource status (resetting it so that it's not forbidden to be checked again, unless it's handed over for analysis).
+                # Reset priority so that it's not prioritised anymore.
+                Resource.pending_statuses.pop(check_data["resource_id"], None)
+                new_check: dict = await Check.ingest(connection, check_data, resource_status)
 
-    has_changed: bool = await has_check_changed(check_data, last_check)
     if has_changed:
-        queue.enqueue(
-            send,
+        await send(
             dataset_id=dataset_id,
             resource_id=check_data["resource_id"],
             document={
@@ -51,17 +94,18 @@ async def preprocess_check_data(dataset_id: str, check_data: dict) -> tuple[dict
                 )
                 or None,
             },
-            _priority="high",
         )
 
-    # Update resource following check:
-    # Reset resource status so that it's not forbidden to be checked again.
-    # Reset priority so that it's not prioritised anymore.
-    await Resource.update(check_data["resource_id"], data={"status": None, "priority": False})
-
-    check_data["next_check_at"] = calculate_next_check_date(has_changed, last_check, None)
-
-    new_check: dict = await Check.insert(data=check_data, returning="*")
+    if buffered:
+        # buffered once sent, since it may be flushed right away along with its callback
+        Resource.pending_statuses.pop(check_data["resource_id"], None)
+        new_check = await Check.buffer(
+            check_data,
+            resource_status,
+            on_ingested=(lambda check: on_ingested(check, last_check)) if on_ingested else None,
+        )
+    elif on_ingested:
+        await on_ingested(new_check, last_check)
 
     return new_check, last_check
 
@@ -82,11 +126,7 @@ async def has_check_changed(check_data: dict, last_check_data: dict | None) -> b
         "timeout"
     )
     current_headers = check_data.get("headers", {})
-    last_check_headers = (
-        json.loads(last_check_data.get("headers"))
-        if last_check_data and last_check_data.get("headers")
-        else {}
-    )
+    last_check_headers = (last_check_data and last_check_data.get("headers")) or {}
     content_has_changed = last_check_data and (
         current_headers.get("content-length") != last_check_headers.get("content-length")
         or current_headers.get("content-type") != last_check_headers.get("content-type")
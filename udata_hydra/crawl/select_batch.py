@@ -79,7 +79,7 @@ async def select_batch_resources_to_check() -> list[Record]:
                 SELECT catalog.url, dataset_id, catalog.resource_id
                 FROM catalog, checks
                 WHERE catalog.last_check IS NOT NULL
-                AND catalog.last_check = checks.id
+                AND catalog.last_check = checks.id AND catalog.last_check_at = checks.created_at
                 AND (checks.next_check_at <= $1 OR checks.next_check_at IS NULL)
                 AND {excluded}
                 AND catalog.priority = False
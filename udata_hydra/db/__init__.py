@@ -1,48 +1,161 @@
 import json
+import logging
+import random
+import time
+from functools import lru_cache
+from typing import Any
 
 from asyncpg import Record
 
-from udata_hydra import context
+from udata_hydra import config, context
 
+log = logging.getLogger("udata-hydra")
 
-def convert_dict_values_to_json(data: dict) -> dict:
+# udata_hydra.utils.metrics, imported on the first query since the utils depend on the db
+metrics: Any = None
+
+
+class QueryCounter:
     """
-    Convert values in dict that are dict to json for DB serialization
-    TODO: this is suboptimal from asyncpg, dig into this
-    https://magicstack.github.io/asyncpg/current/usage.html#example-automatic-json-conversion
+    Runs queries with their parameters bound, never interpolated in the query text, and counts
+    them along with their duration. Since the query text of a same query is always the same,
+    the asyncpg statement cache of each connection prepares it once (unless disabled for an
+    external pooler, see EXTERNAL_POOLER).
+
+    ```
+    resource = await queries.fetchrow(connection, "SELECT ... WHERE id = $1", resource_id)
+    ```
+
+    A share QUERIES_SAMPLE_RATE of the SELECT queries fetched is run again with
+    EXPLAIN (ANALYZE, BUFFERS), sampling their planning time and the share of the blocks they
+    read which were in the Postgres buffers. The SELECT queries run through the counter must
+    then be free of side effects.
     """
-    for k, v in data.items():
-        if type(v) is dict:
-            data[k] = json.dumps(v)
-    return data
 
+    def __init__(self) -> None:
+        # distinct query texts run
+        self.statements: set[str] = set()
+        self.count = 0
+        self.time = 0.0
+        # stats of the sampled queries
+        self.sampled = 0
+        self.planning_time = 0.0
+        self.buffers_hit = 0
+        self.buffers_read = 0
 
-def compute_insert_query(table_name: str, data: dict, returning: str = "id") -> str:
-    columns = ",".join([f'"{k}"' for k in data.keys()])
+    async def run(self, method: str, connection, query: str, *args):
+        global metrics
+        if metrics is None:
+            from udata_hydra.utils import metrics
+
+        start = time.perf_counter()
+        result = await getattr(connection, method)(query, *args)
+        duration: float = time.perf_counter() - start
+        metrics.DB_QUERY_DURATION.observe(duration, statement=statement_label(query))
+        self.count += 1
+        self.time += duration
+        self.statements.add(query)
+        if (
+            method != "execute"
+            and config.QUERIES_SAMPLE_RATE
+            and random.random() < config.QUERIES_SAMPLE_RATE
+            and query.lstrip()[:6].upper() == "SELECT"
+        ):
+            await self.sample(connection, query, *args)
+        return result
+
+    async def sample(self, connection, query: str, *args) -> None:
+        """Run a query again with EXPLAIN (ANALYZE, BUFFERS) and add its planning time and buffers
+        to the stats, in a savepoint so that a failure doesn't abort the transaction of the query"""
+        try:
+            async with connection.transaction():
+                plan = await connection.fetchval(
+                    f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", *args
+                )
+        except Exception as e:
+            log.warning(f"Could not sample query {statement_label(query)}: {e}")
+            return
+        # decoded by the JSON codec of the pools, if any
+        plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]
+        self.sampled += 1
+        self.planning_time += plan["Planning Time"] / 1000
+        # the buffers of the top node of the plan include the ones of its children
+        self.buffers_hit += plan["Plan"].get("Shared Hit Blocks", 0)
+        self.buffers_read += plan["Plan"].get("Shared Read Blocks", 0)
+
+    async def fetch(self, connection, query: str, *args) -> list[Record]:
+        return await self.run("fetch", connection, query, *args)
+
+    async def fetchrow(self, connection, query: str, *args) -> Record | None:
+        return await self.run("fetchrow", connection, query, *args)
+
+    async def execute(self, connection, query: str, *args) -> str:
+        return await self.run("execute", connection, query, *args)
+
+    def stats(self) -> dict:
+        buffers: int = self.buffers_hit + self.buffers_read
+        return {
+            "queries": self.count,
+            "statements": len(self.statements),
+            "time": round(self.time, 4),
+            "sampled": self.sampled,
+            "planning_time": round(self.planning_time, 4),
+            # share of the blocks read by the sampled queries which were in the Postgres buffers
+            "buffers_hit_ratio": round(self.buffers_hit / buffers, 4) if buffers else None,
+        }
+
+
+queries = QueryCounter()
+
+
+@lru_cache(maxsize=1024)
+def statement_label(query: str) -> str:
+    """Short label of a query for the metrics, from its first words"""
+    return " ".join(query.split())[:80]
+
+
+@lru_cache
+def build_insert_query(table_name: str, columns: tuple[str, ...], returning: str = "id") -> str:
+    columns_clause = ",".join([f'"{c}"' for c in columns])
     # $1, $2...
-    placeholders = ",".join([f"${x + 1}" for x in range(len(data.values()))])
+    placeholders = ",".join([f"${x + 1}" for x in range(len(columns))])
     return f"""
-        INSERT INTO "{table_name}" ({columns})
+        INSERT INTO "{table_name}" ({columns_clause})
         VALUES ({placeholders})
         RETURNING {returning};
     """
 
 
-def compute_update_query(table_name: str, data: dict, returning: str = "*") -> str:
-    columns = data.keys()
+@lru_cache
+def build_update_query(
+    table_name: str,
+    columns: tuple[str, ...],
+    returning: str = "*",
+    key: str | tuple[str, ...] = "id",
+) -> str:
     # $1, $2...
-    placeholders = [f"${x + 1}" for x in range(len(data.values()))]
+    placeholders = [f"${x + 1}" for x in range(len(columns))]
     set_clause = ",".join([f"{c} = {v}" for c, v in zip(columns, placeholders)])
+    keys: tuple[str, ...] = (key,) if isinstance(key, str) else key
+    where_clause = " AND ".join([f"{k} = ${len(placeholders) + x + 1}" for x, k in enumerate(keys)])
     return f"""
         UPDATE "{table_name}"
         SET {set_clause}
-        WHERE id = ${len(placeholders) + 1}
+        WHERE {where_clause}
         RETURNING {returning};
     """
 
 
-async def update_table_record(table_name: str, record_id: int, data: dict) -> Record | None:
-    data = convert_dict_values_to_json(data)
+def compute_insert_query(table_name: str, data: dict, returning: str = "id") -> str:
+    return build_insert_query(table_name, tuple(data.keys()), returning)
+
+
+def compute_update_query(table_name: str, data: dict, returning: str = "*") -> str:
+    return build_update_query(table_name, tuple(data.keys()), returning)
+
+
+async def update_table_record(table_name: str, record_id: int | str, data: dict) -> Record | None:
     q = compute_update_query(table_name, data)
     pool = await context.pool()
-    return await pool.fetchrow(q, *data.values(), record_id)
+    async with pool.acquire() as connection:
+        return await queries.fetchrow(connection, q, *data.values(), record_id)
@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from udata_hydra import context
+
+
+class CatalogSync:
+    """Represents the watermark of the incremental synchronisation of the catalog from a source,
+    in the "catalog_sync" DB table"""
+
+    @classmethod
+    async def get_watermark(cls, source: str) -> datetime | None:
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = "SELECT watermark FROM catalog_sync WHERE source = $1"
+            return await connection.fetchval(q, source)
+
+    @classmethod
+    async def set_watermark(cls, source: str, watermark: datetime) -> None:
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = """
+                INSERT INTO catalog_sync (source, watermark, synced_at)
+                VALUES ($1, $2, NOW())
+                ON CONFLICT (source) DO UPDATE SET watermark = $2, synced_at = NOW()
+            """
+            await connection.execute(q, source, watermark)
@@ -1,30 +1,97 @@
-from datetime import date
+import logging
+import time
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from datetime import date, datetime, timezone
 
 from asyncpg import Record
 
-from udata_hydra import context
+from udata_hydra import config, context
 from udata_hydra.db import (
+    build_update_query,
     compute_insert_query,
-    convert_dict_values_to_json,
+    queries,
     update_table_record,
 )
 
+log = logging.getLogger("udata-hydra")
+
+# columns filled in by the crawler when a check is ingested, with their postgres types
+CRAWL_COLUMNS: dict[str, str] = {
+    "resource_id": "uuid",
+    "url": "varchar",
+    "domain": "varchar",
+    "status": "int",
+    "headers": "jsonb",
+    "timeout": "boolean",
+    "response_time": "float8",
+    "error": "varchar",
+    "next_check_at": "timestamptz",
+}
+
+# insert a check, point its resource to it and set the resource status and priority
+INGEST_QUERY = f"""
+    WITH inserted AS (
+        INSERT INTO checks ({",".join(CRAWL_COLUMNS)})
+        VALUES ({",".join(f"${x + 1}" for x in range(len(CRAWL_COLUMNS)))})
+        RETURNING *
+    ), updated AS (
+        UPDATE catalog
+        SET last_check = inserted.id, last_check_at = inserted.created_at, status = ${len(CRAWL_COLUMNS) + 1},
+            priority = FALSE
+        FROM inserted
+        WHERE catalog.resource_id = inserted.resource_id
+        RETURNING catalog.dataset_id
+    )
+    SELECT inserted.*, updated.dataset_id FROM inserted LEFT JOIN updated ON TRUE
+"""
+
+# same as INGEST_QUERY for many checks passed as one array per column, along with the time they
+# were made at and the status of their resource
+BULK_INGEST_QUERY = f"""
+    WITH rows AS (
+        SELECT * FROM unnest({",".join(f"${x + 1}::{t}[]" for x, t in enumerate(CRAWL_COLUMNS.values()))}, ${len(CRAWL_COLUMNS) + 1}::timestamptz[], ${len(CRAWL_COLUMNS) + 2}::varchar[])
+        AS r({",".join(CRAWL_COLUMNS)}, created_at, resource_status)
+    ), inserted AS (
+        INSERT INTO checks ({",".join(CRAWL_COLUMNS)}, created_at)
+        SELECT {",".join(CRAWL_COLUMNS)}, created_at FROM rows
+        RETURNING *
+    ), updated AS (
+        UPDATE catalog
+        SET last_check = inserted.id, last_check_at = inserted.created_at, status = rows.resource_status,
+            priority = FALSE
+        FROM inserted JOIN rows ON rows.resource_id = inserted.resource_id
+        WHERE catalog.resource_id = inserted.resource_id
+        RETURNING catalog.resource_id, catalog.dataset_id
+    )
+    SELECT inserted.*, updated.dataset_id
+    FROM inserted LEFT JOIN updated ON updated.resource_id = inserted.resource_id
+"""
+
 
 class Check:
     """Represents a check in the "checks" DB table"""
 
+    # checks waiting to be written in DB, by resource_id
+    pending_checks: dict[str, dict] = {}
+    # status of the resource and callback of each of the checks waiting to be written in DB
+    pending_ingests: dict[str, tuple[str | None, Callable[[dict], Awaitable] | None]] = {}
+    last_checks_flush: float = time.monotonic()
+
+    # dimensions the checks are counted by in the "checks_rollups" DB table, by day
+    ROLLUP_DIMENSIONS = ("domain", "status", "content_type")
+
     @classmethod
     async def get_by_id(cls, check_id: int, with_deleted: bool = False) -> Record | None:
         pool = await context.pool()
         async with pool.acquire() as connection:
             q = """
                 SELECT * FROM catalog JOIN checks
-                ON catalog.last_check = checks.id
+                ON catalog.last_check = checks.id AND catalog.last_check_at = checks.created_at
                 WHERE checks.id = $1
             """
             if not with_deleted:
                 q += " AND catalog.deleted = FALSE"
-            return await connection.fetchrow(q, check_id)
+            return await queries.fetchrow(connection, q, check_id)
 
     @classmethod
     async def get_by_resource_id(
@@ -34,12 +101,12 @@ class Check:
         async with pool.acquire() as connection:
             q = """
                 SELECT * FROM catalog JOIN checks
-                ON catalog.last_check = checks.id
+                ON catalog.last_check = checks.id AND catalog.last_check_at = checks.created_at
                 WHERE catalog.resource_id = $1
             """
             if not with_deleted:
                 q += " AND catalog.deleted = FALSE"
-            return await connection.fetchrow(q, resource_id)
+            return await queries.fetchrow(connection, q, resource_id)
 
     @classmethod
     async def get_by_url(cls, url: str) -> list[Record]:
@@ -64,38 +131,134 @@ class Check:
                 catalog.status as catalog_status, checks.status as check_status, checks.next_check_at as next_check_at, catalog.deleted as deleted, *
             FROM checks, catalog
             WHERE catalog.{column} = $1
-            AND checks.id = catalog.last_check
+            AND checks.id = catalog.last_check AND checks.created_at = catalog.last_check_at
             """
-            return await connection.fetchrow(q, url or resource_id)
+            return await queries.fetchrow(connection, q, url or resource_id)
 
     @classmethod
-    async def get_all(cls, url: str | None = None, resource_id: str | None = None) -> list | None:
-        column: str = "url" if url else "resource_id"
+    async def get_with_resource(cls, check_id: int, since: datetime | None = None) -> Record | None:
+        """A check along with its resource, like get_latest, whether it's still the latest or not.
+        since, a date before its creation, spares the lookup in the older partitions"""
         pool = await context.pool()
         async with pool.acquire() as connection:
-            q = f"""
+            q = """
             SELECT catalog.id as catalog_id, checks.id as check_id,
                 catalog.status as catalog_status, checks.status as check_status, checks.next_check_at as next_check_at, catalog.deleted as deleted, *
             FROM checks, catalog
-            WHERE catalog.{column} = $1
-            AND catalog.{column} = checks.{column}
-            ORDER BY created_at DESC
+            WHERE checks.id = $1 AND checks.created_at >= COALESCE($2::timestamptz, '-infinity')
+            AND catalog.resource_id = checks.resource_id
             """
-            return await connection.fetch(q, url or resource_id)
+            return await queries.fetchrow(connection, q, check_id, since)
 
     @classmethod
-    async def get_group_by_for_date(cls, column: str, date: date, page_size: int = 20):
+    async def get_latest_many(
+        cls, urls: list[str] | None = None, resource_ids: list[str] | None = None
+    ) -> list[Record]:
+        """Get the latest checks of many URLs or resources at once, one check per URL or resource"""
+        column: str = "url" if urls else "resource_id"
         pool = await context.pool()
         async with pool.acquire() as connection:
             q = f"""
-            SELECT {column} as value, count(*) as count
-            FROM checks
-            WHERE created_at::date = $1
-            GROUP BY {column}
-            ORDER BY count desc
-            LIMIT $2
+            SELECT DISTINCT ON (catalog.{column}) catalog.id as catalog_id, checks.id as check_id,
+                catalog.status as catalog_status, checks.status as check_status, checks.next_check_at as next_check_at, catalog.deleted as deleted, *
+            FROM checks, catalog
+            WHERE catalog.{column} = ANY($1::{"varchar" if urls else "uuid"}[])
+            AND checks.id = catalog.last_check AND checks.created_at = catalog.last_check_at
+            ORDER BY catalog.{column}, checks.created_at DESC
             """
-            return await connection.fetch(q, date, page_size)
+            return await queries.fetch(connection, q, urls or resource_ids)
+
+    @staticmethod
+    def get_all_query(
+        url: str | None = None,
+        resource_id: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        before: tuple[datetime, int] | None = None,
+    ) -> tuple[str, list]:
+        """
+        Query of the checks of a URL or a resource, most recent first, created between since and
+        until, and strictly before the (created_at, id) keyset cursor before if any.
+        Filtering both tables on the value rather than joining them on it lets the checks index
+        on the column be used, as well as the partitions bounds for since and until.
+        """
+        column: str = "url" if url else "resource_id"
+        args: list = [url or resource_id]
+        conditions: list[str] = [f"catalog.{column} = $1", f"checks.{column} = $1"]
+        if since:
+            args.append(since)
+            conditions.append(f"checks.created_at >= ${len(args)}")
+        if until:
+            args.append(until)
+            conditions.append(f"checks.created_at < ${len(args)}")
+        if before:
+            args.extend(before)
+            conditions.append(f"(checks.created_at, checks.id) < (${len(args) - 1}, ${len(args)})")
+        q = f"""
+            SELECT catalog.id as catalog_id, checks.id as check_id,
+                catalog.status as catalog_status, checks.status as check_status, checks.next_check_at as next_check_at, catalog.deleted as deleted, *
+            FROM checks, catalog
+            WHERE {" AND ".join(conditions)}
+            ORDER BY checks.created_at DESC, checks.id DESC
+        """
+        return q, args
+
+    @classmethod
+    async def get_all(
+        cls,
+        url: str | None = None,
+        resource_id: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        before: tuple[datetime, int] | None = None,
+        limit: int | None = None,
+    ) -> list[Record]:
+        q, args = cls.get_all_query(url, resource_id, since, until, before)
+        if limit:
+            args.append(limit)
+            q += f" LIMIT ${len(args)}"
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            return await connection.fetch(q, *args)
+
+    @classmethod
+    async def iter_all(
+        cls,
+        url: str | None = None,
+        resource_id: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        before: tuple[datetime, int] | None = None,
+    ) -> AsyncGenerator[Record, None]:
+        """Same as get_all, yielding the checks from a server-side cursor as they are fetched"""
+        q, args = cls.get_all_query(url, resource_id, since, until, before)
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            # server-side cursors only live within a transaction
+            async with connection.transaction():
+                async for record in connection.cursor(
+                    q, *args, prefetch=config.CHECKS_CURSOR_PREFETCH
+                ):
+                    yield record
+
+    @classmethod
+    async def get_group_by_for_dates(
+        cls, dimension: str, since: date, until: date, page_size: int = 20
+    ) -> list[Record]:
+        """Count the checks created from since to until (included) by value of dimension,
+        from the daily rollups of the checks, most frequent values first"""
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = """
+            SELECT NULLIF(value, '') AS value, sum(count)::BIGINT AS count
+            FROM checks_rollups
+            WHERE dimension = $1 AND date BETWEEN $2 AND $3
+            GROUP BY 1
+            HAVING sum(count) > 0
+            ORDER BY count DESC, value
+            LIMIT $4
+            """
+            return await queries.fetch(connection, q, dimension, since, until, page_size)
 
     @classmethod
     async def insert(cls, data: dict, returning: str = "id") -> dict:
@@ -103,17 +266,20 @@ class Check:
         Insert a new check in DB, associate it with the resource and return the check dict, optionally associated with the resource dataset_id.
         This uses the info from the last check of the same resource.
         """
-        data = convert_dict_values_to_json(data)
         q1: str = compute_insert_query(table_name="checks", data=data, returning=returning)
         pool = await context.pool()
         async with pool.acquire() as connection:
-            last_check: Record = await connection.fetchrow(q1, *data.values())
+            last_check: Record = await queries.fetchrow(connection, q1, *data.values())
             last_check_dict = dict(last_check)
-            q2 = (
-                """UPDATE catalog SET last_check = $1 WHERE resource_id = $2 RETURNING dataset_id"""
-            )
-            updated_resource: Record | None = await connection.fetchrow(
-                q2, last_check["id"], data["resource_id"]
+            q2 = """
+                UPDATE catalog
+                SET last_check = checks.id, last_check_at = checks.created_at
+                FROM checks
+                WHERE checks.id = $1 AND catalog.resource_id = $2
+                RETURNING dataset_id
+            """
+            updated_resource: Record | None = await queries.fetchrow(
+                connection, q2, last_check["id"], data["resource_id"]
             )
             # Add the dataset_id arg to the check response, if we can, and if it's asked
             if returning in ["*", "dataset_id"] and updated_resource:
@@ -121,13 +287,163 @@ class Check:
             return last_check_dict
 
     @classmethod
-    async def update(cls, check_id: int, data: dict) -> Record | None:
-        """Update a check in DB with new data and return the check id in DB"""
-        return await update_table_record(table_name="checks", record_id=check_id, data=data)
+    async def get_last_for_update(cls, connection, resource_id: str) -> Record | None:
+        """Get the last check of a resource and lock the resource row until the end of the
+        current transaction on connection, so that concurrent ingestions are serialised"""
+        q = """
+            SELECT * FROM catalog JOIN checks
+            ON catalog.last_check = checks.id AND catalog.last_check_at = checks.created_at
+            WHERE catalog.resource_id = $1 AND catalog.deleted = FALSE
+            FOR UPDATE OF catalog
+        """
+        return await queries.fetchrow(connection, q, resource_id)
+
+    @classmethod
+    async def ingest(cls, connection, data: dict, resource_status: str | None = None) -> dict:
+        """
+        Insert a new check from crawl data and, in the same statement, point the resource to it,
+        set its status to resource_status and reset its priority.
+        Return the check dict, with the resource dataset_id.
+        """
+        check: Record = await queries.fetchrow(
+            connection, INGEST_QUERY, *[data.get(c) for c in CRAWL_COLUMNS], resource_status
+        )
+        return dict(check)
+
+    @classmethod
+    async def buffer(
+        cls,
+        data: dict,
+        resource_status: str | None = None,
+        on_ingested: Callable[[dict], Awaitable] | None = None,
+    ) -> dict:
+        """
+        Buffer a new check from crawl data, to be written in DB later along with other checks.
+        Buffered checks are written by flush_buffered, which is triggered every
+        CHECKS_FLUSH_INTERVAL seconds, and set their resource status to resource_status
+        and reset its priority. Until then, the buffered check stands for the last check of
+        its resource. on_ingested is awaited with the inserted check once it's written in DB.
+        """
+        resource_id = str(data["resource_id"])
+        if resource_id in cls.pending_checks:
+            # don't overwrite the previous check of this resource
+            await cls.flush_buffered()
+        # stamped with the time of the crawl, which is the one inserted in DB
+        check: dict = {**data, "created_at": datetime.now(timezone.utc)}
+        cls.pending_checks[resource_id] = check
+        cls.pending_ingests[resource_id] = (resource_status, on_ingested)
+        if time.monotonic() - cls.last_checks_flush >= config.CHECKS_FLUSH_INTERVAL:
+            await cls.flush_buffered()
+        return check
+
+    @classmethod
+    def get_buffered(cls, resource_id: str) -> dict | None:
+        """Get the check of a resource waiting to be written in DB, if any"""
+        return cls.pending_checks.get(str(resource_id))
 
     @classmethod
-    async def delete(cls, check_id: int) -> int:
+    async def flush_buffered(cls) -> None:
+        """
+        Write all the buffered checks in DB with a single multi-row insert, then point each
+        resource to its new check, set its status and reset its priority in the same statement.
+        The callbacks of the checks are then awaited with the inserted checks.
+        """
+        cls.last_checks_flush = time.monotonic()
+        if not cls.pending_checks:
+            return
+        pending, cls.pending_checks = cls.pending_checks, {}
+        ingests, cls.pending_ingests = cls.pending_ingests, {}
+        rows = list(pending.values())
+        try:
+            pool = await context.pool()
+            async with pool.acquire() as connection:
+                inserted: list[Record] = await queries.fetch(
+                    connection,
+                    BULK_INGEST_QUERY,
+                    *[[row.get(c) for row in rows] for c in CRAWL_COLUMNS],
+                    [row["created_at"] for row in rows],
+                    [ingests[resource_id][0] for resource_id in pending],
+                )
+        except Exception:
+            # keep the checks for the next flush, unless newer checks of their resources came in
+            for resource_id, check in pending.items():
+                if resource_id not in cls.pending_checks:
+                    cls.pending_checks[resource_id] = check
+                    cls.pending_ingests[resource_id] = ingests[resource_id]
+            raise
+        for record in inserted:
+            on_ingested = ingests[str(record["resource_id"])][1]
+            if on_ingested is None:
+                continue
+            try:
+                await on_ingested(dict(record))
+            except Exception as e:
+                log.exception(f"Error after ingesting check {record['id']}", exc_info=e)
+
+    @classmethod
+    async def update(
+        cls, check_id: int, data: dict, created_at: datetime | None = None
+    ) -> Record | None:
+        """Update a check in DB with new data and return the check id in DB.
+        Give the created_at of the check when known, so that only its partition is looked up."""
+        if created_at is None:
+            return await update_table_record(table_name="checks", record_id=check_id, data=data)
+        q = build_update_query("checks", tuple(data.keys()), key=("id", "created_at"))
         pool = await context.pool()
         async with pool.acquire() as connection:
-            q = """DELETE FROM checks WHERE id = $1"""
-            return await connection.fetch(q, check_id)
+            return await queries.fetchrow(connection, q, *data.values(), check_id, created_at)
+
+    @classmethod
+    async def add_timings(
+        cls, check_id: int, name: str, timings: dict, created_at: datetime | None = None
+    ) -> None:
+        """Store the timings of the stages of an analysis of a check under name, e.g. "analyse-csv",
+        along with the ones of its other analyses"""
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = """
+                UPDATE checks
+                SET analysis_timings = COALESCE(analysis_timings, '{}') || jsonb_build_object($2::text, $3::jsonb)
+                WHERE id = $1
+            """
+            if created_at is None:
+                await queries.execute(connection, q, check_id, name, timings)
+            else:
+                q += " AND created_at = $4"
+                await queries.execute(connection, q, check_id, name, timings, created_at)
+
+    @classmethod
+    async def delete(cls, check_id: int) -> str:
+        """Delete a check, the last_check of its resource is set to NULL by a trigger"""
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            return await connection.execute("DELETE FROM checks WHERE id = $1", check_id)
+
+    @classmethod
+    async def create_partitions(cls, months: int | None = None) -> None:
+        """Make sure that the monthly partitions of the checks table exist, from the current month,
+        and move the checks caught by the default partition to the partitions of their months"""
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            await connection.execute("SELECT drain_checks_default()")
+            await connection.execute(
+                "SELECT create_checks_partitions(now(), $1)",
+                months or config.CHECKS_PARTITIONS_AHEAD,
+            )
+
+    @classmethod
+    async def get_partitions_before(cls, connection, date: datetime) -> list[Record]:
+        """Get the partitions of the checks table which only hold checks created before date"""
+        q = r"""
+            SELECT name, upper_bound FROM (
+                SELECT
+                    c.relname AS name,
+                    substring(pg_get_expr(c.relpartbound, c.oid) FROM 'TO \(''(.*)''\)')::timestamptz
+                        AS upper_bound
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'checks'::regclass
+            ) partitions
+            WHERE upper_bound <= $1
+            ORDER BY upper_bound
+        """
+        return await connection.fetch(q, date)
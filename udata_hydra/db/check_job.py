@@ -0,0 +1,77 @@
+import uuid
+from datetime import datetime
+
+from asyncpg import Record
+
+from udata_hydra import config, context
+from udata_hydra.db import update_table_record
+
+
+class CheckJob:
+    """Represents a check of a resource requested through the API and run by a worker,
+    in the "check_jobs" DB table"""
+
+    STATUSES = {
+        "QUEUED": "waiting for a worker",
+        "RUNNING": "checking the resource",
+        "DONE": "check done, its analysis may still be running",
+        "FAILED": "check failed",
+    }
+
+    @classmethod
+    async def get(cls, job_id: str) -> Record | None:
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = "SELECT * FROM check_jobs WHERE id = $1"
+            return await connection.fetchrow(q, job_id)
+
+    @classmethod
+    async def get_or_insert(
+        cls, resource_id: str, force_analysis: bool, timeout: int
+    ) -> tuple[Record, bool]:
+        """
+        Pending job of a resource, or a new one, along with whether it was created.
+        The pending jobs left behind are failed first: the ones queued for more than
+        CHECK_JOBS_MAX_QUEUED seconds, and the ones running for more than their timeout.
+        The concurrent requests of a resource share its pending job, see check_jobs_pending_resource_id_idx.
+        """
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = """
+                UPDATE check_jobs SET status = 'FAILED', error = 'lost', finished_at = NOW()
+                WHERE resource_id = $1 AND (
+                    (status = 'QUEUED' AND created_at < NOW() - make_interval(secs => $2))
+                    OR (status = 'RUNNING' AND started_at < NOW() - make_interval(secs => $3))
+                )
+            """
+            await connection.execute(q, resource_id, config.CHECK_JOBS_MAX_QUEUED, timeout)
+            q = """
+                INSERT INTO check_jobs (id, resource_id, force_analysis) VALUES ($1, $2, $3)
+                ON CONFLICT (resource_id) WHERE status IN ('QUEUED', 'RUNNING') DO NOTHING
+                RETURNING *
+            """
+            job: Record | None = await connection.fetchrow(
+                q, uuid.uuid4(), resource_id, force_analysis
+            )
+            if job:
+                return job, True
+            # inserted by a concurrent request, visible once committed
+            q = "SELECT * FROM check_jobs WHERE resource_id = $1 AND status IN ('QUEUED', 'RUNNING')"
+            job = await connection.fetchrow(q, resource_id)
+            if not job:
+                # already finished meanwhile
+                return await cls.get_or_insert(resource_id, force_analysis, timeout)
+            return job, False
+
+    @classmethod
+    async def update(cls, job_id: str, data: dict) -> Record | None:
+        return await update_table_record(table_name="check_jobs", record_id=job_id, data=data)
+
+    @classmethod
+    async def purge(cls, before: datetime) -> int:
+        """Delete the jobs created before a date, returning their number"""
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = """WITH deleted AS (DELETE FROM check_jobs WHERE created_at < $1 RETURNING id)
+            SELECT count(*) FROM deleted"""
+            return await connection.fetchval(q, before)
@@ -1,6 +1,9 @@
+import time
+
 from asyncpg import Record
 
 from udata_hydra import config, context
+from udata_hydra.db import build_update_query, queries
 
 
 class Resource:
@@ -18,12 +21,19 @@ class Resource:
         "CONVERTING_TO_PARQUET": "currently being converted to Parquet",
     }
 
+    # status transitions waiting to be written in DB, by resource_id: (status, priority)
+    pending_statuses: dict[str, tuple[str | None, bool | None]] = {}
+    last_statuses_flush: float = time.monotonic()
+
     @classmethod
     async def get(cls, resource_id: str, column_name: str = "*") -> Record | None:
+        if column_name != "*" and not column_name.isidentifier():
+            raise ValueError(f"Invalid column name: {column_name}")
+        column: str = column_name if column_name == "*" else f'"{column_name}"'
         pool = await context.pool()
         async with pool.acquire() as connection:
-            q = f"""SELECT {column_name} FROM catalog WHERE resource_id = '{resource_id}';"""
-            return await connection.fetchrow(q)
+            q = f"""SELECT {column} FROM catalog WHERE resource_id = $1;"""
+            return await queries.fetchrow(connection, q, resource_id)
 
     @classmethod
     async def insert(
@@ -52,21 +62,147 @@ class Resource:
                     RETURNING *;"""
             await connection.fetchrow(q, dataset_id, resource_id, url, status, priority)
 
+    @classmethod
+    async def create_staging(cls, connection) -> None:
+        """
+        Create the temporary "catalog_staging" table, to be filled with COPY and merged into
+        the catalog with merge_staging, within the current transaction on connection.
+        Temporary tables are not written to the WAL, and this one is dropped at commit.
+        """
+        await connection.execute("""
+            CREATE TEMPORARY TABLE catalog_staging (
+                line INT,
+                dataset_id VARCHAR(24),
+                resource_id UUID,
+                url VARCHAR,
+                harvest_modified_at TIMESTAMPTZ
+            ) ON COMMIT DROP
+        """)
+
+    @classmethod
+    async def merge_staging(cls, connection, dataset_ids: list[str] | None = None) -> Record:
+        """
+        Merge the "catalog_staging" table into the catalog in a single statement:
+        - upsert the resources whose values have changed (the last line of a resource wins)
+        - mark as deleted the resources missing from the staging table, among the resources of
+          dataset_ids if given, else among all resources
+        Return the number of inserted, updated and deleted resources.
+        """
+        await connection.execute("ANALYZE catalog_staging")
+        q = """
+            WITH upserted AS (
+                INSERT INTO catalog (
+                    dataset_id, resource_id, url, harvest_modified_at,
+                    deleted, priority, status
+                )
+                SELECT DISTINCT ON (resource_id)
+                    dataset_id, resource_id, url, harvest_modified_at, FALSE, FALSE, NULL
+                FROM catalog_staging
+                ORDER BY resource_id, line DESC
+                ON CONFLICT (resource_id) DO UPDATE SET
+                    dataset_id = excluded.dataset_id,
+                    url = excluded.url,
+                    deleted = FALSE
+                WHERE catalog.dataset_id IS DISTINCT FROM excluded.dataset_id
+                    OR catalog.url IS DISTINCT FROM excluded.url
+                    OR catalog.deleted
+                RETURNING xmax = 0 AS inserted
+            ), deleted AS (
+                UPDATE catalog SET deleted = TRUE
+                WHERE deleted = FALSE
+                AND ($1::varchar[] IS NULL OR dataset_id = ANY($1::varchar[]))
+                AND NOT EXISTS (
+                    SELECT 1 FROM catalog_staging
+                    WHERE catalog_staging.resource_id = catalog.resource_id
+                )
+                RETURNING id
+            )
+            SELECT
+                count(*) FILTER (WHERE inserted) AS inserted,
+                count(*) FILTER (WHERE NOT inserted) AS updated,
+                (SELECT count(*) FROM deleted) AS deleted
+            FROM upserted
+        """
+        return await connection.fetchrow(q, dataset_ids)
+
     @classmethod
     async def update(cls, resource_id: str, data: dict) -> Record:
         """Update a resource in DB with new data and return the updated resource in DB"""
-        columns = data.keys()
-        # $1, $2...
-        placeholders = [f"${x + 1}" for x in range(len(data.values()))]
-        set_clause = ",".join([f"{c} = {v}" for c, v in zip(columns, placeholders)])
+        if "status" in data:
+            # this status supersedes any buffered transition for this resource
+            cls.pending_statuses.pop(str(resource_id), None)
+        q = build_update_query("catalog", tuple(data.keys()), key="resource_id")
         pool = await context.pool()
         async with pool.acquire() as connection:
-            q = f"""
-                    UPDATE catalog
-                    SET {set_clause}
-                    WHERE resource_id = ${len(placeholders) + 1}
-                    RETURNING *;"""
-            return await connection.fetchrow(q, *data.values(), resource_id)
+            return await queries.fetchrow(connection, q, *data.values(), resource_id)
+
+    @classmethod
+    async def set_status(
+        cls,
+        resource_id: str,
+        status: str | None,
+        priority: bool | None = None,
+        flush: bool = False,
+    ) -> None:
+        """Buffer a status transition for a resource, without fetching the updated resource.
+        Transitions are coalesced by resource and written by flush_statuses, either by the first
+        transition buffered STATUS_FLUSH_INTERVAL seconds after the previous flush, or right away
+        if flush is True (e.g. before handing the resource over to another worker).
+        There is no timer: the crawler batches and the analysis jobs flush the transitions left
+        when they end, so that no process keeps buffered transitions while idle.
+
+        Args:
+            resource_id: the resource to update.
+            status: the new status of the resource.
+            priority: the new priority of the resource, if it should be changed.
+            flush: write all the pending transitions in DB right away.
+        """
+        if status not in cls.STATUSES.keys():
+            raise ValueError(f"Invalid status: {status}")
+
+        resource_id = str(resource_id)
+        if priority is None and resource_id in cls.pending_statuses:
+            priority = cls.pending_statuses[resource_id][1]
+        cls.pending_statuses[resource_id] = (status, priority)
+
+        if flush or time.monotonic() - cls.last_statuses_flush >= config.STATUS_FLUSH_INTERVAL:
+            await cls.flush_statuses()
+
+    @classmethod
+    async def flush_statuses(cls) -> None:
+        """Write all the buffered status transitions in DB with a single query.
+        If the write fails, the transitions are buffered again, behind the ones buffered since."""
+        cls.last_statuses_flush = time.monotonic()
+        if not cls.pending_statuses:
+            return
+        pending, cls.pending_statuses = cls.pending_statuses, {}
+        try:
+            pool = await context.pool()
+            async with pool.acquire() as connection:
+                q = """
+                        UPDATE catalog
+                        SET status = v.status, priority = COALESCE(v.priority, catalog.priority)
+                        FROM unnest($1::uuid[], $2::varchar[], $3::boolean[])
+                            AS v(resource_id, status, priority)
+                        WHERE catalog.resource_id = v.resource_id;"""
+                await queries.execute(
+                    connection,
+                    q,
+                    list(pending.keys()),
+                    [status for status, _ in pending.values()],
+                    [priority for _, priority in pending.values()],
+                )
+        except Exception:
+            for resource_id, (status, priority) in pending.items():
+                if resource_id not in cls.pending_statuses:
+                    cls.pending_statuses[resource_id] = (status, priority)
+                elif cls.pending_statuses[resource_id][1] is None:
+                    # a newer status supersedes this one, but not its priority
+                    cls.pending_statuses[resource_id] = (
+                        cls.pending_statuses[resource_id][0],
+                        priority,
+                    )
+            raise
 
     @classmethod
     async def update_or_insert(
@@ -110,8 +246,8 @@ class Resource:
         pool = await context.pool()
         async with pool.acquire() as connection:
             # Mark resource as deleted in catalog table
-            q = f"""UPDATE catalog SET deleted = TRUE WHERE resource_id = '{resource_id}';"""
-            await connection.execute(q)
+            q = """UPDATE catalog SET deleted = TRUE WHERE resource_id = $1;"""
+            await queries.execute(connection, q, resource_id)
 
     @staticmethod
     def get_excluded_clause() -> str:
@@ -1,5 +1,3 @@
-import json
-
 from asyncpg import Record
 
 from udata_hydra import context
@@ -37,11 +35,13 @@ class ResourceException:
         resource_id: str,
         table_indexes: dict[str, str] | None = None,
         comment: str | None = None,
+        profile: bool = False,
     ) -> Record:
         """
         Insert a new resource_exception
         table_indexes is a JSON object of column names and index types
         e.g. {"siren": "unique", "code_postal": "index"}
+        profile is whether to profile the analyses of the resource
         """
         pool = await context.pool()
 
@@ -59,11 +59,11 @@ class ResourceException:
 
         async with pool.acquire() as connection:
             q = """
-                INSERT INTO resources_exceptions (resource_id, table_indexes, comment)
-                VALUES ($1, $2, $3)
+                INSERT INTO resources_exceptions (resource_id, table_indexes, comment, profile)
+                VALUES ($1, $2, $3, $4)
                 RETURNING *;
             """
-            return await connection.fetchrow(q, resource_id, json.dumps(table_indexes), comment)
+            return await connection.fetchrow(q, resource_id, table_indexes, comment, profile)
 
     @classmethod
     async def update(
@@ -71,11 +71,13 @@ class ResourceException:
         resource_id: str,
         table_indexes: dict[str, str] | None = None,
         comment: str | None = None,
+        profile: bool = False,
     ) -> Record:
         """
         Update a resource_exception
         table_indexes is a JSON object of column names and index types
         e.g. {"siren": "unique", "code_postal": "index"}
+        profile is whether to profile the analyses of the resource
         """
         pool = await context.pool()
 
@@ -94,11 +96,11 @@ class ResourceException:
         async with pool.acquire() as connection:
             q = """
                 UPDATE resources_exceptions
-                SET table_indexes = $2, comment = $3
+                SET table_indexes = $2, comment = $3, profile = $4
                 WHERE resource_id = $1
                 RETURNING *;
             """
-            return await connection.fetchrow(q, resource_id, json.dumps(table_indexes), comment)
+            return await connection.fetchrow(q, resource_id, table_indexes, comment, profile)
 
     @classmethod
     async def delete(cls, resource_id: str) -> None:
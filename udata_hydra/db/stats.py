@@ -0,0 +1,201 @@
+import asyncio
+from datetime import datetime, timezone
+
+from udata_hydra import config, context
+from udata_hydra.db.resource import Resource
+
+
+async def compute_crawler_status(connection) -> dict:
+    """Count the resources to check and their checks freshness, in a single scan of the catalog"""
+    now = datetime.now(timezone.utc)
+    q = f"""
+        SELECT
+            count(*) FILTER (WHERE catalog.last_check IS NULL) AS count_never_checked,
+            count(*) FILTER (WHERE catalog.last_check IS NOT NULL) AS count_checked,
+            count(*) FILTER (WHERE checks.next_check_at <= $1) AS count_outdated
+        FROM catalog LEFT JOIN checks ON catalog.last_check = checks.id
+            AND catalog.last_check_at = checks.created_at
+        WHERE {Resource.get_excluded_clause()}
+    """
+    stats_resources = await connection.fetchrow(q, now)
+
+    count_pending_checks: int = (
+        stats_resources["count_never_checked"] + stats_resources["count_outdated"]
+    )
+    # all w/ a check, minus those with an outdated checked
+    count_fresh_checks: int = stats_resources["count_checked"] - stats_resources["count_outdated"]
+    total: int = stats_resources["count_never_checked"] + stats_resources["count_checked"]
+
+    q = """
+        SELECT COALESCE(status, 'null') AS status, COUNT(*) AS count
+        FROM catalog
+        GROUP BY COALESCE(status, 'null');
+    """
+    status_counts: dict = {status or "null": 0 for status in Resource.STATUSES}
+    status_counts["null"] = 0
+    for row in await connection.fetch(q):
+        status_counts[row["status"]] = row["count"]
+
+    return {
+        "total": total,
+        "pending_checks": count_pending_checks,
+        "fresh_checks": count_fresh_checks,
+        "checks_percentage": round(stats_resources["count_checked"] / total * 100, 1)
+        if total
+        else 0.0,
+        "fresh_checks_percentage": round(count_fresh_checks / total * 100, 1) if total else 0.0,
+        "resources_statuses_count": status_counts,
+    }
+
+
+async def compute_checks_stats(connection) -> dict:
+    """Count the last checks of resources by outcome and by HTTP status"""
+    q = f"""
+        SELECT
+            count(*) AS count_checked,
+            count(*) FILTER (WHERE error IS NULL AND timeout = False) AS count_ok,
+            count(*) FILTER (WHERE error IS NOT NULL) AS count_error,
+            count(*) FILTER (WHERE timeout = True) AS count_timeout
+        FROM catalog JOIN checks ON catalog.last_check = checks.id
+            AND catalog.last_check_at = checks.created_at
+        WHERE {Resource.get_excluded_clause()}
+    """
+    stats_status = await connection.fetchrow(q)
+
+    def cmp_rate(key: str) -> float | int:
+        if stats_status["count_checked"] == 0:
+            return 0
+        return round(stats_status[key] / stats_status["count_checked"] * 100, 1)
+
+    q = f"""
+        SELECT checks.status, count(*) as count FROM checks, catalog
+        WHERE catalog.last_check = checks.id AND catalog.last_check_at = checks.created_at
+        AND checks.status IS NOT NULL
+        AND {Resource.get_excluded_clause()}
+        GROUP BY checks.status
+        ORDER BY count DESC;
+    """
+    res = await connection.fetch(q)
+
+    return {
+        "status": sorted(
+            [
+                {
+                    "label": s,
+                    "count": stats_status[f"count_{s}"],
+                    "percentage": cmp_rate(f"count_{s}"),
+                }
+                for s in ["error", "timeout", "ok"]
+            ],
+            key=lambda x: x["count"],
+            reverse=True,
+        ),
+        "status_codes": [
+            {
+                "code": r["status"],
+                "count": r["count"],
+                "percentage": round(r["count"] / sum(r["count"] for r in res) * 100, 1),
+            }
+            for r in res
+        ],
+    }
+
+
+async def compute_analysis_stats(connection) -> dict:
+    """Quantiles of the wall and CPU times of the analyses stages of the latest checks,
+    with the rows and bytes they processed, by analysis and stage"""
+    q = """
+        SELECT
+            timers.name AS analysis,
+            stages.name AS stage,
+            count(*) AS count,
+            percentile_cont(ARRAY[0.5, 0.95, 0.99])
+                WITHIN GROUP (ORDER BY (stages.timings->>'wall')::float) AS wall,
+            percentile_cont(ARRAY[0.5, 0.95, 0.99])
+                WITHIN GROUP (ORDER BY (stages.timings->>'cpu')::float) AS cpu,
+            sum((stages.timings->>'rows')::bigint)::bigint AS rows,
+            sum((stages.timings->>'bytes')::bigint)::bigint AS bytes
+        FROM checks,
+            jsonb_each(checks.analysis_timings) AS timers(name, stages),
+            jsonb_each(timers.stages) AS stages(name, timings)
+        WHERE checks.analysis_timings IS NOT NULL
+        AND checks.created_at >= NOW() - make_interval(days => $1)
+        GROUP BY timers.name, stages.name
+        ORDER BY timers.name, stages.name
+    """
+    res: dict = {}
+    for r in await connection.fetch(q, config.STATS_ANALYSIS_DAYS):
+        res.setdefault(r["analysis"], {})[r["stage"]] = {
+            "count": r["count"],
+            **{
+                measure: {
+                    f"p{int(quantile * 100)}": round(value, 4)
+                    for quantile, value in zip((0.5, 0.95, 0.99), r[measure])
+                }
+                for measure in ("wall", "cpu")
+            },
+            "rows": r["rows"],
+            "bytes": r["bytes"],
+        }
+    return {"days": config.STATS_ANALYSIS_DAYS, "analyses": res}
+
+
+class Stats:
+    """Represents the snapshots of the crawler statistics in the "stats" DB table.
+    Snapshots are refreshed every STATS_REFRESH_INTERVAL seconds by the crawler, or on demand
+    when they are older than STATS_MAX_AGE seconds."""
+
+    COMPUTE = {
+        "crawler_status": compute_crawler_status,
+        "checks_stats": compute_checks_stats,
+        "analysis_stats": compute_analysis_stats,
+    }
+
+    # don't compute the same snapshot concurrently within a process
+    locks: dict[str, asyncio.Lock] = {}
+
+    @classmethod
+    async def get(cls, name: str) -> dict:
+        """Get the snapshot of the statistics name, with its computation date in "computed_at",
+        refreshing it if it's missing or outdated"""
+        pool = await context.pool()
+        async with pool.acquire() as connection:
+            q = "SELECT data, computed_at FROM stats WHERE name = $1"
+            snapshot = await connection.fetchrow(q, name)
+        if (
+            not snapshot
+            or (datetime.now(timezone.utc) - snapshot["computed_at"]).total_seconds()
+            > config.STATS_MAX_AGE
+        ):
+            return await cls.refresh(name, max_age=config.STATS_MAX_AGE)
+        return {**snapshot["data"], "computed_at": snapshot["computed_at"].isoformat()}
+
+    @classmethod
+    async def refresh(cls, name: str, max_age: float | None = None) -> dict:
+        """Compute and store the snapshot of the statistics name, unless it has been refreshed
+        less than max_age seconds ago in the meantime"""
+        async with cls.locks.setdefault(name, asyncio.Lock()):
+            pool = await context.pool()
+            async with pool.acquire() as connection:
+                if max_age is not None:
+                    q = """SELECT data, computed_at FROM stats
+                        WHERE name = $1 AND computed_at >= NOW() - make_interval(secs => $2)"""
+                    snapshot = await connection.fetchrow(q, name, max_age)
+                    if snapshot:
+                        return {
+                            **snapshot["data"],
+                            "computed_at": snapshot["computed_at"].isoformat(),
+                        }
+                data: dict = await cls.COMPUTE[name](connection)
+                q = """
+                    INSERT INTO stats (name, data, computed_at) VALUES ($1, $2, NOW())
+                    ON CONFLICT (name) DO UPDATE SET data = $2, computed_at = NOW()
+                    RETURNING computed_at
+                """
+                computed_at: datetime = await connection.fetchval(q, name, data)
+        return {**data, "computed_at": computed_at.isoformat()}
+
+    @classmethod
+    async def refresh_all(cls, max_age: float | None = None) -> None:
+        for name in cls.COMPUTE:
+            await cls.refresh(name, max_age=max_age)
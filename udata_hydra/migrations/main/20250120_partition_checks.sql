@@ -0,0 +1,76 @@
+-- Partition the `checks` table by month on `created_at`, so that outdated checks are dropped a whole partition
+-- at a time instead of being deleted row by row, and so that queries filtering on `created_at` only scan
+-- the relevant partitions.
+-- The existing table is not copied: it is attached as the partition of all the checks created until the end of
+-- the current month.
+-- This is an offline migration, to be run in a maintenance window:
+-- - stop the crawler, the workers and the API before running it, and drain the RQ queues beforehand if the jobs
+--   are not to be retried after the window;
+-- - like any migration, it runs in a single transaction, which takes an ACCESS EXCLUSIVE lock on `checks` (then
+--   `checks_legacy`) and on `catalog` at its first statements and holds it until its end: reads are blocked too;
+-- - the lock lasts as long as the whole migration, which is dominated by the work done on the existing checks:
+--   one pass to fill the missing `created_at`, one scan to set it NOT NULL, the build of the new primary key
+--   index (a sort of the whole table) and one more scan to validate the partition bounds on ATTACH. Expect
+--   roughly the time of a sequential scan of `checks` three times over plus a REINDEX of its primary key, i.e.
+--   proportional to the size of the table; time it on a restored dump of production to size the window;
+-- - the new partitions are empty, so the rest of the migration is immediate.
+
+-- `catalog.last_check` can't reference `checks.id` alone anymore, since the primary key includes `created_at`
+ALTER TABLE catalog DROP CONSTRAINT IF EXISTS fk_last_check;
+
+ALTER TABLE checks RENAME TO checks_legacy;
+-- the primary key of the partitioned table includes `created_at`, lookups by id still use its index
+ALTER TABLE checks_legacy DROP CONSTRAINT checks_pkey;
+ALTER INDEX IF EXISTS url_idx RENAME TO checks_legacy_url_idx;
+ALTER INDEX IF EXISTS domain_idx RENAME TO checks_legacy_domain_idx;
+ALTER INDEX IF EXISTS resource_id_idx RENAME TO checks_legacy_resource_id_idx;
+ALTER INDEX IF EXISTS created_at_idx RENAME TO checks_legacy_created_at_idx;
+
+CREATE TABLE checks (LIKE checks_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (created_at);
+ALTER TABLE checks ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE checks ADD PRIMARY KEY (id, created_at);
+ALTER SEQUENCE checks_id_seq OWNED BY checks.id;
+CREATE INDEX IF NOT EXISTS url_idx ON checks (url);
+CREATE INDEX IF NOT EXISTS domain_idx ON checks (domain);
+CREATE INDEX IF NOT EXISTS resource_id_idx ON checks (resource_id);
+CREATE INDEX IF NOT EXISTS created_at_idx ON checks (created_at);
+
+UPDATE checks_legacy SET created_at = to_timestamp(0) WHERE created_at IS NULL;
+ALTER TABLE checks_legacy ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE checks_legacy ADD CONSTRAINT checks_legacy_pkey PRIMARY KEY (id, created_at);
+
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE checks ATTACH PARTITION checks_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        (date_trunc('month', now() AT TIME ZONE 'UTC') + INTERVAL '1 month') AT TIME ZONE 'UTC'
+    );
+END $$;
+
+-- catches the checks of months whose partition hasn't been created in time, see `drain_checks_default`
+CREATE TABLE checks_default PARTITION OF checks DEFAULT;
+
+-- create the monthly partitions `checks_YYYY_MM` of `months` months from the month of `since`,
+-- skipping the months already covered by another partition
+CREATE OR REPLACE FUNCTION create_checks_partitions(since TIMESTAMPTZ, months INT) RETURNS VOID AS $$
+DECLARE
+    partition_start TIMESTAMP;
+BEGIN
+    FOR i IN 0..months - 1 LOOP
+        partition_start := date_trunc('month', since AT TIME ZONE 'UTC') + make_interval(months => i);
+        BEGIN
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF checks FOR VALUES FROM (%L) TO (%L)',
+                'checks_' || to_char(partition_start, 'YYYY_MM'),
+                partition_start AT TIME ZONE 'UTC',
+                (partition_start + INTERVAL '1 month') AT TIME ZONE 'UTC'
+            );
+        EXCEPTION WHEN invalid_object_definition OR check_violation THEN
+            -- overlaps another partition, or some checks of this month are already in the default partition
+            RAISE NOTICE 'Skipping partition of checks for %: %', to_char(partition_start, 'YYYY-MM'), SQLERRM;
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_checks_partitions(now(), 3);
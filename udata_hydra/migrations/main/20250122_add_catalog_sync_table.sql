@@ -0,0 +1,8 @@
+-- Add catalog_sync table, to keep the watermark of the incremental catalog synchronisation of each source:
+-- the last update date of the most recently updated dataset that has been synced
+
+CREATE TABLE IF NOT EXISTS catalog_sync (
+    source VARCHAR PRIMARY KEY,
+    watermark TIMESTAMPTZ NOT NULL,
+    synced_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,8 @@
+-- Add stats table, to keep the latest snapshot of each crawler statistics served by the API,
+-- instead of scanning the catalog and the checks on every request
+
+CREATE TABLE IF NOT EXISTS stats (
+    name VARCHAR PRIMARY KEY,
+    data JSONB NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
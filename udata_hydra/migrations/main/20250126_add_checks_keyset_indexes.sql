@@ -0,0 +1,6 @@
+-- Add indexes to paginate the checks of a resource or a URL, most recent first, with a keyset cursor on (created_at, id)
+
+CREATE INDEX IF NOT EXISTS resource_id_created_at_idx ON checks (resource_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS url_created_at_idx ON checks (url, created_at DESC, id DESC);
+DROP INDEX IF EXISTS resource_id_idx;
+DROP INDEX IF EXISTS url_idx;
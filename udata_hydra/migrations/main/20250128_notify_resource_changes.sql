@@ -0,0 +1,46 @@
+-- Notify the writes to a resource or to its checks on the `resource_changes` channel, with its resource_id as
+-- payload, so that the API invalidates its cached responses of this resource whichever process wrote it.
+-- Notifications are sent once per statement and on commit. A statement writing more than 100 resources
+-- (e.g. `load-catalog`, backfills) sends a single `*` notification, invalidating all the cached responses:
+-- each distinct notification of a transaction costs a lookup of the ones already queued before Postgres 13.
+
+CREATE OR REPLACE FUNCTION notify_resource_changes() RETURNS TRIGGER AS $$
+DECLARE
+    changed_ids TEXT[];
+    changed_id TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT resource_id::text) INTO changed_ids FROM old_rows;
+    ELSE
+        SELECT array_agg(DISTINCT resource_id::text) INTO changed_ids FROM new_rows;
+    END IF;
+    IF cardinality(changed_ids) > 100 THEN
+        PERFORM pg_notify('resource_changes', '*');
+    ELSIF changed_ids IS NOT NULL THEN
+        FOREACH changed_id IN ARRAY changed_ids LOOP
+            PERFORM pg_notify('resource_changes', changed_id);
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- a trigger with transition tables handles a single event
+DROP TRIGGER IF EXISTS catalog_notify_changes ON catalog;
+CREATE TRIGGER catalog_notify_changes
+    AFTER UPDATE ON catalog
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_resource_changes();
+
+DROP TRIGGER IF EXISTS catalog_notify_deletes ON catalog;
+CREATE TRIGGER catalog_notify_deletes
+    AFTER DELETE ON catalog
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_resource_changes();
+
+-- new checks always update `catalog.last_check`, only their analysis results are written afterwards
+DROP TRIGGER IF EXISTS checks_notify_changes ON checks;
+CREATE TRIGGER checks_notify_changes
+    AFTER UPDATE ON checks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_resource_changes();
@@ -0,0 +1,19 @@
+-- Add check_jobs table, to follow the checks requested through the API and run by the workers.
+-- Their ids are generated by the application, gen_random_uuid() needing Postgres 13.
+
+CREATE TABLE IF NOT EXISTS check_jobs (
+    id UUID PRIMARY KEY,
+    resource_id UUID NOT NULL,
+    force_analysis BOOLEAN NOT NULL DEFAULT TRUE,
+    status VARCHAR NOT NULL DEFAULT 'QUEUED',
+    check_id BIGINT,
+    result VARCHAR,
+    error VARCHAR,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS check_jobs_resource_id_idx ON check_jobs (resource_id, created_at DESC);
+-- at most one pending job by resource, the concurrent requests of a same resource sharing it
+CREATE UNIQUE INDEX IF NOT EXISTS check_jobs_pending_resource_id_idx
+    ON check_jobs (resource_id) WHERE status IN ('QUEUED', 'RUNNING');
@@ -0,0 +1,90 @@
+-- Add checks_rollups table, counting the checks by day and by dimension value (domain, status and content type),
+-- maintained by triggers on the checks table so that the aggregates of the API don't scan the checks.
+-- Counts are kept when outdated checks are purged: they're the history of the checks made each day.
+-- The checks without a value are counted under an empty value (NULL on read), which keeps the key unique before
+-- Postgres 15 and its UNIQUE NULLS NOT DISTINCT.
+-- The backfill counts all the existing checks while holding off their writes: run this migration while the crawler,
+-- the workers and the API are stopped.
+
+CREATE TABLE IF NOT EXISTS checks_rollups (
+    date DATE NOT NULL,
+    dimension VARCHAR NOT NULL,
+    value VARCHAR NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    CONSTRAINT checks_rollups_key UNIQUE (dimension, date, value)
+);
+
+-- count the checks inserted by a statement, the crawler flushing its buffered checks in bulk,
+-- keys being sorted so that concurrent transactions lock the rows they share in the same order
+CREATE OR REPLACE FUNCTION rollup_checks_insert() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO checks_rollups (date, dimension, value, count)
+    SELECT date, dimension, COALESCE(value, ''), count(*)
+    FROM new_checks,
+    LATERAL (VALUES
+        ('domain', new_checks.domain),
+        ('status', new_checks.status::VARCHAR),
+        ('content_type', new_checks.headers->>'content-type')
+    ) AS dimensions (dimension, value),
+    LATERAL (SELECT (new_checks.created_at AT TIME ZONE 'UTC')::DATE AS date) AS dates
+    GROUP BY 1, 2, 3
+    ORDER BY 1, 2, 3
+    ON CONFLICT (dimension, date, value) DO UPDATE SET count = checks_rollups.count + EXCLUDED.count;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- checks are mostly updated with their analysis results, which aren't counted: the trigger only fires on the
+-- updates of the counted columns, moving the check from its old values to its new ones.
+-- NB: `created_at` is never updated, an update moving a check to another partition would be a DELETE and an INSERT
+-- of the partitions, which are not counted.
+CREATE OR REPLACE FUNCTION rollup_checks_update() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO checks_rollups (date, dimension, value, count)
+    SELECT date, dimension, COALESCE(value, ''), sum(count)
+    FROM (VALUES
+        ((OLD.created_at AT TIME ZONE 'UTC')::DATE, 'domain', OLD.domain, -1),
+        ((OLD.created_at AT TIME ZONE 'UTC')::DATE, 'status', OLD.status::VARCHAR, -1),
+        ((OLD.created_at AT TIME ZONE 'UTC')::DATE, 'content_type', OLD.headers->>'content-type', -1),
+        ((NEW.created_at AT TIME ZONE 'UTC')::DATE, 'domain', NEW.domain, 1),
+        ((NEW.created_at AT TIME ZONE 'UTC')::DATE, 'status', NEW.status::VARCHAR, 1),
+        ((NEW.created_at AT TIME ZONE 'UTC')::DATE, 'content_type', NEW.headers->>'content-type', 1)
+    ) AS changes (date, dimension, value, count)
+    GROUP BY 1, 2, 3
+    HAVING sum(count) != 0
+    ORDER BY 1, 2, 3
+    ON CONFLICT (dimension, date, value) DO UPDATE SET count = checks_rollups.count + EXCLUDED.count;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- backfill from the existing checks, before counting the new ones
+LOCK TABLE checks IN SHARE MODE;
+INSERT INTO checks_rollups (date, dimension, value, count)
+SELECT (created_at AT TIME ZONE 'UTC')::DATE AS date, dimension, COALESCE(value, ''), count(*)
+FROM checks,
+LATERAL (VALUES
+    ('domain', checks.domain),
+    ('status', checks.status::VARCHAR),
+    ('content_type', checks.headers->>'content-type')
+) AS dimensions (dimension, value)
+GROUP BY 1, 2, 3
+ON CONFLICT (dimension, date, value) DO NOTHING;
+
+DROP TRIGGER IF EXISTS checks_rollup_insert ON checks;
+CREATE TRIGGER checks_rollup_insert
+    AFTER INSERT ON checks
+    REFERENCING NEW TABLE AS new_checks
+    FOR EACH STATEMENT EXECUTE FUNCTION rollup_checks_insert();
+
+DROP TRIGGER IF EXISTS checks_rollup_update ON checks;
+CREATE TRIGGER checks_rollup_update
+    AFTER UPDATE ON checks
+    FOR EACH ROW
+    WHEN (
+        OLD.created_at IS DISTINCT FROM NEW.created_at
+        OR OLD.domain IS DISTINCT FROM NEW.domain
+        OR OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.headers->>'content-type' IS DISTINCT FROM NEW.headers->>'content-type'
+    )
+    EXECUTE FUNCTION rollup_checks_update();
@@ -0,0 +1,4 @@
+-- Add the breakdown of the analyses of a check by stage, along with an index to aggregate the latest ones
+
+ALTER TABLE checks ADD COLUMN IF NOT EXISTS analysis_timings JSONB;
+CREATE INDEX IF NOT EXISTS analysis_timings_created_at_idx ON checks (created_at) WHERE analysis_timings IS NOT NULL;
@@ -0,0 +1,4 @@
+-- Add a flag to profile the analyses of a resource exception, and the path of the profile of the analysis of a check
+
+ALTER TABLE resources_exceptions ADD COLUMN IF NOT EXISTS profile BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE checks ADD COLUMN IF NOT EXISTS analysis_profile VARCHAR;
@@ -0,0 +1,110 @@
+-- Maintenance of the partitioned `checks` table:
+-- - `catalog.last_check_at` holds the `created_at` of the last check of a resource, so that joining its last check
+--   on (id, created_at) only looks up the partition holding it instead of all the partitions;
+-- - deleting checks sets the `last_check` of their resources to NULL, as the former `fk_last_check` foreign key did;
+-- - the checks of a month caught by the default partition are moved to the partition of their month when it's
+--   created, see `drain_checks_default`.
+-- The backfill of `last_check_at` updates the whole catalog: run this migration while the crawler is stopped.
+
+ALTER TABLE catalog ADD COLUMN IF NOT EXISTS last_check_at TIMESTAMPTZ;
+
+UPDATE catalog SET last_check_at = checks.created_at
+FROM checks
+WHERE checks.id = catalog.last_check AND catalog.last_check_at IS DISTINCT FROM checks.created_at;
+
+-- keep `last_check_at` in sync when `last_check` is updated alone
+CREATE OR REPLACE FUNCTION catalog_set_last_check_at() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.last_check IS DISTINCT FROM OLD.last_check AND NEW.last_check_at IS NOT DISTINCT FROM OLD.last_check_at THEN
+        NEW.last_check_at := (SELECT created_at FROM checks WHERE id = NEW.last_check);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS catalog_set_last_check_at ON catalog;
+CREATE TRIGGER catalog_set_last_check_at
+    BEFORE UPDATE OF last_check ON catalog
+    FOR EACH ROW EXECUTE FUNCTION catalog_set_last_check_at();
+
+-- ON DELETE SET NULL of the former `fk_last_check`, once per statement.
+-- Partitions dropped as a whole don't fire it, their resources are updated beforehand (see `purge-checks`).
+CREATE OR REPLACE FUNCTION checks_unset_last_check() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE catalog SET last_check = NULL, last_check_at = NULL
+    FROM deleted_checks
+    WHERE catalog.last_check = deleted_checks.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS checks_unset_last_check ON checks;
+CREATE TRIGGER checks_unset_last_check
+    AFTER DELETE ON checks
+    REFERENCING OLD TABLE AS deleted_checks
+    FOR EACH STATEMENT EXECUTE FUNCTION checks_unset_last_check();
+
+-- create the partition `checks_YYYY_MM` of the month starting at `partition_start` (UTC), if it doesn't exist.
+-- The checks of this month caught by the default partition meanwhile are moved to it: they are deleted from
+-- the default partition itself, which doesn't fire the triggers of `checks`.
+CREATE OR REPLACE FUNCTION create_checks_partition(partition_start TIMESTAMP) RETURNS VOID AS $$
+DECLARE
+    partition_name TEXT := 'checks_' || to_char(partition_start, 'YYYY_MM');
+    lower_bound TIMESTAMPTZ := partition_start AT TIME ZONE 'UTC';
+    upper_bound TIMESTAMPTZ := (partition_start + INTERVAL '1 month') AT TIME ZONE 'UTC';
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    IF EXISTS (SELECT 1 FROM checks_default WHERE created_at >= lower_bound AND created_at < upper_bound) THEN
+        EXECUTE format('CREATE TABLE %I (LIKE checks INCLUDING DEFAULTS)', partition_name);
+        EXECUTE format(
+            'WITH moved AS (
+                DELETE FROM checks_default WHERE created_at >= %L AND created_at < %L RETURNING *
+            ) INSERT INTO %I SELECT * FROM moved',
+            lower_bound, upper_bound, partition_name
+        );
+        EXECUTE format(
+            'ALTER TABLE checks ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+            partition_name, lower_bound, upper_bound
+        );
+    ELSE
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF checks FOR VALUES FROM (%L) TO (%L)',
+            partition_name, lower_bound, upper_bound
+        );
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- create the monthly partitions of `months` months from the month of `since`,
+-- skipping the months already covered by another partition
+CREATE OR REPLACE FUNCTION create_checks_partitions(since TIMESTAMPTZ, months INT) RETURNS VOID AS $$
+DECLARE
+    partition_start TIMESTAMP;
+BEGIN
+    FOR i IN 0..months - 1 LOOP
+        partition_start := date_trunc('month', since AT TIME ZONE 'UTC') + make_interval(months => i);
+        BEGIN
+            PERFORM create_checks_partition(partition_start);
+        EXCEPTION WHEN invalid_object_definition THEN
+            -- overlaps another partition, e.g. the legacy one
+            RAISE NOTICE 'Skipping partition of checks for %: %', to_char(partition_start, 'YYYY-MM'), SQLERRM;
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- move all the checks of the default partition to the partitions of their months, so that it stays empty
+-- and that they are dropped along with their partitions once outdated
+CREATE OR REPLACE FUNCTION drain_checks_default() RETURNS VOID AS $$
+DECLARE
+    partition_start TIMESTAMP;
+BEGIN
+    FOR partition_start IN
+        SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') FROM checks_default
+    LOOP
+        PERFORM create_checks_partitions(partition_start AT TIME ZONE 'UTC', 1);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
@@ -5,8 +5,10 @@ from aiohttp import web
 from udata_hydra.routes.checks import (
     create_check,
     get_all_checks,
+    get_check_job,
     get_checks_aggregate,
     get_latest_check,
+    get_latest_checks,
 )
 from udata_hydra.routes.resources import (
     create_resource,
@@ -21,7 +23,14 @@ from udata_hydra.routes.resources_exceptions import (
     get_all_resources_exceptions,
     update_resource_exception,
 )
-from udata_hydra.routes.status import get_crawler_status, get_health, get_stats, get_worker_status
+from udata_hydra.routes.status import (
+    get_analysis_stats,
+    get_crawler_status,
+    get_health,
+    get_metrics,
+    get_stats,
+    get_worker_status,
+)
 
 
 def generate_routes(
@@ -50,9 +59,11 @@ def generate_routes(
 # Define the routes parameters
 routes_params = [
     (web.get, "/api/checks/latest", get_latest_check, "get-latest-check"),
+    (web.post, "/api/checks/latest", get_latest_checks, None),
     (web.get, "/api/checks/all", get_all_checks, None),
     (web.get, "/api/checks/aggregate", get_checks_aggregate, None),
     (web.post, "/api/checks", create_check, None),
+    (web.get, "/api/checks/jobs/{job_id}", get_check_job, "get-check-job"),
     # Routes for resources
     (web.get, "/api/resources/{resource_id}", get_resource, None),
     (web.get, "/api/resources/{resource_id}/status", get_resource_status, None),
@@ -63,7 +74,9 @@ routes_params = [
     (web.get, "/api/status/crawler", get_crawler_status, None),
     (web.get, "/api/status/worker", get_worker_status, None),
     (web.get, "/api/stats", get_stats, None),
+    (web.get, "/api/stats/analysis", get_analysis_stats, None),
     (web.get, "/api/health", get_health, None),
+    (web.get, "/api/metrics", get_metrics, None),
     # Routes for resources exceptions
     (web.get, "/api/resources-exceptions", get_all_resources_exceptions, None),
     (web.post, "/api/resources-exceptions", create_resource_exception, None),
@@ -1,16 +1,26 @@
+import asyncio
 import json
-from datetime import date
+import time
+import uuid
+from collections.abc import AsyncGenerator
+from datetime import date, datetime, timedelta, timezone
 
 import aiohttp
 from aiohttp import web
 from asyncpg import Record
 
 from udata_hydra import config, context
-from udata_hydra.crawl.check_resources import check_resource
+from udata_hydra.context import json_dumps
+from udata_hydra.crawl.check_resources import (
+    check_resource,
+    check_resource_job,
+    flush_pending_writes,
+)
 from udata_hydra.db.check import Check
+from udata_hydra.db.check_job import CheckJob
 from udata_hydra.db.resource import Resource
-from udata_hydra.schemas import CheckGroupBy, CheckSchema
-from udata_hydra.utils import get_request_params
+from udata_hydra.schemas import CheckGroupBy, CheckJobSchema, CheckSchema, serializer
+from udata_hydra.utils import get_request_params, queue
 
 
 async def get_latest_check(request: web.Request) -> web.Response:
@@ -22,48 +32,194 @@ async def get_latest_check(request: web.Request) -> web.Response:
     if data["deleted"]:
         raise web.HTTPGone()
 
-    return web.json_response(CheckSchema().dump(dict(data)))
+    return web.json_response(serializer(CheckSchema)(data), dumps=json_dumps)
 
 
-async def get_all_checks(request: web.Request) -> web.Response:
-    url, resource_id = get_request_params(request, params_names=["url", "resource_id"])
-    data: list | None = await Check.get_all(url, resource_id)
-    if not data:
-        raise web.HTTPNotFound()
+async def get_latest_checks(request: web.Request) -> web.Response:
+    """
+    Get the latest checks of many URLs or resource_ids at once, given as a JSON list in the
+    "urls" or "resource_ids" key of the payload.
+    Returns a mapping of each URL or resource_id, as given, to its latest check, or to null if there is none.
+    """
+    try:
+        payload: dict = await request.json()
+        key: str = "urls" if "urls" in payload else "resource_ids"
+        if not isinstance(payload[key], list):
+            raise ValueError(f"{key} must be a list")
+        values: list[str] = [str(v) for v in payload[key]]
+        # the values as looked up, e.g. the canonical form of the resource_ids
+        lookups: dict[str, str] = {
+            v: str(uuid.UUID(v)) if key == "resource_ids" else v for v in values
+        }
+    except Exception as err:
+        raise web.HTTPBadRequest(text=json.dumps({"error": str(err)}))
+    if len(values) > config.CHECKS_LATEST_MAX_ITEMS:
+        raise web.HTTPBadRequest(
+            text=json.dumps(
+                {"error": f"Too many {key}, at most {config.CHECKS_LATEST_MAX_ITEMS} per request"}
+            )
+        )
 
-    return web.json_response([CheckSchema().dump(dict(r)) for r in data])
+    column: str = "url" if key == "urls" else "resource_id"
+    records: list[Record] = await Check.get_latest_many(**{key: list(set(lookups.values()))})
+    dump_check = serializer(CheckSchema)
+    checks: dict = {str(r[column]): dump_check(r) for r in records}
+    return web.json_response({v: checks.get(lookups[v]) for v in values}, dumps=json_dumps)
 
 
-async def get_checks_aggregate(request: web.Request) -> web.Response:
-    created_at: str = request.query.get("created_at")
-    if not created_at:
+def parse_cursor(cursor: str) -> tuple[datetime, int]:
+    """Parse a keyset cursor "<created_at>,<id>" of the checks pagination"""
+    created_at, check_id = cursor.rsplit(",", 1)
+    return datetime.fromisoformat(created_at), int(check_id)
+
+
+async def get_all_checks(request: web.Request) -> web.StreamResponse:
+    """
+    Get the checks of a given URL or resource_id, most recent first, optionally created
+    between `since` and `until`.
+    With `page_size`, checks are paginated with a keyset cursor: the `Link` header holds the URL
+    of the next page, if any. Without it, all the checks are streamed from a server-side cursor.
+    Checks are written as a JSON array, or as newline delimited JSON with `format=ndjson`.
+    """
+    url, resource_id = get_request_params(request, params_names=["url", "resource_id"])
+    try:
+        since: datetime | None = (
+            datetime.fromisoformat(request.query["since"]) if "since" in request.query else None
+        )
+        until: datetime | None = (
+            datetime.fromisoformat(request.query["until"]) if "until" in request.query else None
+        )
+        before: tuple[datetime, int] | None = (
+            parse_cursor(request.query["cursor"]) if "cursor" in request.query else None
+        )
+        page_size: int | None = (
+            int(request.query["page_size"]) if "page_size" in request.query else None
+        )
+    except ValueError as err:
+        raise web.HTTPBadRequest(text=json.dumps({"error": str(err)}))
+    if page_size is not None and not 0 < page_size <= config.CHECKS_MAX_PAGE_SIZE:
         raise web.HTTPBadRequest(
-            text="Missing mandatory 'created_at' param. You can use created_at=today to filter on today checks."
+            text=json.dumps({"error": f"page_size must be in 1..{config.CHECKS_MAX_PAGE_SIZE}"})
         )
+    filters = dict(url=url, resource_id=resource_id, since=since, until=until, before=before)
 
-    if created_at == "today":
-        created_at_date: date = date.today()
+    headers: dict = {}
+    if page_size:
+        records: list[Record] = await Check.get_all(**filters, limit=page_size + 1)
+        if len(records) > page_size:
+            records = records[:page_size]
+            last: Record = records[-1]
+            next_url = request.url.update_query(
+                cursor=f"{last['created_at'].isoformat()},{last['check_id']}"
+            )
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        rows: AsyncGenerator[Record, None] = iter_records(records)
     else:
-        created_at_date: date = date.fromisoformat(created_at)
+        rows = Check.iter_all(**filters)
+
+    try:
+        # fetch the first check before answering, to tell if there is any
+        first: Record | None = await anext(rows, None)
+        if not first and not before:
+            raise web.HTTPNotFound()
+
+        ndjson: bool = request.query.get("format") == "ndjson"
+        response = web.StreamResponse(headers=headers)
+        response.content_type = "application/x-ndjson" if ndjson else "application/json"
+        await response.prepare(request)
+        dump_check = serializer(CheckSchema)
+        buffer = bytearray(b"" if ndjson else b"[")
+        count = 0
+        record: Record | None = first
+        while record:
+            row: bytes = json_dumps(dump_check(record)).encode()
+            if ndjson:
+                buffer += row + b"\n"
+            else:
+                buffer += (b"," if count else b"") + row
+            count += 1
+            # write the checks by chunks of the size of the cursor prefetch
+            if count % config.CHECKS_CURSOR_PREFETCH == 0:
+                await response.write(bytes(buffer))
+                buffer.clear()
+            record = await anext(rows, None)
+        if not ndjson:
+            buffer += b"]"
+        await response.write(bytes(buffer))
+        await response.write_eof()
+        return response
+    finally:
+        # release the DB connection of the cursor, even if the client went away
+        if not page_size:
+            await rows.aclose()
+
+
+async def iter_records(records: list[Record]) -> AsyncGenerator[Record, None]:
+    for record in records:
+        yield record
+
+
+def parse_date(value: str) -> date:
+    return date.today() if value == "today" else date.fromisoformat(value)
+
+
+async def get_checks_aggregate(request: web.Request) -> web.Response:
+    """
+    Count the checks created on a day (`created_at`) or from `since` to `until` (included, today by
+    default), by value of `group_by`: "domain", "status" or "content_type", most frequent first.
+    Dates are in format YYYY-MM-DD or "today". Counts come from the daily rollups of the checks.
+    """
+    try:
+        if "created_at" in request.query:
+            since = until = parse_date(request.query["created_at"])
+        elif "since" in request.query:
+            since = parse_date(request.query["since"])
+            until = parse_date(request.query.get("until", "today"))
+        else:
+            raise web.HTTPBadRequest(
+                text="Missing mandatory 'created_at' or 'since' param. You can use created_at=today to filter on today checks."
+            )
+        page_size: int = int(request.query.get("page_size", 20))
+    except ValueError as err:
+        raise web.HTTPBadRequest(text=json.dumps({"error": str(err)}))
+    if not 0 < page_size <= config.CHECKS_MAX_PAGE_SIZE:
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": f"page_size must be in 1..{config.CHECKS_MAX_PAGE_SIZE}"})
+        )
 
     column: str = request.query.get("group_by")
     if not column:
         raise web.HTTPBadRequest(text="Missing mandatory 'group_by' param.")
-    data: list | None = await Check.get_group_by_for_date(column, created_at_date)
+    # the content type used to be grouped by with the SQL expression of the column
+    dimension: str = "content_type" if column == "headers->>'content-type'" else column
+    if dimension not in Check.ROLLUP_DIMENSIONS:
+        raise web.HTTPBadRequest(
+            text=json.dumps(
+                {"error": f"group_by must be one of: {', '.join(Check.ROLLUP_DIMENSIONS)}"}
+            )
+        )
+
+    data: list[Record] = await Check.get_group_by_for_dates(dimension, since, until, page_size)
     if not data:
         raise web.HTTPNotFound()
 
-    return web.json_response([CheckGroupBy().dump(dict(r)) for r in data])
+    dump_group = serializer(CheckGroupBy)
+    return web.json_response([dump_group(r) for r in data], dumps=json_dumps)
 
 
 async def create_check(request: web.Request) -> web.Response:
-    """Create a new check"""
+    """Create a new check.
+    In async mode ("async" key of the payload, CHECKS_ASYNC by default), the check is run by a worker
+    and the response is a 202 with the check job to poll, also given by the Location header.
+    A check job still pending for the resource is returned instead of queuing another one.
+    """
 
     # Get resource_id from request
     try:
         payload: dict = await request.json()
         resource_id: str = payload["resource_id"]
         force_analysis: bool = payload.get("force_analysis", True)
+        run_async: bool = payload.get("async", config.CHECKS_ASYNC)
     except Exception as err:
         raise web.HTTPBadRequest(text=json.dumps({"error": str(err)}))
 
@@ -74,22 +230,89 @@ async def create_check(request: web.Request) -> web.Response:
     except Exception:
         raise web.HTTPNotFound(text=f"Couldn't find URL for resource {resource_id}")
 
+    if run_async:
+        job, created = await CheckJob.get_or_insert(
+            resource_id, force_analysis, timeout=context.queue_timeout("high")
+        )
+        if created:
+            try:
+                queue.enqueue(check_resource_job, str(job["id"]), _priority="high")
+            except Exception as e:
+                # not left pending, which would hold back the next requests of the resource
+                await CheckJob.update(
+                    str(job["id"]),
+                    {
+                        "status": "FAILED",
+                        "error": str(e),
+                        "finished_at": datetime.now(timezone.utc),
+                    },
+                )
+                raise
+        job_url = request.app.router["get-check-job"].url_for(job_id=str(job["id"]))
+        return web.json_response(
+            await dump_check_job(job),
+            status=202,
+            headers={"Location": str(job_url)},
+            dumps=json_dumps,
+        )
+
     context.monitor().set_status(f'Crawling url "{url}"...')
 
-    async with aiohttp.ClientSession(
-        timeout=None, headers={"user-agent": config.USER_AGENT}
-    ) as session:
-        status: str = await check_resource(
-            url=url,
-            resource=resource,
-            force_analysis=force_analysis,
-            session=session,
-            worker_priority="high",
-        )
-        context.monitor().refresh(status)
+    try:
+        async with aiohttp.ClientSession(
+            timeout=None, headers={"user-agent": config.USER_AGENT}
+        ) as session:
+            status: str = await check_resource(
+                url=url,
+                resource=resource,
+                force_analysis=force_analysis,
+                session=session,
+                worker_priority="high",
+                buffered=False,
+            )
+            context.monitor().refresh(status)
+    finally:
+        await flush_pending_writes()
 
     check: Record | None = await Check.get_latest(url, resource_id)
     if not check:
         raise web.HTTPBadRequest(text=f"Check not created, status: {status}")
 
-    return web.json_response(CheckSchema().dump(dict(check)), status=201)
+    return web.json_response(serializer(CheckSchema)(check), status=201, dumps=json_dumps)
+
+
+async def dump_check_job(job: Record) -> dict:
+    """Check job along with its check once it's done"""
+    data: dict = serializer(CheckJobSchema)(job)
+    check: Record | None = (
+        # with a margin for the clock skew between the hosts
+        await Check.get_with_resource(job["check_id"], since=job["created_at"] - timedelta(hours=1))
+        if job["check_id"]
+        else None
+    )
+    data["check"] = serializer(CheckSchema)(check) if check else None
+    return data
+
+
+async def get_check_job(request: web.Request) -> web.Response:
+    """
+    Get a check job created by POST /api/checks in async mode, with the latest check of its resource
+    once it's done.
+    With `wait`, long-poll the job: answer once it's finished or after `wait` seconds
+    (at most CHECK_JOBS_MAX_WAIT), whichever comes first.
+    """
+    try:
+        job_id = str(uuid.UUID(request.match_info["job_id"]))
+        wait: float = min(float(request.query.get("wait", 0)), config.CHECK_JOBS_MAX_WAIT)
+    except ValueError as err:
+        raise web.HTTPBadRequest(text=json.dumps({"error": str(err)}))
+
+    deadline: float = time.monotonic() + wait
+    job: Record | None = await CheckJob.get(job_id)
+    while job and job["status"] in ("QUEUED", "RUNNING") and time.monotonic() < deadline:
+        await asyncio.sleep(min(config.CHECK_JOBS_POLL_INTERVAL, deadline - time.monotonic()))
+        job = await CheckJob.get(job_id)
+    if not job:
+        raise web.HTTPNotFound()
+
+    return web.json_response(await dump_check_job(job), dumps=json_dumps)
@@ -5,8 +5,9 @@ from aiohttp import web
 from asyncpg import Record
 from marshmallow import ValidationError
 
+from udata_hydra.context import json_dumps
 from udata_hydra.db.resource import Resource
-from udata_hydra.schemas import ResourceDocumentSchema, ResourceSchema
+from udata_hydra.schemas import ResourceDocumentSchema, ResourceSchema, serializer
 
 
 async def get_resource(request: web.Request) -> web.Response:
@@ -24,7 +25,7 @@ async def get_resource(request: web.Request) -> web.Response:
     if not resource:
         raise web.HTTPNotFound()
 
-    return web.json_response(ResourceSchema().dump(dict(resource)))
+    return web.json_response(serializer(ResourceSchema)(resource), dumps=json_dumps)
 
 
 async def get_resource_status(request: web.Request) -> web.Response:
@@ -38,6 +38,8 @@ async def create_resource_exception(request: web.Request) -> web.Response:
         #       ...
         #    },
         comment: str | None = payload.get("comment")
+        # profile the analyses of the resource, to investigate the slow ones
+        profile: bool = bool(payload.get("profile", False))
     except Exception as err:
         raise web.HTTPBadRequest(text=json.dumps({"error": str(err)}))
 
@@ -46,6 +48,7 @@ async def create_resource_exception(request: web.Request) -> web.Response:
             resource_id=resource_id,
             table_indexes=table_indexes,
             comment=comment,
+            profile=profile,
         )
     except ValueError as err:
         raise web.HTTPBadRequest(text=f"Resource exception could not be created: {str(err)}")
@@ -72,6 +75,7 @@ async def update_resource_exception(request: web.Request) -> web.Response:
         payload = await request.json()
         table_indexes: dict[str, str] | None = payload.get("table_indexes")
         comment: str | None = payload.get("comment")
+        profile: bool = bool(payload.get("profile", False))
         if table_indexes:
             valid, error = ResourceExceptionSchema.are_table_indexes_valid(table_indexes)
             if not valid:
@@ -83,6 +87,7 @@ async def update_resource_exception(request: web.Request) -> web.Response:
         resource_id=resource_id,
         table_indexes=table_indexes,
         comment=comment,
+        profile=profile,
     )
 
     return web.json_response(ResourceExceptionSchema().dump(dict(resource_exception)))
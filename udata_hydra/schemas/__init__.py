@@ -1,4 +1,5 @@
 # ruff: noqa: F401
-from .check import CheckGroupBy, CheckSchema
+from .check import CheckGroupBy, CheckJobSchema, CheckSchema
 from .resource import ResourceDocumentSchema, ResourceSchema
 from .resource_exception import ResourceExceptionSchema
+from .serializer import serializer
@@ -1,5 +1,3 @@
-import json
-
 from marshmallow import Schema, fields
 
 
@@ -10,7 +8,7 @@ class CheckSchema(Schema):
     domain = fields.Str()
     created_at = fields.DateTime()
     check_status = fields.Integer(data_key="status")
-    headers = fields.Function(lambda obj: json.loads(obj["headers"]) if obj["headers"] else {})
+    headers = fields.Function(lambda obj: obj["headers"] or {})
     timeout = fields.Boolean()
     response_time = fields.Float()
     error = fields.Str()
@@ -24,6 +22,8 @@ class CheckSchema(Schema):
     parsing_table = fields.Str()
     parquet_url = fields.Str()
     parquet_size = fields.Integer()
+    analysis_timings = fields.Dict()
+    analysis_profile = fields.Str()
 
     def create(self, data):
         return self.load(data)
@@ -32,3 +32,16 @@ class CheckSchema(Schema):
 class CheckGroupBy(Schema):
     value = fields.Str()
     count = fields.Integer()
+
+
+class CheckJobSchema(Schema):
+    id = fields.UUID()
+    resource_id = fields.UUID()
+    force_analysis = fields.Boolean()
+    status = fields.Str()
+    check_id = fields.Integer()
+    result = fields.Str()
+    error = fields.Str()
+    created_at = fields.DateTime()
+    started_at = fields.DateTime()
+    finished_at = fields.DateTime()
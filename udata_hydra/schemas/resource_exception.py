@@ -1,3 +1,5 @@
+import json
+
 from marshmallow import Schema, fields
 
 from udata_hydra import config
@@ -6,8 +8,12 @@ from udata_hydra import config
 class ResourceExceptionSchema(Schema):
     id = fields.Str(required=True)
     resource_id = fields.Str(required=True)
-    table_indexes = fields.Str(allow_none=True)
+    # serialized as a string, as the API always did
+    table_indexes = fields.Function(
+        lambda obj: json.dumps(obj["table_indexes"]) if obj["table_indexes"] is not None else None
+    )
     comment = fields.Str(allow_none=True)
+    profile = fields.Boolean()
 
     @staticmethod
     def are_table_indexes_valid(table_indexes: dict[str, str]) -> tuple[bool, str | None]:
@@ -0,0 +1,71 @@
+from collections.abc import Callable, Mapping
+from functools import cache
+
+from marshmallow import Schema, fields, missing
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+
+# fields whose serialization of non-null values is a plain conversion,
+# UUID being a String field
+CONVERTERS: dict[type, Callable] = {
+    fields.UUID: str,
+    fields.String: str,
+    fields.Integer: int,
+    fields.Float: float,
+}
+
+
+def _converter(field: fields.Field) -> Callable | None:
+    """Fast serialization of the non-null values of field, or None if it can't be precompiled"""
+    if type(field) in CONVERTERS and not getattr(field, "as_string", False):
+        convert = CONVERTERS[type(field)]
+        if convert is str:
+            return lambda value: value.decode() if isinstance(value, bytes) else str(value)
+        return convert
+    if type(field) is fields.DateTime and (field.format or field.DEFAULT_FORMAT) in (
+        "iso",
+        "iso8601",
+    ):
+        return lambda value: value.isoformat()
+    if type(field) is fields.Boolean:
+        slow = field._serialize
+        return lambda value: value if value is True or value is False else slow(value, None, None)
+    if type(field) is fields.Nested and not field.many and not field.only and not field.exclude:
+        return serializer(type(field.schema))
+    return None
+
+
+@cache
+def serializer(schema_class: type[Schema]) -> Callable[[Mapping], dict]:
+    """
+    Serializer of the records of schema_class, dumping them exactly like schema_class().dump() does.
+    Fields and their conversions are resolved once for all, instead of going through marshmallow's
+    machinery for every field of every record, which is what the API mostly spends its time on
+    when answering with many checks. Fields which can't be precompiled (e.g. Function fields)
+    are still serialized by marshmallow.
+    """
+    schema = schema_class()
+    if schema._hooks.get(PRE_DUMP) or schema._hooks.get(POST_DUMP):
+        return schema.dump
+
+    compiled: list[tuple[str, str, str, Callable | None, fields.Field]] = []
+    for name, field in schema.dump_fields.items():
+        key: str = field.data_key if field.data_key is not None else name
+        attribute: str = field.attribute or name
+        convert: Callable | None = _converter(field) if field.dump_default is missing else None
+        compiled.append((key, name, attribute, convert, field))
+
+    def serialize(record: Mapping) -> dict:
+        data = {}
+        for key, name, attribute, convert, field in compiled:
+            if convert is None:
+                value = field.serialize(name, record, accessor=schema.get_attribute)
+                if value is not missing:
+                    data[key] = value
+                continue
+            value = record.get(attribute, missing)
+            if value is missing:
+                continue
+            data[key] = None if value is None else convert(value)
+        return data
+
+    return serialize
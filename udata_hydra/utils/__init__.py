@@ -1,9 +1,10 @@
 # ruff: noqa: F401
+from .artifacts import artifacts
 from .auth import token_auth_middleware
-from .csv import detect_tabular_from_headers
+from .csv import detect_tabular, detect_tabular_from_headers
 from .errors import IOException, ParseException, handle_parse_exception
 from .file import compute_checksum_from_file, download_resource, read_csv_gz
-from .http import get_request_params, is_valid_uri, send
+from .http import get_request_params, is_valid_uri, send, sender
 from .queue import enqueue
 from .reader import Reader, generate_dialect
 from .timer import Timer
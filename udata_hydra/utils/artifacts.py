@@ -0,0 +1,153 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from udata_hydra import config
+
+log = logging.getLogger("udata-hydra")
+
+
+class ArtifactCache:
+    """
+    Cache of the files downloaded for analysis, keyed by check id, in ARTIFACTS_CACHE_FOLDER.
+    The analysis jobs of a same check running on the same host (or sharing this folder) download
+    the file only once, as well as analyses run again from the CLI.
+    Files not used for ARTIFACTS_CACHE_TTL seconds expire, and the least recently used files are
+    evicted when the cache exceeds ARTIFACTS_CACHE_MAX_SIZE bytes. A max size of 0 disables the cache.
+
+    The steps of an analysis re-open its file by path: the analysis pins the key of its file, with a
+    hidden pin file so that the processes sharing the folder see it, and pinned files are neither
+    expired nor evicted until they're unpinned.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(config.ARTIFACTS_CACHE_MAX_SIZE)
+
+    def folder(self) -> Path:
+        folder = Path(
+            config.ARTIFACTS_CACHE_FOLDER or Path(tempfile.gettempdir()) / "udata-hydra-artifacts"
+        )
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder
+
+    def get(self, key: int | str | None) -> str | None:
+        """Path of the cached file of key if it hasn't expired, marking it as recently used"""
+        if not self.enabled or key is None:
+            return None
+        path: Path = self.folder() / str(key)
+        try:
+            expired: bool = time.time() - path.stat().st_mtime > config.ARTIFACTS_CACHE_TTL
+            if expired and path.name not in self.pinned():
+                path.unlink(missing_ok=True)
+                raise FileNotFoundError
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return str(path)
+
+    def put(self, key: int | str | None, file_path: str) -> str:
+        """Move file_path into the cache and return its new path, or file_path if it's not cached"""
+        if not self.enabled or key is None:
+            return file_path
+        path: Path = self.folder() / str(key)
+        # files being written are hidden from the eviction, then renamed atomically
+        writing_path: Path = path.with_name(f".{path.name}.{os.getpid()}")
+        shutil.move(file_path, writing_path)
+        os.replace(writing_path, path)
+        self.evict(keep=path)
+        return str(path)
+
+    def pin(self, key: int | str | None) -> Path | None:
+        """Pin the file of key, cached or about to be, until it's unpinned. Returns the pin to unpin"""
+        if not self.enabled or key is None:
+            return None
+        pin: Path = self.folder() / f".{key}.{os.getpid()}-{uuid.uuid4().hex}.pin"
+        pin.touch()
+        return pin
+
+    def unpin(self, pin: Path | None) -> None:
+        """Remove a pin, the file being marked as recently used"""
+        if pin is None:
+            return
+        pin.unlink(missing_ok=True)
+        try:
+            os.utime(pin.with_name(pin.name[1:].split(".")[0]))
+        except FileNotFoundError:
+            pass
+
+    def pinned(self) -> set[str]:
+        """Names of the pinned files. The pins older than the longest timeout of the jobs
+        are left by crashed processes, and removed"""
+        max_age: int = max(config.RQ_DEFAULT_TIMEOUT, *(config.QUEUES_TIMEOUT or {}).values())
+        now = time.time()
+        names: set[str] = set()
+        for entry in os.scandir(self.folder()):
+            if not (entry.name.startswith(".") and entry.name.endswith(".pin")):
+                continue
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    os.unlink(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            names.add(entry.name[1:].split(".")[0])
+        return names
+
+    def scan(self) -> list[tuple[str, os.stat_result]]:
+        """Stats of the cached files, by path, from the least recently used"""
+        files: dict[str, os.stat_result] = {}
+        for entry in os.scandir(self.folder()):
+            if entry.name.startswith("."):
+                continue
+            try:
+                files[entry.path] = entry.stat()
+            except FileNotFoundError:
+                # evicted by another process in the meantime
+                continue
+        return sorted(files.items(), key=lambda item: item[1].st_mtime)
+
+    def evict(self, keep: Path | None = None) -> None:
+        """Remove the expired files, then the least recently used ones until the cache fits
+        in ARTIFACTS_CACHE_MAX_SIZE, except the pinned ones"""
+        files = self.scan()
+        pinned: set[str] = self.pinned()
+        now = time.time()
+        total_size: int = sum(stat.st_size for _, stat in files)
+        for path, stat in files:
+            expired: bool = now - stat.st_mtime > config.ARTIFACTS_CACHE_TTL
+            if (keep and path == str(keep)) or Path(path).name in pinned:
+                continue
+            if not expired and total_size <= config.ARTIFACTS_CACHE_MAX_SIZE:
+                continue
+            Path(path).unlink(missing_ok=True)
+            total_size -= stat.st_size
+            self.evictions += 1
+            log.debug(f"Evicted {path} from the artifacts cache")
+
+    def stats(self) -> dict:
+        files = self.scan() if self.enabled else []
+        return {
+            "files": len(files),
+            "size": sum(stat.st_size for _, stat in files),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / (self.hits + self.misses), 3)
+            if self.hits + self.misses
+            else None,
+        }
+
+
+artifacts = ArtifactCache()
@@ -0,0 +1,306 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import Callable
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any
+
+import asyncpg
+from aiohttp import web
+from aiohttp.helpers import ETAG_ANY
+
+from udata_hydra import config
+
+log = logging.getLogger("udata-hydra")
+
+# Postgres channel on which the writes to the catalog and the checks are notified, by resource_id,
+# the writes to many resources at once being notified as "*"
+NOTIFY_CHANNEL = "resource_changes"
+# seconds between two checks of the connection listening to NOTIFY_CHANNEL, and between two attempts
+# to connect it again once lost
+LISTENER_CHECK_INTERVAL = 10
+LISTENER_APPLICATION_NAME = "udata-hydra-cache-listener"
+# fields of the checks from which the Last-Modified header of the responses holding them is derived
+LAST_MODIFIED_FIELDS = ("created_at", "parsing_started_at", "parsing_finished_at")
+# fields of the checks written after their creation, from which along with their id the ETag of the
+# responses holding them is derived (the stages of analysis_timings being written one by one)
+CHECK_VERSION_FIELDS = LAST_MODIFIED_FIELDS + ("next_check_at", "analysis_profile")
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(q * len(values)), len(values) - 1)], 2)
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of the responses of the read endpoints, keyed by route and query params.
+    Each route is cached for its own TTL in seconds from API_CACHE_TTL, routes not listed there are
+    not cached. Entries are tagged with the resource_id they depend on, so that they are invalidated
+    as soon as the resource or its checks are written, whether by the API itself or by the crawler
+    and the workers through Postgres notifications on NOTIFY_CHANNEL.
+    The cache is only used while it's listening to them, see listen.
+    """
+
+    def __init__(self) -> None:
+        self.listening = False
+        self.entries: OrderedDict[tuple, dict] = OrderedDict()
+        self.keys_by_tag: defaultdict[str, set[tuple]] = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+        # latest response times in ms, of the hits and of the misses
+        self.latencies: dict[str, deque] = {
+            "hit": deque(maxlen=1000),
+            "miss": deque(maxlen=1000),
+        }
+
+    @staticmethod
+    def get_ttl(request: web.Request) -> int:
+        route = request.match_info.route.resource
+        if request.method != "GET" or route is None:
+            return 0
+        return (config.API_CACHE_TTL or {}).get(route.canonical.rstrip("/"), 0)
+
+    @staticmethod
+    def get_key(request: web.Request) -> tuple:
+        route = request.match_info.route.resource
+        return (
+            route.canonical.rstrip("/") if route else request.path,
+            tuple(sorted(request.match_info.items())),
+            tuple(sorted(request.query.items())),
+        )
+
+    def get(self, key: tuple) -> dict | None:
+        entry: dict | None = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] < time.monotonic():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key: tuple, entry: dict, tags: set[str]) -> None:
+        self.remove(key)
+        entry["tags"] = tags
+        self.entries[key] = entry
+        for tag in tags:
+            self.keys_by_tag[tag].add(key)
+        while len(self.entries) > config.API_CACHE_MAX_ENTRIES:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key: tuple) -> None:
+        entry: dict | None = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry["tags"]:
+            keys: set[tuple] = self.keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_tag[tag]
+
+    def invalidate(self, tag: str) -> None:
+        """Remove the entries depending on tag, e.g. a resource_id"""
+        for key in list(self.keys_by_tag.get(tag, ())):
+            self.remove(key)
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.keys_by_tag.clear()
+
+    def listener(self, connection, pid: int, channel: str, payload: str) -> None:
+        """asyncpg listener of NOTIFY_CHANNEL"""
+        if payload == "*":
+            self.clear()
+        else:
+            self.invalidate(payload)
+
+    async def listen(self) -> None:
+        """
+        Listen to NOTIFY_CHANNEL on a dedicated connection, since a listening connection can't go
+        back to the pool, until cancelled. The connection is checked every LISTENER_CHECK_INTERVAL
+        seconds and connected again once lost: the notifications sent meanwhile are missed,
+        so the cache is cleared and bypassed until it listens again.
+        """
+        while True:
+            try:
+                connection = await asyncpg.connect(
+                    dsn=config.DATABASE_URL,
+                    server_settings={
+                        "search_path": config.DATABASE_SCHEMA,
+                        "application_name": LISTENER_APPLICATION_NAME,
+                    },
+                )
+            except (OSError, asyncpg.PostgresError) as e:
+                log.warning(f"API cache can't listen to {NOTIFY_CHANNEL}: {e}")
+                await asyncio.sleep(LISTENER_CHECK_INTERVAL)
+                continue
+            try:
+                await connection.add_listener(NOTIFY_CHANNEL, self.listener)
+                self.listening = True
+                while not connection.is_closed():
+                    await asyncio.sleep(LISTENER_CHECK_INTERVAL)
+                    await connection.execute("SELECT 1", timeout=LISTENER_CHECK_INTERVAL)
+            except (OSError, TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                log.warning(f"API cache lost its connection listening to {NOTIFY_CHANNEL}: {e}")
+            finally:
+                self.listening = False
+                self.clear()
+                await connection.close(timeout=LISTENER_CHECK_INTERVAL)
+
+    def record(self, outcome: str, start: float) -> None:
+        self.latencies[outcome].append((time.monotonic() - start) * 1000)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / (self.hits + self.misses), 3)
+            if self.hits + self.misses
+            else None,
+            "latency_ms": {
+                outcome: {
+                    f"p{int(q * 100)}": _percentile(list(values), q) for q in (0.5, 0.95, 0.99)
+                }
+                for outcome, values in self.latencies.items()
+            },
+        }
+
+
+def _load(body: bytes | None) -> Any:
+    """JSON body of a request or a response, None if it has none"""
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+def _get_tags(request: web.Request, data: Any = None) -> set[str]:
+    """resource_ids a request or a response, of JSON body data, depends on"""
+    tags = {
+        str(value)
+        for value in (request.match_info.get("resource_id"), request.query.get("resource_id"))
+        if value
+    }
+    if isinstance(data, dict) and data.get("resource_id"):
+        tags.add(str(data["resource_id"]))
+    return tags
+
+
+def _get_etag(key: tuple, data: Any, body: bytes) -> str:
+    """
+    ETag of a response, derived from the version of what it holds rather than from its whole body:
+    the id, the write dates and the timed stages of a check, the status and the last modification
+    of a resource.
+    The other responses (e.g. the checks aggregates) fall back to a digest of their body.
+    """
+    version: tuple | None = None
+    if isinstance(data, dict) and "id" in data and "created_at" in data:
+        version = (
+            "check",
+            data["id"],
+            *(data.get(field) for field in CHECK_VERSION_FIELDS),
+            sorted(data.get("analysis_timings") or {}),
+        )
+    elif isinstance(data, dict) and "resource_id" in data and "status" in data:
+        document: dict = data.get("document") or {}
+        version = ("resource", data["resource_id"], data["status"], document.get("last_modified"))
+    digest = hashlib.md5(repr((key[0], version)).encode() if version else body)
+    return digest.hexdigest()
+
+
+def _get_last_modified(data: Any) -> str | None:
+    """Last-Modified header of a response holding a check, from its latest write dates"""
+    if not isinstance(data, dict):
+        return None
+    dates: list[datetime] = []
+    for field in LAST_MODIFIED_FIELDS:
+        try:
+            dates.append(datetime.fromisoformat(data[field]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return format_datetime(max(dates).astimezone(timezone.utc), usegmt=True) if dates else None
+
+
+def _is_not_modified(request: web.Request, etag: str) -> bool:
+    """Whether the client already has the version etag of the response, from its If-None-Match
+    entity tags, compared weakly as required for this header"""
+    return any(tag.value in (etag, ETAG_ANY) for tag in request.if_none_match or ())
+
+
+def _cached_response(request: web.Request, entry: dict) -> web.Response:
+    headers = {"ETag": f'"{entry["etag"]}"'}
+    if entry["last_modified"]:
+        headers["Last-Modified"] = entry["last_modified"]
+    if _is_not_modified(request, entry["etag"]):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=entry["body"], content_type=entry["content_type"], headers=headers)
+
+
+def response_cache_middleware() -> Callable:
+    """Serve the cached responses of the GET routes listed in API_CACHE_TTL from app["cache"],
+    answering 304 to the clients already having the current version (If-None-Match),
+    and invalidate the cached responses of a resource on the other requests writing it"""
+
+    @web.middleware
+    async def middleware(request, handler):
+        cache: ResponseCache | None = request.app.get("cache")
+        ttl: int = ResponseCache.get_ttl(request) if cache is not None and cache.listening else 0
+
+        if not ttl:
+            response = await handler(request)
+            if (
+                cache is not None
+                and request.method not in ("GET", "HEAD")
+                and response.status < 400
+            ):
+                body: bytes | None = await request.read() if request.can_read_body else None
+                for tag in _get_tags(request, _load(body)):
+                    cache.invalidate(tag)
+            return response
+
+        start = time.monotonic()
+        key: tuple = ResponseCache.get_key(request)
+        entry: dict | None = cache.get(key)
+        if entry is not None:
+            cache.hits += 1
+            response = _cached_response(request, entry)
+            cache.not_modified += response.status == 304
+            cache.record("hit", start)
+            return response
+
+        cache.misses += 1
+        response = await handler(request)
+        if response.status != 200 or not isinstance(getattr(response, "body", None), bytes):
+            cache.record("miss", start)
+            return response
+        data: Any = _load(response.body)
+        entry = {
+            "body": response.body,
+            "content_type": response.content_type,
+            "etag": _get_etag(key, data, response.body),
+            "last_modified": _get_last_modified(data),
+            "expires_at": time.monotonic() + ttl,
+        }
+        cache.set(key, entry, _get_tags(request, data))
+        response = _cached_response(request, entry)
+        cache.not_modified += response.status == 304
+        cache.record("miss", start)
+        return response
+
+    return middleware
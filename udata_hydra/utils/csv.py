@@ -1,4 +1,13 @@
-import json
+import csv as stdcsv
+import zlib
+
+import aiohttp
+import magic
+
+from udata_hydra import config, context
+
+# content types too generic to tell if a file is tabular or not, see sniff_tabular_from_content
+GENERIC_CONTENT_TYPES = ["application/octet-stream", "binary/octet-stream", "text/plain"]
 
 
 async def detect_tabular_from_headers(check: dict) -> tuple[bool, str]:
@@ -8,7 +17,7 @@ async def detect_tabular_from_headers(check: dict) -> tuple[bool, str]:
         - a csv.gz (1. is the file's content binary?, 2. does the URL contain "csv.gz"?)
         - a xls(x)
     """
-    headers: dict = json.loads(check["headers"] or "{}")
+    headers: dict = check["headers"] or {}
 
     if any(
         headers.get("content-type", "").lower().startswith(ct)
@@ -41,3 +50,94 @@ async def detect_tabular_from_headers(check: dict) -> tuple[bool, str]:
         return True, "xlsx"
 
     return False, "csv"
+
+
+async def detect_tabular(check: dict) -> tuple[bool, str]:
+    """
+    Determine if file looks tabular from its content-type header, or, when the content-type is
+    too generic (or missing) and SNIFF_TABULAR is on, from the first bytes of its content
+    """
+    is_tabular, file_format = await detect_tabular_from_headers(check)
+    content_type: str = ((check["headers"] or {}).get("content-type") or "").lower()
+    if (
+        config.SNIFF_TABULAR
+        and file_format != "csvgz"
+        and (not content_type or any(content_type.startswith(ct) for ct in GENERIC_CONTENT_TYPES))
+    ):
+        # a text/plain file is tabular from its headers, even with a single column
+        sniffed: tuple[bool, str] | None = await sniff_tabular_from_content(
+            check["url"], min_columns=1 if is_tabular else 2
+        )
+        if sniffed:
+            return sniffed
+    return is_tabular, file_format
+
+
+async def sniff_tabular_from_content(url: str, min_columns: int = 2) -> tuple[bool, str] | None:
+    """
+    Fetch the first SNIFF_SIZE bytes of a file with a Range request, aborting the response
+    if the server ignores the Range header, and determine if the file looks like:
+        - a csv, if it's text with a consistent CSV dialect of min_columns columns on its first lines
+        - a csv.gz, if it's gzipped and its decompressed first bytes look like a csv
+        - a xls(x), from its mime type
+    Returns None if the first bytes couldn't be fetched.
+    """
+    shared_session: aiohttp.ClientSession | None = context.http_session()
+    session = shared_session or aiohttp.ClientSession(headers={"user-agent": config.USER_AGENT})
+    prefix = b""
+    try:
+        async with session.get(
+            url,
+            headers={"Range": f"bytes=0-{config.SNIFF_SIZE - 1}"},
+            allow_redirects=True,
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as response:
+            if response.status not in (200, 206):
+                return None
+            async for chunk in response.content.iter_chunked(1024):
+                prefix += chunk
+                if len(prefix) >= config.SNIFF_SIZE:
+                    break
+    except (aiohttp.ClientError, TimeoutError):
+        return None
+    finally:
+        if not shared_session:
+            await session.close()
+    is_complete: bool = len(prefix) < config.SNIFF_SIZE
+    prefix = prefix[: config.SNIFF_SIZE]
+
+    mime_type: str = magic.from_buffer(prefix, mime=True)
+    if mime_type in ["application/x-gzip", "application/gzip"]:
+        try:
+            content: bytes = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(prefix)
+        except zlib.error:
+            return False, "csv"
+        return looks_like_csv(content, is_complete=False, min_columns=min_columns), "csvgz"
+    if mime_type == "application/vnd.ms-excel":
+        return True, "xls"
+    if mime_type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
+        return True, "xlsx"
+    if mime_type.startswith("text/"):
+        return looks_like_csv(prefix, is_complete=is_complete, min_columns=min_columns), "csv"
+    return False, "csv"
+
+
+def looks_like_csv(
+    content: bytes, is_complete: bool = True, nb_lines: int = 50, min_columns: int = 2
+) -> bool:
+    """Check if the first lines of content share a CSV dialect with at least min_columns columns.
+    The last line is left out when content is truncated. A single column has no delimiter
+    to sniff: with min_columns=1, lines without any dialect are taken as such a column."""
+    lines: list[str] = content.decode("utf-8", errors="replace").splitlines()
+    if not is_complete:
+        lines = lines[:-1]
+    lines = [line for line in lines[:nb_lines] if line.strip()]
+    if len(lines) < 2:
+        return False
+    try:
+        dialect = stdcsv.Sniffer().sniff("\n".join(lines), delimiters=",;\t|")
+    except stdcsv.Error:
+        return min_columns <= 1
+    widths: list[int] = [len(row) for row in stdcsv.reader(lines, dialect)]
+    # rows may have as many columns as the header, allowing for a few irregular ones
+    return widths[0] >= min_columns and widths.count(widths[0]) >= 0.8 * len(widths)
@@ -69,6 +69,7 @@ async def handle_parse_exception(e: ParseException, table_name: str, check: Reco
         await Check.update(
             check["id"],
             {"parsing_error": err, "parsing_finished_at": datetime.now(timezone.utc)},
+            created_at=check.get("created_at"),
         )
         log.error("Parsing error", exc_info=e)
     else:
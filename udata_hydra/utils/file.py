@@ -2,13 +2,14 @@ import gzip
 import hashlib
 import logging
 import tempfile
+import time
 from typing import IO
 
 import aiohttp
 import magic
 
-from udata_hydra import config
-from udata_hydra.utils import IOException
+from udata_hydra import config, context
+from udata_hydra.utils import IOException, metrics
 
 log = logging.getLogger("udata-hydra")
 
@@ -51,21 +52,26 @@ async def download_resource(
     chunk_size = 1024
     i = 0
     too_large, download_error = False, None
+    start = time.perf_counter()
+    # reuse the session of the async worker, if any
+    shared_session: aiohttp.ClientSession | None = context.http_session()
+    session = shared_session or aiohttp.ClientSession(headers={"user-agent": config.USER_AGENT})
     try:
-        async with aiohttp.ClientSession(
-            headers={"user-agent": config.USER_AGENT}, raise_for_status=True
-        ) as session:
-            async with session.get(url, allow_redirects=True) as response:
-                async for chunk in response.content.iter_chunked(chunk_size):
-                    if max_size_allowed is None or i * chunk_size < max_size_allowed:
-                        tmp_file.write(chunk)
-                    else:
-                        too_large = True
-                        break
-                    i += 1
+        async with session.get(url, allow_redirects=True, raise_for_status=True) as response:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                if max_size_allowed is None or i * chunk_size < max_size_allowed:
+                    tmp_file.write(chunk)
+                else:
+                    too_large = True
+                    break
+                i += 1
     except aiohttp.ClientResponseError as e:
         download_error = e
     finally:
+        if not shared_session:
+            await session.close()
+        metrics.DOWNLOAD_DURATION.observe(time.perf_counter() - start)
+        metrics.DOWNLOADED_BYTES.inc(tmp_file.tell())
         tmp_file.close()
         if too_large:
             raise IOException("File too large to download", url=url)
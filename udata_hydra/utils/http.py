@@ -1,12 +1,15 @@
+import asyncio
+import contextlib
 import json
 import logging
+import time
 from urllib.parse import urlparse
 
 import aiohttp
 from aiohttp import web
 
-from udata_hydra import config
-from udata_hydra.utils import IOException
+from udata_hydra import config, context
+from udata_hydra.utils import queue
 
 log = logging.getLogger("udata-hydra")
 
@@ -27,11 +30,97 @@ def get_request_params(request, params_names: list[str]) -> list:
     return data
 
 
+class UdataSender:
+    """
+    Coalesces the documents sent to the udata extras of resources: the documents of a same resource
+    pushed by the current process until the sender is flushed are merged into a single document.
+    Documents pushed by different processes are not merged: a resource checked by the crawler
+    and analysed by a worker still gets a document from each, and the jobs of an RQ worker, each
+    run in a forked process, only merge the documents they push themselves.
+    Flushing enqueues the pending documents in a single `send_documents` job, so that they are sent
+    by a worker rather than by the crawler or the API, and survive the process that pushed them.
+    Pending documents are flushed once SEND_COALESCE_WINDOW seconds have passed since the first one,
+    and must be flushed at the end of each job or crawler batch, including when it fails.
+    The counters are the ones of the current process too: `pushed`, `coalesced` and `enqueued` by
+    the processes pushing documents, `sent`, `retried` and `dropped` by the ones running the
+    `send_documents` jobs, which are lost with the forked processes of RQ workers.
+    """
+
+    def __init__(self) -> None:
+        # pending documents by resource_id: (dataset_id, document)
+        self.pending: dict[str, tuple[str, dict]] = {}
+        self.first_pending_at: float | None = None
+        self.counters = {
+            "pushed": 0,
+            "coalesced": 0,
+            "enqueued": 0,
+            "sent": 0,
+            "retried": 0,
+            "dropped": 0,
+        }
+        self.sending_time = 0.0
+
+    async def push(self, dataset_id: str, resource_id: str, document: dict) -> None:
+        self.counters["pushed"] += 1
+        resource_id = str(resource_id)
+        if resource_id in self.pending:
+            # later values of a same key win over the earlier ones
+            self.counters["coalesced"] += 1
+            document = {**self.pending[resource_id][1], **document}
+        self.pending[resource_id] = (dataset_id, dict(document))
+        if self.first_pending_at is None:
+            self.first_pending_at = time.monotonic()
+        elif time.monotonic() - self.first_pending_at >= config.SEND_COALESCE_WINDOW:
+            await self.flush()
+
+    async def flush(self) -> None:
+        self.first_pending_at = None
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        documents = [
+            (dataset_id, resource_id, document)
+            for resource_id, (dataset_id, document) in pending.items()
+        ]
+        try:
+            queue.enqueue(send_documents, documents, _priority="high")
+        except Exception:
+            # keep the documents for the next flush, merged with the ones pushed meanwhile
+            for resource_id, (dataset_id, document) in pending.items():
+                if resource_id in self.pending:
+                    document = {**document, **self.pending[resource_id][1]}
+                self.pending[resource_id] = (dataset_id, document)
+            raise
+        self.counters["enqueued"] += len(documents)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "pending": len(self.pending),
+            "sent_per_second": round(self.counters["sent"] / self.sending_time, 1)
+            if self.sending_time
+            else None,
+        }
+
+
+sender = UdataSender()
+
+
 async def send(dataset_id: str, resource_id: str, document: dict) -> None:
-    log.debug(
-        f"Sending payload to udata {dataset_id}/{resource_id}: {json.dumps(document, indent=4)}"
-    )
+    """Send a document to the udata extras of a resource, coalesced with the other documents of
+    the resource until the sender is flushed"""
+    await sender.push(dataset_id, resource_id, document)
 
+
+# statuses for which udata may accept the document later on
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+async def send_documents(documents: list[tuple[str, str, dict]]) -> None:
+    """
+    Job sending documents to the udata extras of their resources over a single session,
+    with at most SEND_CONCURRENCY requests at a time.
+    """
     if not config.WEBHOOK_ENABLED:
         log.debug("Webhook disabled, skipping send")
         return
@@ -40,22 +129,50 @@ async def send(dataset_id: str, resource_id: str, document: dict) -> None:
         log.error("UDATA_* config is not set, not sending callbacks")
         return
 
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(config.SEND_CONCURRENCY)
+    session: aiohttp.ClientSession | None = context.http_session()
+    async with (
+        aiohttp.ClientSession() if session is None else contextlib.nullcontext(session)
+    ) as session:
+
+        async def _send(dataset_id: str, resource_id: str, document: dict) -> None:
+            async with semaphore:
+                await send_with_retry(session, dataset_id, resource_id, document)
+
+        await asyncio.gather(*(_send(*document) for document in documents))
+    sender.sending_time += time.perf_counter() - start
+    log.debug(f"Sent {len(documents)} documents to udata: {sender.stats()}")
+
+
+async def send_with_retry(
+    session: aiohttp.ClientSession, dataset_id: str, resource_id: str, document: dict
+) -> None:
+    """Send a document to udata, retrying SEND_MAX_RETRIES times with an exponential backoff
+    when udata is unavailable"""
+    log.debug(
+        f"Sending payload to udata {dataset_id}/{resource_id}: {json.dumps(document, indent=4)}"
+    )
     uri = f"{config.UDATA_URI}/datasets/{dataset_id}/resources/{resource_id}/extras/"
-    headers = {
-        "content-type": "application/json",
-        "X-API-KEY": config.UDATA_URI_API_KEY,
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.put(uri, json=document, headers=headers) as resp:
-            # we're raising since we should be in a worker thread
-            if resp.status == 404:
-                pass
-            elif resp.status == 410:
-                raise IOException(
-                    "Resource has been deleted on udata", resource_id=resource_id, url=uri
-                )
-            if resp.status == 502:
-                raise IOException("Udata is unreachable", resource_id=resource_id, url=uri)
-            else:
-                resp.raise_for_status()
+    headers = {"content-type": "application/json", "X-API-KEY": config.UDATA_URI_API_KEY}
+    for attempt in range(config.SEND_MAX_RETRIES + 1):
+        if attempt:
+            sender.counters["retried"] += 1
+            await asyncio.sleep(config.SEND_RETRY_BACKOFF * 2 ** (attempt - 1))
+        try:
+            async with session.put(uri, json=document, headers=headers) as resp:
+                if resp.status in RETRY_STATUSES:
+                    error = f"udata responded with {resp.status}"
+                    continue
+                if resp.status == 410:
+                    error = "Resource has been deleted on udata"
+                elif resp.status >= 400:
+                    error = f"udata responded with {resp.status}"
+                else:
+                    sender.counters["sent"] += 1
+                    return
+                break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = f"udata is unreachable: {e}"
+    sender.counters["dropped"] += 1
+    log.error(f"Document for resource {resource_id} not sent to udata ({uri}): {error}")
@@ -0,0 +1,323 @@
+import asyncio
+import importlib
+import logging
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from typing import Any
+
+from aiohttp import web
+
+from udata_hydra import config
+
+log = logging.getLogger("udata-hydra")
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# label value of the series beyond METRICS_MAX_SERIES by metric, e.g. for the less crawled domains
+OVERFLOW_LABEL = "other"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric of the current process, made of a series by values of its labels, rendered in the
+    Prometheus text format. Updating a series is a dict lookup, cheap enough to instrument hot paths.
+    The number of series of a metric is capped by METRICS_MAX_SERIES, further label values being
+    counted together under OVERFLOW_LABEL.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.series: dict[tuple, Any] = {}
+        registry.register(self)
+
+    def key(self, labels: dict) -> tuple:
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        if key in self.series or len(self.series) < config.METRICS_MAX_SERIES:
+            return key
+        return tuple(OVERFLOW_LABEL for _ in self.labels)
+
+    def format_labels(self, key: tuple, extra: dict | None = None) -> str:
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+        pairs += [f'{label}="{_escape(value)}"' for label, value in (extra or {}).items()]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) of each sample"""
+        return [("", self.format_labels(key), value) for key, value in self.series.items()]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not config.METRICS_ENABLED:
+            return
+        key = self.key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A gauge set by the code, or computed at collection time by a function set with set_function,
+    returning either a value or a value by labels values tuple"""
+
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.function: Callable[[], float | dict[tuple, float]] | None = None
+
+    def set(self, value: float, **labels) -> None:
+        if not config.METRICS_ENABLED:
+            return
+        self.series[self.key(labels)] = value
+
+    def set_function(self, function: Callable[[], float | dict[tuple, float]]) -> None:
+        self.function = function
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        if self.function:
+            try:
+                values = self.function()
+            except Exception as e:
+                log.warning(f"Could not collect metric {self.name}: {e}")
+                return []
+            if not isinstance(values, dict):
+                values = {(): values}
+            self.series = {
+                tuple(str(v) for v in key): value
+                for key, value in values.items()
+                if value is not None
+            }
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        if not config.METRICS_ENABLED:
+            return
+        key = self.key(labels)
+        series = self.series.get(key)
+        if series is None:
+            # count by bucket (not cumulative), then sum and count
+            series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, **labels) -> "HistogramTimer":
+        """Context manager observing the seconds spent in its block"""
+        return HistogramTimer(self, labels)
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        samples = []
+        for key, series in self.series.items():
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulated += count
+                labels = self.format_labels(key, {"le": _format_value(float(bound))})
+                samples.append(("_bucket", labels, cumulated))
+            samples.append(("_sum", self.format_labels(key), series[-2]))
+            samples.append(("_count", self.format_labels(key), series[-1]))
+        return samples
+
+
+class HistogramTimer:
+    def __init__(self, histogram: Histogram, labels: dict) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "HistogramTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# stats of the queues by stat and queue, fetched from Redis by refresh_queues_stats
+_queues_stats: dict[str, dict[tuple, float]] = {"depth": {}, "wait": {}}
+_queues_stats_fetched_at: float = 0
+
+
+def _fetch_queues_stats() -> dict[str, dict[tuple, float]]:
+    # imported here since the queues depend on the whole app
+    from udata_hydra import context
+    from udata_hydra.utils.queue import get_oldest_wait_time
+    from udata_hydra.worker import ALL_QUEUES
+
+    stats: dict[str, dict[tuple, float]] = {"depth": {}, "wait": {}}
+    for q in ALL_QUEUES:
+        queue = context.queue(q)
+        if queue is None:
+            # no Redis while testing
+            continue
+        stats["depth"][(q,)] = len(queue)
+        stats["wait"][(q,)] = get_oldest_wait_time(queue)
+    return stats
+
+
+async def refresh_queues_stats() -> None:
+    """Fetch the stats of the queues in a thread, so that the Redis calls don't block the event loop,
+    at most once every METRICS_QUEUES_TTL seconds whatever the number of scrapes"""
+    global _queues_stats_fetched_at
+    if time.monotonic() - _queues_stats_fetched_at < config.METRICS_QUEUES_TTL:
+        return
+    _queues_stats_fetched_at = time.monotonic()
+    try:
+        _queues_stats.update(await asyncio.to_thread(_fetch_queues_stats))
+    except Exception as e:
+        log.warning(f"Could not collect the queues metrics: {e}")
+        _queues_stats.update(depth={}, wait={})
+
+
+def _pools_stats() -> dict[tuple, float]:
+    from udata_hydra import context
+
+    stats: dict = context.pools_stats()
+    return {
+        (stats["role"], db, state): p[state]
+        for db, p in stats["databases"].items()
+        for state in ("size", "idle")
+    }
+
+
+def _counters(module: str, name: str) -> Callable[[], dict[tuple, float]]:
+    def collect() -> dict[tuple, float]:
+        stats: dict = getattr(importlib.import_module(module), name).stats()
+        return {(k,): v for k, v in stats.items() if isinstance(v, (int, float))}
+
+    return collect
+
+
+# -- crawler -- #
+CHECK_DURATION = Histogram(
+    "hydra_check_duration_seconds", "Response time of the checked URLs", labels=("domain",)
+)
+CHECKS = Counter("hydra_checks_total", "Checks by result", labels=("result",))
+CHECK_RESPONSES = Counter(
+    "hydra_check_responses_total", "Checks by HTTP status of the response", labels=("status",)
+)
+BACKOFF_DECISIONS = Counter(
+    "hydra_backoff_decisions_total", "Domain backoff decisions of the crawler", labels=("decision",)
+)
+BATCHES = Counter("hydra_batches_total", "Batches of resources selected to be checked")
+BATCH_FILL_RATIO = Gauge(
+    "hydra_batch_fill_ratio", "Size of the last batch of resources to check, relative to BATCH_SIZE"
+)
+
+# -- jobs -- #
+QUEUE_DEPTH = Gauge("hydra_queue_depth", "Jobs waiting in each queue", labels=("queue",))
+QUEUE_DEPTH.set_function(lambda: _queues_stats["depth"])
+QUEUE_OLDEST_WAIT = Gauge(
+    "hydra_queue_oldest_wait_seconds", "Wait of the oldest job of each queue", labels=("queue",)
+)
+QUEUE_OLDEST_WAIT.set_function(lambda: _queues_stats["wait"])
+JOB_WAIT = Histogram("hydra_job_wait_seconds", "Time jobs waited in their queue", labels=("queue",))
+JOB_DURATION = Histogram(
+    "hydra_job_duration_seconds", "Run time of the jobs", labels=("queue", "status")
+)
+
+# -- analysis -- #
+DOWNLOADED_BYTES = Counter("hydra_download_bytes_total", "Bytes of the downloaded resources")
+DOWNLOAD_DURATION = Histogram("hydra_download_duration_seconds", "Download time of the resources")
+# observed by the Timer of the analyses
+ANALYSIS_STAGE_DURATION = Histogram(
+    "hydra_analysis_stage_duration_seconds", "Wall time of the analysis stages", labels=("stage",)
+)
+ANALYSIS_STAGE_CPU = Histogram(
+    "hydra_analysis_stage_cpu_seconds", "CPU time of the analysis stages", labels=("stage",)
+)
+ROWS_INGESTED = Counter("hydra_rows_ingested_total", "Rows of the analysed files copied to the DB")
+
+# -- DB and process -- #
+DB_QUERY_DURATION = Histogram(
+    "hydra_db_query_duration_seconds",
+    "Duration of the queries run through the query counter, by statement",
+    labels=("statement",),
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "hydra_db_pool_connections", "Connections of the DB pools", labels=("role", "db", "state")
+)
+DB_POOL_CONNECTIONS.set_function(_pools_stats)
+DB_QUERIES = Gauge("hydra_db_queries", "Counters of the queries run", labels=("counter",))
+DB_QUERIES.set_function(_counters("udata_hydra.db", "queries"))
+UDATA_SENDER = Gauge(
+    "hydra_udata_sender",
+    "Counters of the documents pushed to udata by this process, or sent by it for the async worker",
+    labels=("counter",),
+)
+UDATA_SENDER.set_function(_counters("udata_hydra.utils.http", "sender"))
+ARTIFACTS_CACHE = Gauge(
+    "hydra_artifacts_cache", "Counters of the downloaded files cache", labels=("counter",)
+)
+ARTIFACTS_CACHE.set_function(_counters("udata_hydra.utils.artifacts", "artifacts"))
+# set by the API, whose response cache belongs to its app
+API_CACHE = Gauge("hydra_api_cache", "Counters of the API response cache", labels=("counter",))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if config.METRICS_ENABLED:
+        await refresh_queues_stats()
+    return web.Response(
+        body=registry.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server(port: int | None) -> web.AppRunner | None:
+    """Serve the metrics of the current process on `port`/metrics, for the processes which are
+    not the API (crawler, workers). Returns the runner to clean up, or None if port is not set."""
+    if not port or not config.METRICS_ENABLED:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    log.info(f"Serving metrics on port {port}")
+    return runner
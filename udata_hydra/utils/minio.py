@@ -29,17 +29,20 @@ class MinIOClient:
         self,
         file_name,
         delete_source=True,
+        object_name: str | None = None,
     ) -> str:
+        """Upload a file to MINIO_FOLDER, as object_name if given, returning its URL"""
         if self.bucket is None:
             raise AttributeError("A bucket has to be specified.")
         if os.path.isfile(file_name):
+            object_name = object_name or file_name
             self.client.fput_object(
                 self.bucket,
-                f"{config.MINIO_FOLDER}/{file_name}",
+                f"{config.MINIO_FOLDER}/{object_name}",
                 file_name,
             )
             if delete_source:
                 os.remove(file_name)
-            return f"https://{self.url}/{self.bucket}/{config.MINIO_FOLDER}/{file_name}"
+            return f"https://{self.url}/{self.bucket}/{config.MINIO_FOLDER}/{object_name}"
         else:
             raise Exception(f"file '{file_name}' does not exists")
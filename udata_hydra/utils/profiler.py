@@ -0,0 +1,81 @@
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import tempfile
+from contextvars import Token
+from pathlib import Path
+
+from udata_hydra import config, context
+
+log = logging.getLogger("udata-hydra")
+
+# a process has a single profiler hook (sys.monitoring from Python 3.12, which refuses a second one,
+# per thread before, where the last one replaces the others): the profiled jobs take turns
+_lock = asyncio.Lock()
+
+
+class Profiler:
+    """
+    Opt-in profiler of an analysis, to investigate after the fact where the time of a slow one goes
+    (csv_detective, casting, COPY encoding, parquet...). The profile is dumped in PROFILES_FOLDER
+    as a pstats file, e.g. to be browsed with `python -m pstats` or snakeviz.
+
+    ```
+    profiler = Profiler()
+    if await profiler.start():
+        ...
+        path: str = profiler.stop(key=check_id)
+    ```
+
+    The profiler is deterministic (cProfile), which slows the analysis down: it's only meant for
+    the resources to investigate. Its CPU-bound steps run in the calling process to be profiled,
+    and the profile also holds the frames of the other jobs running meanwhile in the async worker.
+    A profiled job waits for the one being profiled in its process, if any, to be done.
+    """
+
+    def __init__(self) -> None:
+        self.profile = cProfile.Profile()
+        self.token: Token[bool] | None = None
+        self.enabled = False
+
+    @staticmethod
+    def folder() -> Path:
+        folder = Path(
+            config.PROFILES_FOLDER or Path(tempfile.gettempdir()) / "udata-hydra-profiles"
+        )
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder
+
+    async def start(self) -> bool:
+        """Start profiling once the other profiled jobs are done, returning whether it's profiling:
+        it isn't if another profiler is already active, e.g. one of the tooling running the process"""
+        await _lock.acquire()
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            _lock.release()
+            log.warning(f"Could not profile: {e}")
+            return False
+        self.enabled = True
+        self.token = context.profiling.set(True)
+        return True
+
+    def stop(self, key: int | str) -> str:
+        """Stop profiling and dump the profile as <key>.pstats, returning its path"""
+        if self.enabled:
+            self.profile.disable()
+            self.enabled = False
+            _lock.release()
+        if self.token is not None:
+            context.profiling.reset(self.token)
+            self.token = None
+        path: Path = self.folder() / f"{key}.pstats"
+        self.profile.dump_stats(path)
+        if log.isEnabledFor(logging.DEBUG):
+            summary = io.StringIO()
+            pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(20)
+            log.debug(summary.getvalue())
+        log.info(f"Profile of {key} dumped to {path}")
+        return str(path)
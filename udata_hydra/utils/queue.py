@@ -1,4 +1,9 @@
-from udata_hydra import context
+from datetime import datetime, timezone
+
+from rq import Queue
+from rq.job import Job
+
+from udata_hydra import config, context
 from udata_hydra.logger import setup_logging
 
 log = setup_logging()
@@ -14,3 +19,40 @@ def enqueue(fn, *args, **kwargs):
     """
     priority = kwargs.pop("_priority", "default")
     return context.queue(priority).enqueue(fn, *args, **kwargs)
+
+
+def get_analysis_queue(
+    size: int | str | None, file_format: str = "csv", priority: str = "default"
+) -> str:
+    """
+    Route an analysis job by its expected cost: files whose size, weighted by the cost of their format,
+    exceeds HEAVY_ANALYSIS_SIZE go to the "heavy" queue, the others to the queue of their priority.
+    Formats are weighted by the ratio of their MAX_FILESIZE_ALLOWED to the one of CSV files.
+    """
+    try:
+        size = int(size or 0)
+    except ValueError:
+        return priority
+    max_sizes: dict = config.MAX_FILESIZE_ALLOWED
+    weight: float = max_sizes["csv"] / max_sizes.get(file_format, max_sizes["csv"])
+    return "heavy" if size * weight >= config.HEAVY_ANALYSIS_SIZE else priority
+
+
+def get_wait_time(job: Job) -> float:
+    """Seconds a job has been waiting in its queue"""
+    if not job.enqueued_at:
+        return 0.0
+    enqueued_at: datetime = job.enqueued_at
+    if not enqueued_at.tzinfo:
+        # RQ < 2 stores naive UTC datetimes
+        enqueued_at = enqueued_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - enqueued_at).total_seconds()
+
+
+def get_oldest_wait_time(queue: Queue | None) -> float:
+    """Seconds the oldest job of a queue has been waiting, 0 if the queue is empty (or missing while testing)"""
+    if queue is None:
+        return 0.0
+    job_ids: list[str] = queue.get_job_ids(0, 1)
+    job: Job | None = queue.fetch_job(job_ids[0]) if job_ids else None
+    return round(get_wait_time(job), 1) if job else 0.0
@@ -1,32 +1,53 @@
 import logging
 import time
 
+from udata_hydra import context
+from udata_hydra.utils import metrics
+
 log = logging.getLogger("udata-hydra")
 
 
 class Timer:
     """
-    A simple Timer class for code execution time measurement as a debug log.
+    Timer of the stages of a process, e.g. an analysis, recording the wall time and the CPU time
+    of each stage, along with the rows and bytes it processed if given.
 
     ```
     timer = Timer("my-timer")
-    timer.mark("a-step")
-    timer.stop()
+    timer.mark("a-step", rows=1000, bytes=2048)
+    timings: dict = timer.stop()
     ```
-    """
 
-    steps = []
+    stop() returns the breakdown of the stages and their total, to be stored with the check.
+    The stages are also observed in the analysis metrics, which aggregate them into quantiles.
+    The CPU time is the one of the process, along with the one of the steps run in the pool
+    of processes of the async worker: concurrent jobs of the async worker share the former.
+    """
 
     def __init__(self, name: str) -> None:
         self.name = name
-        self.steps.append(time.perf_counter())
-
-    def mark(self, step: str) -> None:
-        t_mark = time.perf_counter()
-        t_delta = t_mark - self.steps[-1]
-        self.steps.append(t_mark)
-        log.debug(f"[{self.name}] {step} done in {t_delta:0.4f}s")
-
-    def stop(self) -> None:
-        t_delta = time.perf_counter() - self.steps[0]
-        log.debug(f"[{self.name}] Total time {t_delta:0.4f}s")
+        self.stages: dict[str, dict] = {}
+        self.start = self.last = self.clock()
+
+    @staticmethod
+    def clock() -> tuple[float, float]:
+        return time.perf_counter(), time.process_time() + context.offloaded_cpu_time.get()
+
+    def mark(self, step: str, rows: int | None = None, bytes: int | None = None) -> None:
+        now = self.clock()
+        stage = {"wall": round(now[0] - self.last[0], 4), "cpu": round(now[1] - self.last[1], 4)}
+        self.last = now
+        if rows is not None:
+            stage["rows"] = rows
+        if bytes is not None:
+            stage["bytes"] = bytes
+        self.stages[step] = stage
+        metrics.ANALYSIS_STAGE_DURATION.observe(stage["wall"], stage=step)
+        metrics.ANALYSIS_STAGE_CPU.observe(stage["cpu"], stage=step)
+        log.debug(f"[{self.name}] {step} done in {stage['wall']:0.4f}s (cpu {stage['cpu']:0.4f}s)")
+
+    def stop(self) -> dict[str, dict]:
+        now = self.clock()
+        total = {"wall": round(now[0] - self.start[0], 4), "cpu": round(now[1] - self.start[1], 4)}
+        log.debug(f"[{self.name}] Total time {total['wall']:0.4f}s (cpu {total['cpu']:0.4f}s)")
+        return {**self.stages, "total": total}
@@ -1,8 +1,183 @@
-from udata_hydra import config
+import asyncio
+import inspect
+import logging
+import signal
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+import redis
+from rq import Queue
+from rq.defaults import DEFAULT_RESULT_TTL
+from rq.exceptions import DequeueTimeout
+from rq.job import Job, JobStatus
+
+from udata_hydra import config, context
 from udata_hydra.logger import setup_logging
+from udata_hydra.utils import metrics, sender
+from udata_hydra.utils import queue as queue_utils
 
 setup_logging()
 
+log = logging.getLogger("udata-hydra")
+
 REDIS_URL = config.REDIS_URL
 
+# by order of priority, the queues consumed by `rq worker -c udata_hydra.worker`
 QUEUES = ["high", "default", "low"]
+# the lane of the analysis of big files, left out of QUEUES: a RQ worker only pops from a lower queue
+# once the higher ones are empty, so heavy jobs need RQ workers of their own to be run at all
+HEAVY_QUEUE = "heavy"
+# the queues consumed by the async worker, which bounds the concurrency of the heavy jobs instead
+ALL_QUEUES = QUEUES + [HEAVY_QUEUE]
+
+# jobs, failures, and total seconds waited in queue and run, by queue
+lanes_stats: defaultdict[str, dict] = defaultdict(
+    lambda: {"jobs": 0, "failed": 0, "wait_time": 0.0, "run_time": 0.0}
+)
+
+
+async def perform_job(job: Job, queue: Queue) -> None:
+    """Run a job in the current event loop, coroutine functions being awaited and
+    plain functions being run in a thread, and record its outcome in the queue registries.
+
+    The timeout of a job cancels its coroutine, but neither a plain function (a thread can't be
+    stopped) nor a CPU-bound step already running in the pool of processes: they run to completion.
+    Plain functions are thus only reported as having exceeded their timeout."""
+    wait_time: float = queue_utils.get_wait_time(job)
+    start = time.monotonic()
+    job.set_status(JobStatus.STARTED)
+    queue.started_job_registry.add(job, ttl=job.timeout or config.RQ_DEFAULT_TIMEOUT)
+    stats: dict = lanes_stats[queue.name]
+    stats["jobs"] += 1
+    stats["wait_time"] += wait_time
+    metrics.JOB_WAIT.observe(wait_time, queue=queue.name)
+    status = "finished"
+    try:
+        timeout: float | None = job.timeout if job.timeout and job.timeout > 0 else None
+        if inspect.iscoroutinefunction(job.func):
+            await asyncio.wait_for(job.func(*job.args, **job.kwargs), timeout=timeout)
+        else:
+            await asyncio.to_thread(job.func, *job.args, **job.kwargs)
+            if timeout and time.monotonic() - start > timeout:
+                log.warning(f"Job {job.id} ({job.func_name}) exceeded its timeout of {timeout}s")
+    except Exception:
+        log.exception(f"Job {job.id} ({job.func_name}) failed")
+        queue.started_job_registry.remove(job)
+        job.set_status(JobStatus.FAILED)
+        queue.failed_job_registry.add(job, exc_string=traceback.format_exc())
+        stats["failed"] += 1
+        status = "failed"
+    else:
+        queue.started_job_registry.remove(job)
+        job.set_status(JobStatus.FINISHED)
+        # like RQ workers, keep the jobs without a result_ttl of their own for the default one
+        ttl = DEFAULT_RESULT_TTL if job.result_ttl is None else job.result_ttl
+        queue.finished_job_registry.add(job, ttl=ttl)
+    finally:
+        run_time = time.monotonic() - start
+        stats["run_time"] += run_time
+        metrics.JOB_DURATION.observe(run_time, queue=queue.name, status=status)
+        log.info(
+            f"Job {job.id} ({job.func_name}) on {queue.name}: "
+            f"waited {wait_time:.1f}s, ran {run_time:.1f}s"
+        )
+
+
+async def start_worker(queues: list[str] = ALL_QUEUES, burst: bool = False) -> None:
+    """
+    Consume the jobs of queues, by order of priority, within a single event loop.
+    Unlike the RQ worker which forks a process with its own event loop and DB pools for each job,
+    up to WORKER_CONCURRENCY jobs run concurrently and share the DB pools and the HTTP sessions,
+    while their CPU-bound steps are run in a pool of WORKER_PROCESSES processes.
+    The jobs of a queue in WORKER_QUEUES_CONCURRENCY are further limited to its concurrency,
+    so that heavy jobs can't take all the slots.
+
+    :burst: stop once the queues are empty instead of waiting for new jobs
+    """
+    context.set_role("worker")
+    metrics_server = await metrics.start_metrics_server((config.METRICS_PORTS or {}).get("worker"))
+    connection = redis.from_url(REDIS_URL)
+    rq_queues = [
+        Queue(name, connection=connection, default_timeout=context.queue_timeout(name))
+        for name in queues
+    ]
+    context.context["executor"] = ProcessPoolExecutor(max_workers=config.WORKER_PROCESSES)
+    context.context["http_session"] = aiohttp.ClientSession(
+        headers={"user-agent": config.USER_AGENT}
+    )
+    slots = asyncio.Semaphore(config.WORKER_CONCURRENCY)
+    running: set[asyncio.Task] = set()
+    running_by_queue: defaultdict[str, int] = defaultdict(int)
+    queues_concurrency: dict = config.WORKER_QUEUES_CONCURRENCY or {}
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    async def run(job: Job, queue: Queue) -> None:
+        try:
+            await perform_job(job, queue)
+        finally:
+            running_by_queue[queue.name] -= 1
+            slots.release()
+
+    log.info(f"Async worker listening to {', '.join(queues)}")
+    try:
+        while not stopping.is_set():
+            await slots.acquire()
+            # only pop from the queues which haven't reached their own concurrency
+            available: list[Queue] = [
+                q
+                for q in rq_queues
+                if running_by_queue[q.name]
+                < queues_concurrency.get(q.name, config.WORKER_CONCURRENCY)
+            ]
+            if not available:
+                slots.release()
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                # blocking pop in a thread, with a timeout so that stopping is noticed
+                dequeued = await asyncio.to_thread(
+                    Queue.dequeue_any,
+                    available,
+                    None if burst else config.WORKER_DEQUEUE_TIMEOUT,
+                    connection=connection,
+                )
+            except DequeueTimeout:
+                dequeued = None
+            if not dequeued:
+                slots.release()
+                if burst and not running:
+                    break
+                if burst:
+                    await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            job, queue = dequeued
+            running_by_queue[queue.name] += 1
+            task = asyncio.create_task(run(job, queue))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        log.info(f"Async worker stopping, waiting for {len(running)} running jobs")
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        await context.context.pop("http_session").close()
+        context.context.pop("executor").shutdown()
+        await sender.flush()
+        for db in list(context.context["databases"]):
+            await context.context["databases"].pop(db).close()
+        if metrics_server:
+            await metrics_server.cleanup()
+
+
+def run() -> None:
+    """Launch the async worker on all the queues"""
+    asyncio.run(start_worker())
+
+
+if __name__ == "__main__":
+    run()